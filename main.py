@@ -1,8 +1,12 @@
 # Import necessary libraries
+import time
+# Record the moment the process started importing so the startup timing report can measure
+# how long it takes until the first window is drawn
+_STARTUP_T0 = time.perf_counter()
 import tkinter as tk  # (GUI toolkit for creating desktop applications)
 # ttk (themed tk) is a module in tkinter that provides access to the Tk themed widget set,
 # offering a more modern and customizable look for GUI elements compared to standard tkinter widgets
-from tkinter import ttk, filedialog, messagebox, font as tkfont
+from tkinter import ttk, filedialog, messagebox, simpledialog, font as tkfont
 # Example: ttk.Button(parent, text="Click me") creates a themed button
 import tkinterdnd2 as tkdnd  # (Extension for drag and drop functionality)
 # Example: root.drop_target_register(tkdnd.DND_FILES) enables file drop on a window
@@ -10,26 +14,229 @@ import fitz  # (PyMuPDF library for PDF handling)
 # Example: doc = fitz.open("example.pdf") opens a PDF file
 from PIL import Image, ImageTk  # (Python Imaging Library for image processing)
 # Example: img = Image.open("example.jpg") opens an image file
-import io
-import requests
-from openai import OpenAI
+import os
+import sys
+import json
+import httpx
+import asyncio
+import random
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from openai import AsyncOpenAI
 from os import getenv
 import pytesseract  # (Optical Character Recognition library)
 # Example: text = pytesseract.image_to_string(Image.open('image.png')) extracts text from an image
 import pyperclip
 import threading
 import queue
-from duckduckgo_search import DDGS
-import time
-from openai import OpenAIError
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from PIL import Image, ImageTk
-from pix2tex.cli import LatexOCR
+import multiprocessing
+import bisect
+import hashlib
+import re
+import sqlite3
+import argparse
+import heapq
+import itertools
+import statistics
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+from openai import OpenAIError, APIConnectionError, APIStatusError
 import numpy as np
+# Note: matplotlib, pix2tex (torch) and duckduckgo_search are heavy to import, so they are
+# imported lazily inside the functions that use them instead of here. This keeps the time
+# until the first window appears short.
+
+# Directory used for on-disk caches (model catalog, indexes, ...)
+CACHE_DIR = getenv("PDF_ASSISTANT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pdf_study_assistant"))
+# How long (in seconds) the cached OpenRouter model catalog stays fresh
+MODEL_CATALOG_TTL = int(getenv("PDF_ASSISTANT_MODEL_CATALOG_TTL", str(24 * 60 * 60)))
+# Context length used until the real value has been loaded from the model catalog
+DEFAULT_CONTEXT_LENGTH = 131072
+# Target time (in seconds) from process start until the first window is drawn
+STARTUP_TARGET_SECONDS = float(getenv("PDF_ASSISTANT_STARTUP_TARGET", "1.0"))
+# Whether to start the LaTeX OCR worker (which loads the model) right after the window appears.
+# If disabled, it is started the first time an equation is highlighted.
+PRELOAD_LATEX_OCR = getenv("PDF_ASSISTANT_PRELOAD_LATEX", "1") == "1"
+# Number of CPU threads the LaTeX OCR model (torch) may use, so it doesn't starve page rendering
+LATEX_TORCH_THREADS = int(getenv("PDF_ASSISTANT_LATEX_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Maximum number of equation images sent to the LaTeX OCR worker in one batch
+LATEX_MAX_BATCH = int(getenv("PDF_ASSISTANT_LATEX_MAX_BATCH", "8"))
+# Seconds LatexWorker.recognize waits for a result (the model may still be loading)
+LATEX_RECOGNIZE_TIMEOUT = 120
+# Maximum number of tokens of conversation sent with each AI request (it is also
+# limited by the model's context length minus CONTEXT_RESPONSE_RESERVE)
+CONTEXT_BUDGET_TOKENS = int(getenv("PDF_ASSISTANT_CONTEXT_BUDGET", "16000"))
+# Tokens of the context length kept free for the model's answer
+CONTEXT_RESPONSE_RESERVE = 4096
+# Path of the on-disk cache of document summaries
+SUMMARY_CACHE_PATH = os.path.join(CACHE_DIR, "summaries.sqlite3")
+# Maximum number of AI requests running at the same time while summarising a document
+SUMMARY_CONCURRENCY = int(getenv("PDF_ASSISTANT_SUMMARY_CONCURRENCY", "4"))
+# Number of attempts for each AI request while summarising a document
+SUMMARY_RETRIES = int(getenv("PDF_ASSISTANT_SUMMARY_RETRIES", "3"))
+# Size (in tokens) of the sections a document is split into for summarisation
+SUMMARY_SECTION_TOKENS = 3000
+# Path of the on-disk cache of AI responses to document analyses (highlights and PDF questions)
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "responses.sqlite3")
+# Size limit (in megabytes) and maximum age (in days) of the response cache
+RESPONSE_CACHE_MB = int(getenv("PDF_ASSISTANT_RESPONSE_CACHE_MB", "50"))
+RESPONSE_CACHE_DAYS = int(getenv("PDF_ASSISTANT_RESPONSE_CACHE_DAYS", "30"))
+# Whether a request that is nearly the same as a cached one (e.g. a slightly different
+# highlight of the same passage) returns the cached response, and how similar it must be
+RESPONSE_CACHE_NEAR = getenv("PDF_ASSISTANT_RESPONSE_CACHE_NEAR", "1") == "1"
+RESPONSE_CACHE_SIMILARITY = float(getenv("PDF_ASSISTANT_RESPONSE_CACHE_SIMILARITY", "0.85"))
+# Maximum number of AI requests processed at the same time (chat, highlights and document jobs)
+AI_CONCURRENCY = int(getenv("PDF_ASSISTANT_AI_CONCURRENCY", "2"))
+# Maximum number of those that may be background work (document summaries), so at least
+# one is always free for chat and highlights
+AI_BACKGROUND_CONCURRENCY = int(getenv("PDF_ASSISTANT_AI_BACKGROUND_CONCURRENCY", str(max(1, AI_CONCURRENCY - 1))))
+# Priority classes of AI tasks (lower runs first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_HIGHLIGHT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "chat", PRIORITY_HIGHLIGHT: "highlight", PRIORITY_BACKGROUND: "background"}
+# How often (in milliseconds) a streaming AI answer is redrawn in the chat panel
+STREAM_REFRESH_MS = int(getenv("PDF_ASSISTANT_STREAM_REFRESH_MS", "50"))
+# Maximum number of network requests (AI, model catalog, web search) in flight at once
+HTTP_CONCURRENCY = int(getenv("PDF_ASSISTANT_HTTP_CONCURRENCY", "8"))
+# Seconds allowed for opening a connection, and for waiting on data from an open one
+HTTP_CONNECT_TIMEOUT = float(getenv("PDF_ASSISTANT_HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(getenv("PDF_ASSISTANT_HTTP_READ_TIMEOUT", "120"))
+# Idle keep-alive connections are kept open this long (in seconds) for reuse
+HTTP_KEEPALIVE_SECONDS = 60
+# The longest wait (in seconds) between two attempts of a failed request
+HTTP_BACKOFF_MAX = 60
+# Web search results and fetched pages are cached on disk for this many seconds
+WEB_CACHE_PATH = os.path.join(CACHE_DIR, "web_cache.sqlite3")
+WEB_CACHE_TTL = int(getenv("PDF_ASSISTANT_WEB_CACHE_TTL", str(6 * 60 * 60)))
+# Number of search results whose pages are read and sent to the AI with the results
+WEB_FETCH_PAGES = int(getenv("PDF_ASSISTANT_WEB_FETCH_PAGES", "3"))
+# Limits for reading one page: its size in bytes and the time in seconds
+WEB_FETCH_MAX_BYTES = int(getenv("PDF_ASSISTANT_WEB_FETCH_MAX_KB", "1024")) * 1024
+WEB_FETCH_TIMEOUT = float(getenv("PDF_ASSISTANT_WEB_FETCH_TIMEOUT", "8"))
+# Number of characters of each page's text sent to the AI
+WEB_EXCERPT_CHARS = 1500
+# Maximum number of rounds of tool calls the AI may make before it has to answer
+TOOL_MAX_ITERATIONS = int(getenv("PDF_ASSISTANT_TOOL_MAX_ITERATIONS", "5"))
+# Seconds a round of tool calls may take; unfinished calls report a timeout to the AI
+TOOL_TIMEOUT = float(getenv("PDF_ASSISTANT_TOOL_TIMEOUT", "60"))
+# Maximum number of characters of one tool result sent to the AI
+TOOL_RESULT_CHARS = 6000
+# Number of threads that run tool calls (shared by all AI tasks)
+TOOL_WORKERS = int(getenv("PDF_ASSISTANT_TOOL_WORKERS", "8"))
+# Number of rendered chat equations kept in memory
+LATEX_RENDER_CACHE_SIZE = int(getenv("PDF_ASSISTANT_LATEX_RENDER_CACHE", "256"))
+# Path of the on-disk cache of equations found on pages and their LaTeX
+EQUATION_CACHE_PATH = os.path.join(CACHE_DIR, "equations.sqlite3")
+# Scale at which equation regions are rendered for LaTeX OCR (2 = 144 DPI, like highlights)
+EQUATION_RENDER_SCALE = 2
+# Fonts used for math by TeX (Computer Modern/AMS), Unicode math fonts and Symbol
+MATH_FONT_PATTERN = re.compile(r"CMMI|CMSY|CMEX|CMBSY|MSAM|MSBM|EUFM|EUSM|RSFS|Math|Symbol|STIX", re.IGNORECASE)
+# Memory budget (in megabytes) for rendered pages kept in the page cache
+PAGE_CACHE_BUDGET_MB = int(getenv("PDF_ASSISTANT_PAGE_CACHE_MB", "256"))
+# Number of pages rendered ahead in the reading direction
+PREFETCH_PAGES = int(getenv("PDF_ASSISTANT_PREFETCH_PAGES", "2"))
+# Scale used for the fast low-resolution preview shown before the full-resolution page
+PREVIEW_SCALE = float(getenv("PDF_ASSISTANT_PREVIEW_SCALE", "0.5"))
+# Zoom levels (scale factors) the user can choose from
+ZOOM_LEVELS = [1, 1.5, 2, 3, 4, 6]
+# Pages larger than this many megapixels at the current zoom are rendered in tiles
+TILED_RENDER_MIN_MEGAPIXELS = float(getenv("PDF_ASSISTANT_TILED_MIN_MEGAPIXELS", "6"))
+# Size (in pixels) of the square tiles used for tiled rendering
+TILE_SIZE = int(getenv("PDF_ASSISTANT_TILE_SIZE", "512"))
+# Gap (in pixels) between pages in continuous scroll mode
+CONTINUOUS_PAGE_GAP = 10
+# Number of pages whose parsed content (display list and text page) is kept in memory
+PAGE_CONTENT_CACHE_PAGES = int(getenv("PDF_ASSISTANT_PAGE_CONTENT_CACHE_PAGES", "16"))
+# Number of pages whose word index is kept in memory
+WORD_INDEX_CACHE_PAGES = int(getenv("PDF_ASSISTANT_WORD_INDEX_CACHE_PAGES", "64"))
+# SQLite database holding the full-text search index of every opened PDF
+SEARCH_INDEX_PATH = os.path.join(CACHE_DIR, "search_index.sqlite3")
+# Resolution used to OCR pages without a text layer while building the search index
+SEARCH_OCR_DPI = int(getenv("PDF_ASSISTANT_SEARCH_OCR_DPI", "150"))
+# Directory of the retrieval indexes (one file per document) used to pick the parts of a
+# PDF that are sent to the AI
+RETRIEVAL_INDEX_DIR = os.path.join(CACHE_DIR, "retrieval")
+# Size of the chunks (in words) that documents are split into for retrieval
+RETRIEVAL_CHUNK_WORDS = 200
+# Number of chunks sent to the AI with a question about the PDF
+RETRIEVAL_TOP_K = int(getenv("PDF_ASSISTANT_RETRIEVAL_TOP_K", "5"))
+# SQLite database holding OCR results (text and word boxes) of scanned pages
+OCR_CACHE_PATH = os.path.join(CACHE_DIR, "ocr_cache.sqlite3")
+# Resolution used by the background whole-document OCR job
+OCR_DPI = int(getenv("PDF_ASSISTANT_OCR_DPI", "300"))
+# Number of processes used by the background OCR job (default: all cores)
+OCR_WORKERS = int(getenv("PDF_ASSISTANT_OCR_WORKERS", str(os.cpu_count() or 1)))
+# Number of warm Tesseract engines kept loaded for interactive OCR (selections, submissions)
+OCR_ENGINE_WORKERS = int(getenv("PDF_ASSISTANT_OCR_ENGINE_WORKERS", "2"))
+# Tesseract language(s) used by the warm engines
+OCR_LANG = getenv("PDF_ASSISTANT_OCR_LANG", "eng")
+# Resolution images are rescaled to before interactive OCR
+OCR_TARGET_DPI = int(getenv("PDF_ASSISTANT_OCR_TARGET_DPI", "300"))
+
+
+class StartupTimer:
+    """
+    Records named checkpoints measured from process start.
+
+    The timer is used to produce a startup timing report showing how long it takes
+    until the first window is drawn and when the background loaders finish.
+
+    Example:
+    startup_timer.mark("ui built")
+    startup_timer.report()
+    """
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.marks = []  # (A list of (name, seconds since start) tuples)
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        """
+        Records a checkpoint and returns the elapsed time in seconds.
+
+        Parameters:
+        - name (str): A short description of the checkpoint
+        """
+        elapsed = time.perf_counter() - self.start_time
+        with self.lock:
+            self.marks.append((name, elapsed))
+        return elapsed
+
+    def elapsed(self, name):
+        """
+        Returns the elapsed time recorded for a checkpoint, or None if it was not recorded.
+        """
+        with self.lock:
+            for mark_name, elapsed in self.marks:
+                if mark_name == name:
+                    return elapsed
+        return None
+
+    def report(self, target=STARTUP_TARGET_SECONDS):
+        """
+        Prints the startup timing report.
+
+        Parameters:
+        - target (float): The time-to-first-window target in seconds
+        """
+        with self.lock:
+            marks = list(self.marks)
+        print("Startup timing report:")
+        for name, elapsed in marks:
+            print(f"  {elapsed * 1000:8.1f} ms  {name}")
+        first_window = self.elapsed("first window drawn")
+        if first_window is not None:
+            status = "OK" if first_window <= target else "SLOW"
+            print(f"  Time to first window: {first_window:.3f}s (target {target:.3f}s) [{status}]")
+
+
+startup_timer = StartupTimer(_STARTUP_T0)
+startup_timer.mark("imports done")
 
 # Function to get model information from OpenRouter API
-def get_model_info(model_name):
+def get_model_info(model_name, cache_ttl=MODEL_CATALOG_TTL, timeout=10):
     """
     Retrieves information about a specific AI model from the OpenRouter API.
     
@@ -37,8 +244,15 @@ def get_model_info(model_name):
     to fetch details about available models. It then searches for the specified model by name
     and returns its information.
 
+    The model catalog is cached on disk. A cached catalog younger than cache_ttl seconds is used
+    without any network call, and a stale cached catalog is used as a fallback when the request
+    fails (for example when the network is slow or offline).
+
     Parameters:
     - model_name (str): The name of the AI model to look up
+    - cache_ttl (int): How long (in seconds) the cached catalog stays fresh
+    - timeout (float): Timeout in seconds for the request to OpenRouter (the request goes
+      through the shared connection pool, see AsyncIOLayer)
 
     Returns:
     - dict or None: A dictionary (a data structure that stores key-value pairs) containing model
@@ -49,44 +263,754 @@ def get_model_info(model_name):
     if model_info:
         print(f"Model context length: {model_info['context_length']}")
     """
-    # Send a GET request to the OpenRouter API
-    response = requests.get(
-        'https://openrouter.ai/api/v1/models',
-        headers={'Authorization': f'Bearer {getenv("OPENROUTER_API_KEY")}'}
-    )
-    models = response.json()
-    
-    # Search for the specified model in the response
-    for model in models['data']:
+    cache_path = os.path.join(CACHE_DIR, "model_catalog.json")
+
+    # Try the cached catalog first
+    cached_models = None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        cached_models = cached["models"]
+        if time.time() - cached["fetched_at"] < cache_ttl:
+            return _find_model(cached_models, model_name)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    try:
+        # Send a GET request to the OpenRouter API
+        response = io_layer.run(io_layer.request(
+            "GET",
+            'https://openrouter.ai/api/v1/models',
+            headers={'Authorization': f'Bearer {getenv("OPENROUTER_API_KEY")}'},
+            timeout=timeout,
+        ))
+        models = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Error fetching model catalog: {str(e)}")
+        # Fall back to the stale cached catalog if there is one
+        return _find_model(cached_models, model_name) if cached_models else None
+
+    # Save the catalog so the next start does not need the network
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": time.time(), "models": models['data']}, f)
+    except OSError as e:
+        print(f"Error caching model catalog: {str(e)}")
+
+    return _find_model(models['data'], model_name)
+
+def _find_model(models, model_name):
+    # Search for the specified model in the list of models
+    for model in models:
         if model['id'] == model_name:
             return model
     return None
 
-# Set up OpenAI client with OpenRouter base URL and API key
+def retry_after_seconds(response):
+    """
+    Reads how long a server asked us to wait before trying again.
+
+    Servers that are rate limiting (HTTP 429) or overloaded (HTTP 503) often send a
+    Retry-After header, either as a number of seconds or as a date.
+
+    Parameters:
+    - response (httpx.Response or None): The failed response
+
+    Returns:
+    - float or None: The number of seconds to wait, or None if the server did not say
+    """
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base=1.0, cap=HTTP_BACKOFF_MAX):
+    """
+    Returns how long to wait before the next attempt of a failed request.
+
+    The wait doubles with every attempt (exponential backoff) and a random part of it
+    is used (jitter), so that many requests failing together do not all retry at the
+    same moment. When the server said how long to wait (Retry-After), that is used instead.
+
+    Parameters:
+    - attempt (int): The number of the attempt that failed (0 for the first)
+    - retry_after (float or None): The wait the server asked for, see retry_after_seconds
+    - base (float): The wait in seconds after the first failure
+    - cap (float): The longest wait in seconds
+
+    Returns:
+    - float: The number of seconds to wait
+
+    Example:
+    backoff_delay(3)  # a random wait between 0 and 8 seconds
+    """
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_retryable_error(error):
+    """
+    Returns True if a failed request is worth trying again: network errors, timeouts,
+    rate limits (HTTP 429 and DuckDuckGo's rate limit) and server errors (HTTP 5xx).
+    Other client errors, such as a wrong API key, and errors from bugs in our own code
+    are not retried, so they show up right away.
+    """
+    if isinstance(error, (httpx.TransportError, APIConnectionError)):
+        # (httpx timeouts are transport errors, and APITimeoutError is an APIConnectionError)
+        return True
+    if isinstance(error, (httpx.HTTPStatusError, APIStatusError)):
+        status = error.response.status_code
+        return status in (408, 409, 429) or status >= 500
+    # DuckDuckGo's rate limit and timeout errors (the package is only imported once a search has run)
+    ddgs_exceptions = sys.modules.get("duckduckgo_search.exceptions")
+    if ddgs_exceptions is not None:
+        transient = tuple(getattr(ddgs_exceptions, name) for name in ("RatelimitException", "TimeoutException")
+                          if hasattr(ddgs_exceptions, name))
+        return isinstance(error, transient)
+    return False
+
+
+class AsyncIOLayer:
+    """
+    The network layer shared by the AI requests, the model catalog and the web search.
+
+    An asyncio event loop runs on a background thread and owns one pool of keep-alive
+    HTTP connections, so requests made in parallel (chat, highlights, a document
+    summary) reuse open connections instead of paying for a new TLS handshake each
+    time. A semaphore limits how many requests are in flight at once, every request
+    has its own timeout, and failed requests are retried with exponential backoff
+    that honours the server's Retry-After header.
+
+    Code on other threads hands coroutines to the loop with run(), which waits for
+    the result.
+
+    Example:
+    response = io_layer.run(io_layer.request("GET", "https://openrouter.ai/api/v1/models"))
+    """
+
+    def __init__(self, concurrency=HTTP_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self.loop = None
+        self.thread = None
+        self.http = None
+        self.limiter = None
+        self._openai = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the event loop thread and opens the connection pool (done on first use,
+        so a start of the app without network activity costs nothing).
+        """
+        with self.lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=loop.run_forever, name="io-loop", daemon=True)
+            self.thread.start()
+            asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+            self.loop = loop
+
+    async def _open(self):
+        # The pool and the semaphore are created on the loop they are used on
+        self.limiter = asyncio.Semaphore(self.concurrency)
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+            ),
+        )
+
+    @property
+    def openai(self):
+        """
+        The OpenAI client for OpenRouter, sharing the connection pool. Its own retries
+        are turned off, since the requests are retried by with_retries.
+        """
+        self.start()
+        if self._openai is None:
+            self._openai = AsyncOpenAI(
+                base_url="https://openrouter.ai/api/v1",
+                api_key=getenv("OPENROUTER_API_KEY"),
+                http_client=self.http,
+                max_retries=0,
+            )
+        return self._openai
+
+    def run(self, coro, timeout=None):
+        """
+        Runs a coroutine on the event loop and waits for its result (called from any
+        other thread; exceptions raised by the coroutine are raised here).
+
+        Parameters:
+        - coro (coroutine): The work to run
+        - timeout (float or None): Seconds to wait for the result; the coroutine is
+          cancelled if it takes longer
+
+        Returns:
+        - The result of the coroutine
+        """
+        self.start()
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("AsyncIOLayer.run() cannot wait on the event loop thread")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    async def with_retries(self, make_call, retries=3, base_delay=1.0, what="request"):
+        """
+        Awaits make_call() while holding a slot of the limiter, retrying failures that
+        are worth retrying (see is_retryable_error) with backoff_delay.
+
+        Parameters:
+        - make_call (function): Returns a new coroutine for each attempt
+        - retries (int): Maximum number of attempts
+        - base_delay (float): The wait in seconds after the first failure
+        - what (str): A name for the request in log messages
+
+        Returns:
+        - The result of the first successful attempt. Otherwise the last error is
+          raised, with the number of attempts made in its `attempts` attribute
+        """
+        for attempt in range(retries):
+            try:
+                async with self.limiter:
+                    return await make_call()
+            except Exception as e:
+                if attempt >= retries - 1 or not is_retryable_error(e):
+                    e.attempts = attempt + 1
+                    raise
+                delay = backoff_delay(attempt, retry_after_seconds(getattr(e, "response", None)), base_delay)
+                print(f"Error in {what}: {str(e)}. Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+
+    async def request(self, method, url, timeout=None, retries=3, **kwargs):
+        """
+        Sends an HTTP request through the connection pool.
+
+        Parameters:
+        - method (str): The HTTP method, e.g. "GET"
+        - url (str): The address
+        - timeout (float or None): Timeout in seconds for this request (the pool's
+          default timeouts are used if None)
+        - retries (int): Maximum number of attempts
+        - kwargs: Passed on to httpx (headers, params, json, ...)
+
+        Returns:
+        - httpx.Response: The response; an error status raises httpx.HTTPStatusError
+        """
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+
+        async def send():
+            response = await self.http.request(method, url, **kwargs)
+            response.raise_for_status()
+            return response
+
+        return await self.with_retries(send, retries, what=f"{method} {url}")
+
+    async def call_blocking(self, func, *args, retries=3, what="call", **kwargs):
+        """
+        Runs a blocking function (for example a DuckDuckGo search) on a thread, under
+        the same limiter and retry rules as the HTTP requests.
+        """
+        return await self.with_retries(lambda: asyncio.to_thread(func, *args, **kwargs), retries, what=what)
+
+
+# The network layer used by the whole app
+io_layer = AsyncIOLayer()
+
+class ReadableTextParser(HTMLParser):
+    """
+    Collects the readable text of a web page: its title and the text of its
+    paragraphs, headings, list items and table cells, leaving out scripts, styles,
+    navigation, headers, footers and forms.
+
+    Example:
+    parser = ReadableTextParser()
+    parser.feed(html)
+    parser.close()
+    print(parser.title, parser.blocks)
+    """
+    SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside", "form",
+                 "button", "select", "iframe"}
+    BLOCK_TAGS = {"p", "div", "section", "article", "main", "br", "li", "ul", "ol", "dl", "dt", "dd", "table", "tr",
+                  "td", "th", "blockquote", "pre", "h1", "h2", "h3", "h4", "h5", "h6", "figcaption"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.blocks = []
+        self.current = []
+        self.skip_depth = 0
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "title":
+            self.in_title = True
+        elif tag in self.BLOCK_TAGS:
+            self.end_block()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == "title":
+            self.in_title = False
+        elif tag in self.BLOCK_TAGS:
+            self.end_block()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif not self.skip_depth:
+            self.current.append(data)
+
+    def end_block(self):
+        # Collapse the whitespace of the text collected since the last block boundary
+        text = " ".join("".join(self.current).split())
+        if text:
+            self.blocks.append(text)
+        self.current = []
+
+    def close(self):
+        super().close()
+        self.end_block()
+
+
+def extract_readable_text(html, min_words=6):
+    """
+    Extracts the readable text of a web page.
+
+    Parameters:
+    - html (str): The page's HTML
+    - min_words (int): Shorter blocks (menu entries, buttons, captions) are left out
+
+    Returns:
+    - tuple: (title, list of paragraphs)
+    """
+    parser = ReadableTextParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        print(f"Error parsing web page: {str(e)}")
+    paragraphs = [block for block in parser.blocks if len(block.split()) >= min_words]
+    return " ".join(parser.title.split()), paragraphs
+
+
+async def fetch_page_text(url, max_bytes=WEB_FETCH_MAX_BYTES, timeout=WEB_FETCH_TIMEOUT, retries=3):
+    """
+    Downloads a web page through the shared connection pool and extracts its readable text.
+
+    At most max_bytes are read and the whole download may take at most timeout
+    seconds. Pages that are not HTML or text (PDFs, images) are skipped. The text is
+    extracted on a thread, so the event loop keeps serving the other downloads.
+
+    Failed downloads are retried like the other requests (see AsyncIOLayer.with_retries),
+    within the same time limit.
+
+    Returns:
+    - tuple or None: (title, list of paragraphs), or None for a page that is not text
+    """
+    async def download():
+        async with io_layer.http.stream("GET", url, timeout=timeout, follow_redirects=True,
+                                        headers={"User-Agent": "Mozilla/5.0 (PDF Study Assistant)"}) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "text/html").lower()
+            if "html" not in content_type and not content_type.startswith("text/"):
+                return None
+            body = bytearray()
+            async for piece in response.aiter_bytes():
+                body += piece
+                if len(body) >= max_bytes:
+                    break
+            return bytes(body[:max_bytes]), response.encoding or "utf-8"
+
+    downloaded = await asyncio.wait_for(io_layer.with_retries(download, retries, what=f"GET {url}"), timeout)
+    if downloaded is None:
+        return None
+    body, encoding = downloaded
+    try:
+        html = body.decode(encoding, errors="replace")
+    except LookupError:
+        html = body.decode("utf-8", errors="replace")
+    return await asyncio.to_thread(extract_readable_text, html)
+
+
+def fetch_pages(urls, max_bytes=WEB_FETCH_MAX_BYTES, timeout=WEB_FETCH_TIMEOUT):
+    """
+    Downloads several web pages at the same time and extracts their readable text
+    (see fetch_page_text).
+
+    Parameters:
+    - urls (list): The addresses
+
+    Returns:
+    - dict: {url: (title, list of paragraphs)} for the pages that could be read
+
+    Example:
+    pages = fetch_pages(["http://127.0.0.1:8000/a.html", "http://127.0.0.1:8000/b.html"])
+    """
+    async def fetch_all():
+        return await asyncio.gather(*(fetch_page_text(url, max_bytes, timeout) for url in urls), return_exceptions=True)
+
+    pages = {}
+    for url, result in zip(urls, io_layer.run(fetch_all())):
+        if isinstance(result, BaseException):
+            print(f"Error fetching {url}: {type(result).__name__} {str(result)}")
+        elif result is not None:
+            pages[url] = result
+    return pages
+
+
+def build_excerpt_bundle(results, pages, chars_per_page=WEB_EXCERPT_CHARS):
+    """
+    Builds the compact text of the fetched pages that is sent to the AI with the
+    search results.
+
+    Each page contributes its first paragraphs up to chars_per_page characters.
+    Paragraphs that already appeared on an earlier page (the same text copied across
+    sites, cookie notices) are left out, and so are pages with nothing new.
+
+    Parameters:
+    - results (list): The search results, as dicts with "title" and "href"
+    - pages (dict): {url: (title, list of paragraphs)}, see fetch_pages
+
+    Returns:
+    - str: The excerpts, each labelled with its result number and address, or "" if there are none
+    """
+    seen = set()
+    excerpts = []
+    for number, result in enumerate(results, 1):
+        page = pages.get(result.get("href"))
+        if not page:
+            continue
+        title, paragraphs = page
+        chosen = []
+        length = 0
+        for paragraph in paragraphs:
+            key = hashlib.sha1(" ".join(re.findall(r"\w+", paragraph.lower())).encode("utf-8")).digest()
+            if key in seen:
+                continue
+            seen.add(key)
+            if length + len(paragraph) > chars_per_page:
+                if not chosen:
+                    chosen.append(paragraph[:chars_per_page] + "...")
+                break
+            chosen.append(paragraph)
+            length += len(paragraph)
+        if chosen:
+            excerpts.append(f"[{number}] {title or result.get('title', '')} ({result['href']})\n" + "\n".join(chosen))
+    return "\n\n".join(excerpts)
+
+
+class WebCache:
+    """
+    An on-disk cache of web search results and the text of fetched pages, stored in SQLite.
+
+    Entries older than ttl seconds are not used, and are removed when a newer entry
+    is stored. The cache may be used from several threads.
+
+    Example:
+    cache = WebCache()
+    results = cache.get_search("entropy", 5)
+    if results is None:
+        results = ...
+        cache.put_search("entropy", 5, results)
+    """
+    def __init__(self, db_path=WEB_CACHE_PATH, ttl=WEB_CACHE_TTL):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, results TEXT, fetched_at REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, title TEXT, paragraphs TEXT, fetched_at REAL)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.ttl = ttl
+
+    @staticmethod
+    def search_key(query, max_results):
+        return f"{max_results}:{' '.join(query.lower().split())}"
+
+    def get_search(self, query, max_results):
+        with self.lock:
+            row = self.conn.execute("SELECT results FROM searches WHERE key = ? AND fetched_at > ?",
+                                    (self.search_key(query, max_results), time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_search(self, query, max_results, results):
+        with self.lock:
+            self.conn.execute("DELETE FROM searches WHERE fetched_at <= ?", (time.time() - self.ttl,))
+            self.conn.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                              (self.search_key(query, max_results), json.dumps(results), time.time()))
+            self.conn.commit()
+
+    def get_pages(self, urls):
+        """
+        Returns {url: (title, list of paragraphs)} for the cached pages among urls.
+        """
+        pages = {}
+        with self.lock:
+            for url in urls:
+                row = self.conn.execute("SELECT title, paragraphs FROM pages WHERE url = ? AND fetched_at > ?",
+                                        (url, time.time() - self.ttl)).fetchone()
+                if row:
+                    pages[url] = (row[0], json.loads(row[1]))
+        return pages
+
+    def put_pages(self, pages):
+        with self.lock:
+            self.conn.execute("DELETE FROM pages WHERE fetched_at <= ?", (time.time() - self.ttl,))
+            self.conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                                  [(url, title, json.dumps(paragraphs), time.time()) for url, (title, paragraphs) in pages.items()])
+            self.conn.commit()
+
+
+# The AI model used through OpenRouter (see AsyncIOLayer.openai for the client)
 model = "nousresearch/hermes-3-llama-3.1-405b"
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=getenv("OPENROUTER_API_KEY"),
-)
 
-# Get model info and set max tokens
-model_info = get_model_info(model)
-max_tokens = model_info['context_length'] if model_info else 131072
+# Model info and max tokens. These start with defaults and are filled in by
+# load_model_info(), which runs on a background thread after the window appears.
+model_info = None
+max_tokens = DEFAULT_CONTEXT_LENGTH
+
+def load_model_info():
+    """
+    Loads the model information (context length etc.) for the current model.
+
+    This function is run on a background thread so that a slow network never
+    delays the first window.
+    """
+    global model_info, max_tokens
+    info = get_model_info(model)
+    if info:
+        model_info = info
+        max_tokens = info.get('context_length') or DEFAULT_CONTEXT_LENGTH
+    startup_timer.mark("model catalog loaded")
+
+def minhash_signature(text, num_hashes=64, shingle_words=3):
+    """
+    Computes a MinHash signature of a text, used to find nearly identical texts.
+
+    The text is split into overlapping shingles of a few words. For each of
+    num_hashes hash functions, the signature holds the smallest hash of any shingle.
+    The fraction of positions where two signatures agree estimates the Jaccard
+    similarity of the two texts' shingle sets.
+
+    Parameters:
+    - text (str): The text
+    - num_hashes (int): Length of the signature
+    - shingle_words (int): Words per shingle
+
+    Returns:
+    - numpy.ndarray: The signature (uint32)
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + shingle_words]) for i in range(max(1, len(words) - shingle_words + 1))}
+    prime = (1 << 31) - 1
+    values = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") % prime
+                       for shingle in shingles], dtype=np.uint64)
+    # Fixed random hash functions h(x) = (a * x + b) mod prime (the same in every session)
+    rng = np.random.default_rng(12345)
+    a = rng.integers(1, prime, num_hashes, dtype=np.uint64)
+    b = rng.integers(0, prime, num_hashes, dtype=np.uint64)
+    return ((a[:, None] * values[None, :] + b[:, None]) % prime).min(axis=1).astype(np.uint32)
+
+
+class ResponseCache:
+    """
+    An on-disk cache of AI responses, stored in SQLite.
+
+    A response is stored under a key made from the model, the system prompt and the
+    last user message (with whitespace normalised), so sending the same highlight or
+    page question again, even in a later session, returns the stored answer instead
+    of making a request. Optionally, a request whose last message is nearly the same
+    as a cached one (MinHash similarity of at least RESPONSE_CACHE_SIMILARITY) is a
+    hit too.
+
+    Callers can pass a cache_key dict to say what identifies a request instead of the
+    last user message: "prompt" (the text the key and the near-duplicate signature are
+    made from, e.g. only the highlighted text or the question), "scope" (added to the
+    scope, e.g. the document fingerprint and page) and "near" (False to only allow
+    exact matches). This matters when the message holds a long page of text and a
+    short question: two different questions about the same page would otherwise be
+    near duplicates.
+
+    Entries older than RESPONSE_CACHE_DAYS are removed, and the least recently used
+    entries are removed when the cache grows over RESPONSE_CACHE_MB. Hits and misses
+    are counted for the statistics.
+
+    The cache may be used from several threads.
+
+    Example:
+    cache = ResponseCache()
+    response = cache.get(model, messages)
+    if response is None:
+        response = ...
+        cache.put(model, messages, response)
+    """
+    def __init__(self, db_path=RESPONSE_CACHE_PATH, max_mb=RESPONSE_CACHE_MB, max_days=RESPONSE_CACHE_DAYS,
+                 near=RESPONSE_CACHE_NEAR, similarity=RESPONSE_CACHE_SIMILARITY):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, scope TEXT, prompt TEXT, signature BLOB, "
+                          "response TEXT, created REAL, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_days * 24 * 60 * 60
+        self.near = near
+        self.similarity = similarity
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split())
+
+    def keys(self, model_name, messages, cache_key=None):
+        """
+        Returns (key, scope, prompt): the cache key of a request, the key of its model
+        and system prompt (near matches are only looked for within the same scope),
+        and its last user message (or cache_key["prompt"]).
+        """
+        cache_key = cache_key or {}
+        # Only the first system message is the system prompt (the others hold context
+        # that changes during a conversation, like summaries)
+        system = next((self.normalize(message["content"]) for message in messages if message["role"] == "system"), "")
+        if "prompt" in cache_key:
+            prompt = self.normalize(cache_key["prompt"])
+        else:
+            prompt = next((self.normalize(message["content"]) for message in reversed(messages) if message["role"] == "user"), "")
+        scope = hashlib.sha256(json.dumps([model_name, system, cache_key.get("scope", "")]).encode("utf-8")).hexdigest()
+        key = hashlib.sha256(json.dumps([scope, prompt]).encode("utf-8")).hexdigest()
+        return key, scope, prompt
+
+    def get(self, model_name, messages, cache_key=None):
+        """
+        Returns (response, match) for a request, where match is "exact" or "near",
+        or (None, None) if the response is not cached.
+        """
+        key, scope, prompt = self.keys(model_name, messages, cache_key)
+        near = self.near and (cache_key or {}).get("near", True)
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ? AND created > ?",
+                                    (key, time.time() - self.max_age)).fetchone()
+            match = "exact" if row else None
+            if row is None and near:
+                rows = self.conn.execute("SELECT key, signature, response FROM responses WHERE scope = ? AND created > ?",
+                                         (scope, time.time() - self.max_age)).fetchall()
+                if rows:
+                    # Compare the signature with all cached signatures at once
+                    signatures = np.frombuffer(b"".join(signature for _, signature, _ in rows), dtype=np.uint32).reshape(len(rows), -1)
+                    similarity = (signatures == minhash_signature(prompt)).mean(axis=1)
+                    best = int(similarity.argmax())
+                    if similarity[best] >= self.similarity:
+                        key, row, match = rows[best][0], (rows[best][2],), "near"
+            if row is None:
+                self.misses += 1
+                return None, None
+            if match == "exact":
+                self.exact_hits += 1
+            else:
+                self.near_hits += 1
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return row[0], match
+
+    def put(self, model_name, messages, response, cache_key=None):
+        key, scope, prompt = self.keys(model_name, messages, cache_key)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (key, scope, prompt, minhash_signature(prompt).tobytes(), response, now, now))
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now):
+        # Remove expired entries, then the least recently used ones while over the size limit
+        self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+        total = self.conn.execute("SELECT COALESCE(SUM(LENGTH(prompt) + LENGTH(response)), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, LENGTH(prompt) + LENGTH(response) FROM responses ORDER BY last_used").fetchall():
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        """
+        Returns the hit statistics of this session: exact hits, near hits, misses and the hit rate.
+        """
+        with self.lock:
+            lookups = self.exact_hits + self.near_hits + self.misses
+            return {"exact_hits": self.exact_hits, "near_hits": self.near_hits, "misses": self.misses,
+                    "hit_rate": (self.exact_hits + self.near_hits) / lookups if lookups else 0.0}
+
+
+# The response cache, created on first use (see get_response_cache)
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
 
 # Function to send completion request to the AI model
-def completion(messages, max_retries=3, retry_delay=5):
+def completion(messages, max_retries=3, retry_delay=1, use_cache=False, cache_key=None):
     """
     Sends a completion request to the AI model and returns the response.
 
     This function uses the OpenAI client (a tool for interacting with the AI model) to create
     a chat completion based on the provided messages. It then extracts and returns the content
-    of the AI's response.
+    of the AI's response. The request goes through the shared network layer (see AsyncIOLayer),
+    which retries failed requests with exponential backoff.
 
     Parameters:
     - messages (list): A list of message dictionaries to send to the AI
+    - max_retries (int): Maximum number of attempts
+    - retry_delay (float): The wait in seconds after the first failed attempt; it doubles
+      with every further attempt (see backoff_delay)
+    - use_cache (bool): Look the request up in the response cache first, and store
+      the response there (see ResponseCache)
+    - cache_key (dict): What identifies the request in the cache (see ResponseCache)
 
     Returns:
-    - str: The content of the AI's response
+    - str: The content of the AI's response, or an error message
     
     Example:
     messages = [
@@ -96,32 +1020,2663 @@ def completion(messages, max_retries=3, retry_delay=5):
     response = completion(messages)
     print(response)  # Outputs: "The capital of France is Paris."
     """
+    if use_cache:
+        cached, match = get_response_cache().get(model, messages, cache_key)
+        if cached is not None:
+            print(f"Response cache: {match} hit")
+            return cached
+
+    async def create():
+        response = await io_layer.openai.chat.completions.create(
+            model=model,
+            messages=messages,
+        )
+        return response.choices[0].message.content
+
+    try:
+        content = io_layer.run(io_layer.with_retries(create, max_retries, retry_delay, what="AI request"))
+    except OpenAIError as e:
+        print(f"Error occurred: {str(e)}")
+        return completion_error_message(e)
+    except Exception as e:
+        return f"Unexpected error: {str(e)}"
+    if use_cache:
+        get_response_cache().put(model, messages, content, cache_key)
+    return content
+
+
+def completion_error_message(error):
+    """
+    Returns the error message shown when an AI request failed, with the number of
+    attempts made (see AsyncIOLayer.with_retries) and the kind of error.
+
+    Example:
+    completion_error_message(error)  # "Error: Unable to get a response from the AI after 3 attempts (APITimeoutError). ..."
+    """
+    attempts = getattr(error, "attempts", 1)
+    return (f"Error: Unable to get a response from the AI after {attempts} attempt{'s' if attempts != 1 else ''} "
+            f"({type(error).__name__}). Please try again later.")
+
+
+def is_completion_error(response):
+    """
+    Returns True if a response from completion() or completion_stream() is an
+    error message instead of an answer.
+    """
+    return response.startswith("Error:") or response.startswith("Unexpected error:")
+
+
+def completion_stream(messages, on_delta, max_retries=3, retry_delay=1, cancelled=None, use_cache=False,
+                      cache_key=None, tools=None, tool_choice=None, tool_calls=None):
+    """
+    Sends a completion request to the AI model and streams the response.
+
+    The answer arrives in small pieces (deltas) while the model is generating it, and
+    on_delta(text) is called for each of them, so the answer can be shown as it is
+    written. on_delta is called on the network thread (see AsyncIOLayer). A request is
+    only retried if it failed before any text arrived.
+
+    Parameters:
+    - messages (list): A list of message dictionaries to send to the AI
+    - on_delta (function): Called with every new piece of the answer
+    - max_retries (int): Maximum number of attempts
+    - retry_delay (float): The wait in seconds after the first failed attempt; it doubles
+      with every further attempt (see backoff_delay)
+    - cancelled (threading.Event): If it is set, the stream is closed and the answer
+      received so far is returned
+    - use_cache (bool): Look the request up in the response cache first (a cached
+      response is passed to on_delta in one piece), and store complete responses there
+    - cache_key (dict): What identifies the request in the cache (see ResponseCache)
+    - tools (list): Tools the model may call, in the OpenAI tools format (see AI_TOOLS)
+    - tool_choice (str): "auto" (the default) or "none" to make the model answer without tools
+    - tool_calls (list): The tool calls the model makes are appended to this list, as
+      dicts with "id", "name" and "arguments" (a JSON string); a response with tool
+      calls is not cached
+
+    Returns:
+    - tuple: (the full response or an error message, stats) where stats is a dict with
+      "first_token" (seconds until the first text arrived), "tokens" and "tokens_per_second",
+      or None if nothing was streamed; for a cached response, stats is {"cached": "exact"} or {"cached": "near"}
+
+    Example:
+    response, stats = completion_stream(messages, lambda text: print(text, end=""))
+    """
+    if use_cache:
+        cached, match = get_response_cache().get(model, messages, cache_key)
+        if cached is not None:
+            on_delta(cached)
+            return cached, {"cached": match}
+
+    async def stream_once():
+        # One attempt. Errors before the first piece of text are raised so that
+        # with_retries tries again; later errors end the answer with a note.
+        started = time.perf_counter()
+        first_token_at = None
+        pieces = []
+        chunks = 0
+        usage_tokens = None
+        calls = {}  # (tool calls by their index; their parts arrive in several chunks)
+        options = {"tools": tools, "tool_choice": tool_choice or "auto"} if tools else {}
+        try:
+            stream = await io_layer.openai.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                **options,
+            )
+            async for chunk in stream:
+                if cancelled is not None and cancelled.is_set():
+                    await stream.close()
+                    pieces.append(" [cancelled]")
+                    on_delta(" [cancelled]")
+                    break
+                # The last chunk may only carry the token usage
+                usage = getattr(chunk, "usage", None)
+                if usage and usage.completion_tokens:
+                    usage_tokens = usage.completion_tokens
+                for part in (chunk.choices[0].delta.tool_calls or []) if chunk.choices else []:
+                    call = calls.setdefault(part.index if part.index is not None else len(calls),
+                                            {"id": "", "name": "", "arguments": ""})
+                    if part.id:
+                        call["id"] = part.id
+                    if part.function:
+                        call["name"] += part.function.name or ""
+                        call["arguments"] += part.function.arguments or ""
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                pieces.append(chunk.choices[0].delta.content)
+                chunks += 1
+                on_delta(chunk.choices[0].delta.content)
+        except Exception as e:
+            if not pieces:
+                raise
+            pieces.append(f"\n[Response interrupted: {str(e)}]")
+            calls = {}
+        return pieces, started, first_token_at, chunks, usage_tokens, [calls[index] for index in sorted(calls)]
+
+    try:
+        pieces, started, first_token_at, chunks, usage_tokens, calls = io_layer.run(
+            io_layer.with_retries(stream_once, max_retries, retry_delay, what="AI request"))
+    except OpenAIError as e:
+        print(f"Error occurred: {str(e)}")
+        return completion_error_message(e), None
+    except Exception as e:
+        return f"Unexpected error: {str(e)}", None
+
+    if tool_calls is not None:
+        tool_calls.extend(calls)
+    if first_token_at is None:
+        return "".join(pieces), None
+    # Use the token count reported by the API if there is one; otherwise each
+    # streamed chunk is counted as one token (usually one token per chunk)
+    tokens = usage_tokens or chunks
+    generation_time = time.perf_counter() - first_token_at
+    stats = {
+        "first_token": first_token_at - started,
+        "tokens": tokens,
+        "tokens_per_second": tokens / generation_time if generation_time > 0 else 0.0,
+    }
+    interrupted = cancelled is not None and cancelled.is_set()
+    if use_cache and not interrupted and not calls and not pieces[-1].startswith("\n[Response interrupted"):
+        get_response_cache().put(model, messages, "".join(pieces), cache_key)
+    return "".join(pieces), stats
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in a text without a tokenizer.
+
+    Tokenizers split English into roughly one token per four characters, and
+    give every word and punctuation mark at least one token; the larger of the
+    two counts is used.
+
+    Parameters:
+    - text (str): The text
+
+    Returns:
+    - int: The estimated number of tokens
+    """
+    return max(len(text) // 4, len(re.findall(r"\w+|[^\w\s]", text))) + 1
+
+
+# The tools the AI can call while answering (in the OpenAI tools format). Regions of
+# a page are given as fractions of the page's width and height, from its top-left corner.
+_PAGE_REGION_PARAMETERS = {
+    "type": "object",
+    "properties": {
+        "page": {"type": "integer", "description": "Page number, starting at 1"},
+        "left": {"type": "number", "description": "Left edge, as a fraction (0-1) of the page width"},
+        "top": {"type": "number", "description": "Top edge, as a fraction (0-1) of the page height"},
+        "right": {"type": "number", "description": "Right edge, as a fraction (0-1) of the page width"},
+        "bottom": {"type": "number", "description": "Bottom edge, as a fraction (0-1) of the page height"},
+    },
+    "required": ["page", "left", "top", "right", "bottom"],
+}
+AI_TOOLS = [
+    {"type": "function", "function": {
+        "name": "web_search",
+        "description": "Search the web. Returns the top results with excerpts of their pages.",
+        "parameters": {"type": "object", "properties": {"query": {"type": "string", "description": "The search query"}},
+                       "required": ["query"]}}},
+    {"type": "function", "function": {
+        "name": "fetch_page",
+        "description": "Read the text of a web page, e.g. one of the search results.",
+        "parameters": {"type": "object", "properties": {"url": {"type": "string", "description": "The address of the page"}},
+                       "required": ["url"]}}},
+    {"type": "function", "function": {
+        "name": "read_pdf_page",
+        "description": "Read the text of a page of the PDF the user has open.",
+        "parameters": {"type": "object", "properties": {"page": {"type": "integer", "description": "Page number, starting at 1"}},
+                       "required": ["page"]}}},
+    {"type": "function", "function": {
+        "name": "ocr_region",
+        "description": "Read the text in a region of a PDF page with OCR (for scanned pages and figures).",
+        "parameters": _PAGE_REGION_PARAMETERS}},
+    {"type": "function", "function": {
+        "name": "latex_region",
+        "description": "Convert an equation in a region of a PDF page to LaTeX.",
+        "parameters": _PAGE_REGION_PARAMETERS}},
+]
+
+
+def time_left(deadline):
+    """
+    Returns the seconds left until a deadline (a time.monotonic() time), or 0 if it has passed.
+    """
+    return max(0.0, deadline - time.monotonic())
+
+
+def run_tool_calls(calls, handlers, executor, timeout=TOOL_TIMEOUT, result_chars=TOOL_RESULT_CHARS):
+    """
+    Runs the tool calls of one AI response at the same time on the threads of executor.
+
+    The calls of one response don't depend on each other, so a web search and two
+    page reads take as long as the slowest of them. A call that fails, names an
+    unknown tool or is not finished after timeout seconds gets an error message as
+    its result, so the AI can carry on.
+
+    Parameters:
+    - calls (list): The tool calls, as dicts with "id", "name" and "arguments" (a JSON string)
+    - handlers (dict): {tool name: function}; each function is called as
+      function(deadline, **arguments) and returns the result as text. deadline is the
+      time.monotonic() time by which it must return: it waits at most time_left(deadline)
+      for anything, so a call that hangs doesn't keep an executor thread
+    - executor (ThreadPoolExecutor): The long-lived pool that runs the calls
+    - timeout (float): Seconds to wait for all calls
+    - result_chars (int): Longer results are cut off
+
+    Returns:
+    - list: (call, result, seconds) for each call, in the order of calls
+
+    Example:
+    results = run_tool_calls([{"id": "1", "name": "read_pdf_page", "arguments": '{"page": 3}'}],
+                             {"read_pdf_page": read_page}, executor)
+    """
+    def run(call):
+        started = time.perf_counter()
+        try:
+            handler = handlers.get(call["name"])
+            if handler is None:
+                raise ValueError(f"unknown tool '{call['name']}'")
+            arguments = json.loads(call["arguments"] or "{}")
+            if time_left(deadline) <= 0:
+                raise TimeoutError("the tool did not start in time")
+            result = str(handler(deadline, **arguments))
+        except Exception as e:
+            result = f"Error: {type(e).__name__}: {str(e)}"
+        return result, time.perf_counter() - started
+
+    if not calls:
+        return []
+    started = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    futures = [executor.submit(run, call) for call in calls]
+    results = []
+    for call, future in zip(calls, futures):
+        try:
+            result, seconds = future.result(max(0.0, timeout - (time.perf_counter() - started)))
+        except FutureTimeoutError:
+            result, seconds = f"Error: the tool did not finish within {timeout:.0f} seconds", time.perf_counter() - started
+        if len(result) > result_chars:
+            result = result[:result_chars] + "... [truncated]"
+        results.append((call, result, seconds))
+    # (Calls that timed out stop soon after, when their own waits run out)
+    return results
+
+
+class ConversationContext:
+    """
+    Keeps the conversation sent to the AI within a token budget.
+
+    The context sent with each request is made of:
+    - the system prompt
+    - pinned document excerpts (highlights and PDF content the user sent)
+    - a summary of the older part of the conversation
+    - the most recent turns, word for word
+
+    When the recent turns use more than three quarters of the budget, the oldest
+    ones are compacted: a summary is generated on a background thread and replaces
+    them when it is ready. Document excerpts in compacted turns are pinned instead of
+    summarised, so they are never lost (up to a third of the budget; beyond that the
+    oldest excerpts are dropped). Until a summary is ready, the oldest turns are left
+    out of the request if needed, so a request never goes over the budget.
+
+    All methods may be called from any thread.
+
+    Example:
+    conversation = ConversationContext("You are a helpful study assistant.")
+    conversation.add("user", "Analyze this: ...", excerpt="Highlighted text: ...")
+    response = completion(conversation.build_messages())
+    conversation.add("assistant", response)
+    """
+    def __init__(self, system_prompt, budget_tokens=CONTEXT_BUDGET_TOKENS):
+        self.system_prompt = system_prompt
+        self.budget_tokens = budget_tokens
+        self.turns = []  # (dicts with role, content, tokens and excerpt, oldest first)
+        self.pinned = []  # ((excerpt, tokens), oldest first)
+        self.summary = ""
+        self.compacting = False
+        self.lock = threading.Lock()
+
+    def budget(self):
+        """
+        Returns the token budget, limited by the model's context length (which is
+        known once the model catalog has been loaded).
+        """
+        return max(1024, min(self.budget_tokens, max_tokens - CONTEXT_RESPONSE_RESERVE))
+
+    def add(self, role, content, excerpt=None):
+        """
+        Adds a turn to the conversation.
+
+        Parameters:
+        - role (str): "user" or "assistant"
+        - content (str): The message
+        - excerpt (str): Document text in the message that should be pinned, not
+          summarised, when the turn is compacted
+        """
+        with self.lock:
+            self.turns.append({"role": role, "content": content, "tokens": estimate_tokens(content), "excerpt": excerpt})
+        self.maybe_compact()
+
+    def build_messages(self):
+        """
+        Returns the messages to send with the next request, within the budget.
+        """
+        with self.lock:
+            messages = [{"role": "system", "content": self.system_prompt}]
+            if self.pinned:
+                excerpts = "\n\n".join(excerpt for excerpt, _ in self.pinned)
+                messages.append({"role": "system", "content": f"Document excerpts from earlier in the conversation:\n{excerpts}"})
+            if self.summary:
+                messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+            used = sum(estimate_tokens(message["content"]) for message in messages)
+            # Add the most recent turns that fit, newest first
+            recent = []
+            for turn in reversed(self.turns):
+                if recent and used + turn["tokens"] > self.budget():
+                    break
+                recent.append({"role": turn["role"], "content": turn["content"]})
+                used += turn["tokens"]
+            dropped = len(self.turns) - len(recent)
+        if dropped:
+            # (Rare: normally only until a summary of them is ready, see maybe_compact)
+            print(f"Context: {dropped} older turns left out until they are summarised")
+        return messages + list(reversed(recent))
+
+    def maybe_compact(self):
+        """
+        Starts compacting the oldest turns on a background thread if the recent
+        turns use more than three quarters of the budget.
+        """
+        with self.lock:
+            if self.compacting or sum(turn["tokens"] for turn in self.turns) <= self.budget() * 3 // 4:
+                return
+            # Compact the oldest turns until the rest fits in half of the budget,
+            # always keeping the last four turns (two exchanges) word for word
+            remaining = sum(turn["tokens"] for turn in self.turns)
+            count = 0
+            while count < len(self.turns) - 4 and remaining > self.budget() // 2:
+                remaining -= self.turns[count]["tokens"]
+                count += 1
+            if count == 0:
+                return
+            self.compacting = True
+            old_turns = self.turns[:count]
+            summary = self.summary
+        threading.Thread(target=self.compact, args=(old_turns, summary), daemon=True).start()
+
+    def compact(self, old_turns, summary):
+        # Runs on a background thread: summarise the old turns with the AI model
+        started = time.perf_counter()
+        transcript = "\n\n".join(f"{turn['role']}: {turn['content']}" for turn in old_turns)
+        prompt = ("Summarize this conversation between a student and a study assistant in a few short paragraphs. "
+                  "Keep the questions asked, the answers and conclusions, and any facts, formulas or sources that "
+                  "may be referred to later.\n\n")
+        if summary:
+            prompt += f"Summary of the conversation before this part:\n{summary}\n\n"
+        response = completion([{"role": "user", "content": prompt + "Conversation:\n" + transcript}])
+        with self.lock:
+            self.compacting = False
+            if is_completion_error(response):
+                print(f"Context: compaction failed: {response}")
+                return
+            # The compacted turns are the first ones, as turns are only ever appended
+            del self.turns[:len(old_turns)]
+            self.summary = response
+            for turn in old_turns:
+                if turn["excerpt"]:
+                    self.pinned.append((turn["excerpt"], estimate_tokens(turn["excerpt"])))
+            # Keep the pinned excerpts within a third of the budget
+            while len(self.pinned) > 1 and sum(tokens for _, tokens in self.pinned) > self.budget() // 3:
+                self.pinned.pop(0)
+            before = sum(turn["tokens"] for turn in old_turns)
+        print(f"Context: compacted {len(old_turns)} turns ({before} tokens) into a summary of about "
+              f"{estimate_tokens(response)} tokens in {time.perf_counter() - started:.1f}s")
+        self.maybe_compact()
+
+
+class ChatStream:
+    """
+    State of an AI answer that is being streamed into the chat history: the text
+    mark where it is inserted, the pieces received on the AI thread and not drawn
+    yet, text held back (an unfinished equation) and whether any piece arrived.
+    """
+    def __init__(self, mark):
+        self.mark = mark
+        self.lock = threading.Lock()
+        self.received = False
+        self.pending = []
+        self.tail = ""
+        self.flush_scheduled = False
+        self.active = False
+
+
+class AITask:
+    """
+    A unit of work for the AI scheduler, like answering a chat message.
+
+    Parameters:
+    - kind (str): The type of task, e.g. "message", "highlight" or "pdf"
+    - content: The task's input (for example the user's message)
+    - priority (int): PRIORITY_INTERACTIVE, PRIORITY_HIGHLIGHT or PRIORITY_BACKGROUND
+    - run (function): Called as run(task) on a scheduler thread; it should check
+      task.cancelled regularly and stop early when it is set
+    - label (str): A short description shown in the UI
+    - owner (object): The job that created the task, so its tasks can be cancelled together
+    - serial (str): Tasks with the same serial key run one at a time, in the order they
+      were submitted (e.g. "conversation" for tasks that add turns to the conversation)
+    """
+    ids = itertools.count(1)
+
+    def __init__(self, kind, content, priority, run, label="", owner=None, serial=None):
+        self.id = next(self.ids)
+        self.kind = kind
+        self.content = content
+        self.priority = priority
+        self.run = run
+        self.label = label or kind
+        self.owner = owner
+        self.serial = serial
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+
+
+class AIScheduler:
+    """
+    Runs AI tasks on a fixed number of worker threads, highest priority first.
+
+    Interactive chat runs before highlight analysis, which runs before background
+    document jobs (tasks of the same priority run in the order they were submitted).
+    At most `concurrency` tasks run at the same time, so a slow request doesn't hold
+    up a quick follow-up question. Tasks with the same serial key (see AITask) never
+    run at the same time: a task waits while an earlier one of its key is running or
+    queued, and other tasks run first. At most `background_concurrency` background
+    tasks run at the same time, so the other threads are free for chat and highlights
+    (running tasks are never interrupted). Queued tasks can be cancelled before they
+    start, and running tasks are asked to stop (see AITask).
+
+    on_change() is called from any thread whenever tasks are queued, started or
+    finished, so a readout can be updated.
+
+    Example:
+    scheduler = AIScheduler(concurrency=2)
+    task = AITask("message", "What is entropy?", PRIORITY_INTERACTIVE, answer)
+    scheduler.submit(task)
+    scheduler.cancel(task)
+    """
+    def __init__(self, concurrency=AI_CONCURRENCY, background_concurrency=AI_BACKGROUND_CONCURRENCY, on_change=None):
+        self.on_change = on_change or (lambda: None)
+        self.background_concurrency = max(1, background_concurrency)
+        self.queue = []  # (heap of (priority, sequence number, task))
+        self.sequence = itertools.count()
+        self.running = []
+        self.recent_waits = []  # (seconds queued of the last tasks that started)
+        self.condition = threading.Condition()
+        for _ in range(max(1, concurrency)):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, task):
+        with self.condition:
+            heapq.heappush(self.queue, (task.priority, next(self.sequence), task))
+            self.condition.notify()
+        self.on_change()
+        return task
+
+    def cancel(self, task):
+        """
+        Cancels a task: it is removed from the queue, or asked to stop if it is running.
+        """
+        task.cancelled.set()
+        with self.condition:
+            queued = [entry for entry in self.queue if entry[2] is not task]
+            if len(queued) != len(self.queue):
+                self.queue = queued
+                heapq.heapify(self.queue)
+                task.done.set()
+                # A task that waited behind this one (see next_task) may start now
+                self.condition.notify_all()
+        self.on_change()
+
+    def cancel_owner(self, owner):
+        """
+        Cancels all queued and running tasks of an owner.
+        """
+        for task in self.tasks():
+            if task.owner is owner:
+                self.cancel(task)
+
+    def tasks(self):
+        """
+        Returns the running tasks followed by the queued ones, in the order they will run.
+        """
+        with self.condition:
+            return list(self.running) + [entry[2] for entry in sorted(self.queue)]
+
+    def stats(self):
+        """
+        Returns a readout of the scheduler: the number of running tasks, the number of
+        queued tasks per priority name, the longest current wait and the average wait
+        of recently started tasks (in seconds).
+        """
+        now = time.perf_counter()
+        with self.condition:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for _, _, task in self.queue:
+                queued[PRIORITY_NAMES[task.priority]] += 1
+            longest_wait = max((now - task.submitted_at for _, _, task in self.queue), default=0.0)
+            average_wait = statistics.mean(self.recent_waits) if self.recent_waits else 0.0
+            return {"running": len(self.running), "queued": queued, "longest_wait": longest_wait, "average_wait": average_wait}
+
+    def next_task(self):
+        """
+        Removes and returns the most urgent queued task that may start now, or None.
+        A task may not start while an earlier task with its serial key is running or
+        queued, and a background task may not start while background_concurrency of
+        them are running. Called with the condition held.
+        """
+        busy = {task.serial for task in self.running}
+        background = sum(task.priority == PRIORITY_BACKGROUND for task in self.running)
+        for entry in sorted(self.queue):
+            task = entry[2]
+            if task.priority == PRIORITY_BACKGROUND and background >= self.background_concurrency:
+                continue
+            if task.serial is not None:
+                if task.serial in busy or any(other.serial == task.serial and other_sequence < entry[1]
+                                              for _, other_sequence, other in self.queue):
+                    continue
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            return task
+        return None
+
+    def worker(self):
+        # Runs on each worker thread: take the most urgent task that may start and run it
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None:
+                    self.condition.wait()
+                    task = self.next_task()
+                task.started_at = time.perf_counter()
+                self.recent_waits = (self.recent_waits + [task.started_at - task.submitted_at])[-20:]
+                self.running.append(task)
+            self.on_change()
+            try:
+                task.run(task)
+            except Exception as e:
+                print(f"Error in AI task '{task.label}': {str(e)}")
+            finally:
+                with self.condition:
+                    self.running.remove(task)
+                    # Tasks that waited for this one (see next_task) may start now
+                    self.condition.notify_all()
+                task.done.set()
+                self.on_change()
+
+
+class SummaryCache:
+    """
+    An on-disk cache of document summaries, stored in SQLite.
+
+    Entries are keyed on (document fingerprint, key), where the key names the part
+    of the document, like "section:12-15:<hash of its text>", "chapter:0-40" or "book".
+
+    The cache may be used from several threads; close() it when it is no longer needed.
+    """
+    def __init__(self, db_path=SUMMARY_CACHE_PATH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS summaries (fingerprint TEXT, key TEXT, text TEXT, PRIMARY KEY (fingerprint, key))")
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def get(self, fingerprint, key):
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM summaries WHERE fingerprint = ? AND key = ?", (fingerprint, key)).fetchone()
+        return row[0] if row else None
+
+    def put(self, fingerprint, key, text):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)", (fingerprint, key, text))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class DocumentSummaryJob:
+    """
+    Summarises a whole document in the background with a map-reduce over AI requests.
+
+    1. Map: the document is split into sections of about SUMMARY_SECTION_TOKENS
+       tokens (on page boundaries, where possible), and the sections are summarised
+       concurrently, with at most `concurrency` requests running at the same time.
+    2. Reduce: the section summaries of every chapter (from the PDF's table of
+       contents, or groups of pages if it has none) are combined into a chapter
+       summary, and the chapter summaries into a summary of the whole document.
+       Summaries that don't fit in one request are combined in groups first.
+
+    Every summary is cached on disk, so a finished document is summarised instantly
+    the next time, and an interrupted job continues where it stopped.
+
+    on_progress(kind, text) is called from the job's threads with ("status", message),
+    ("chapter", summary), ("done", summary) or ("error", message).
+
+    Example:
+    job = DocumentSummaryJob(fingerprint, pages, toc, on_progress=print)
+    job.start()
+    """
+    def __init__(self, fingerprint, pages, toc=None, on_progress=None, concurrency=SUMMARY_CONCURRENCY, retries=SUMMARY_RETRIES,
+                 complete=completion):
+        self.fingerprint = fingerprint
+        self.complete = complete  # (called like completion(messages, max_retries=...) for every request)
+        self.pages = pages  # ((page number, text) tuples)
+        self.toc = toc or []  # ((level, title, 1-based page) entries, as from fitz's get_toc)
+        self.on_progress = on_progress or (lambda kind, text: None)
+        self.concurrency = max(1, concurrency)
+        self.retries = max(1, retries)
+        self.cancelled = threading.Event()
+        self.executor = None
+        self.cache = None  # (the SummaryCache, opened when the job runs)
+        # Limits the number of AI requests running at the same time
+        self.request_slots = threading.Semaphore(self.concurrency)
+        self.requests = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def cancel(self):
+        """
+        Stops the job; requests that are already running finish and are cached.
+        """
+        self.cancelled.set()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def chapter_starts(self):
+        """
+        Returns the chapters of the table of contents as (first page, title) tuples,
+        or an empty list if the document has no usable table of contents.
+        """
+        starts = sorted({(page - 1, title) for level, title, page in self.toc if level == 1 and page >= 1})
+        return starts if len(starts) >= 2 else []
+
+    def split_sections(self):
+        """
+        Returns the sections of the document as (first page, last page, text) tuples.
+        A section never crosses the start of a chapter.
+        """
+        sections = []
+        chapter_pages = {page for page, _ in self.chapter_starts()}
+        first, texts, tokens = None, [], 0
+        for page_num, text in self.pages:
+            if page_num in chapter_pages and texts:
+                sections.append((first, last, "\n\n".join(texts)))
+                first, texts, tokens = None, [], 0
+            # Split pages that are larger than a section on their own
+            words = text.split()
+            step = max(1, len(words) * SUMMARY_SECTION_TOKENS // max(1, estimate_tokens(text)))
+            for start in range(0, max(1, len(words)), step):
+                part = " ".join(words[start:start + step])
+                part_tokens = estimate_tokens(part)
+                if texts and tokens + part_tokens > SUMMARY_SECTION_TOKENS:
+                    sections.append((first, last, "\n\n".join(texts)))
+                    first, texts, tokens = None, [], 0
+                if first is None:
+                    first = page_num
+                last = page_num
+                texts.append(f"[Page {page_num + 1}] {part}")
+                tokens += part_tokens
+        if texts:
+            sections.append((first, last, "\n\n".join(texts)))
+        return sections
+
+    def chapters(self, sections):
+        """
+        Groups the sections into chapters: (title, first page, last page, sections).
+        """
+        starts = self.chapter_starts()
+        if not starts:
+            # No usable table of contents: use groups of eight sections
+            return [(f"Pages {group[0][0] + 1}-{group[-1][1] + 1}", group[0][0], group[-1][1], group)
+                    for group in (sections[i:i + 8] for i in range(0, len(sections), 8))]
+        chapters = []
+        for section in sections:
+            # The chapter of a section is the last one that starts on or before its first page
+            index = max(0, bisect.bisect_right([page for page, _ in starts], section[0]) - 1)
+            title = starts[index][1]
+            if chapters and chapters[-1][0] == title:
+                chapters[-1][3].append(section)
+            else:
+                chapters.append((title, section[0], section[1], [section]))
+        return [(title, first, group[-1][1], group) for title, first, _, group in chapters]
+
+    def summarize(self, cache_key, instructions, text):
+        """
+        Summarises a text with one AI request (or returns the cached summary).
+        Runs on the pool threads, which share the job's cache connection.
+
+        Raises:
+        - RuntimeError: If the job was cancelled or the request failed after all retries
+        """
+        cached = self.cache.get(self.fingerprint, cache_key)
+        if cached is not None:
+            return cached
+        if self.cancelled.is_set():
+            raise RuntimeError("Summary cancelled")
+        with self.request_slots:
+            self.requests += 1
+            response = self.complete([{"role": "user", "content": f"{instructions}\n\n{text}"}], max_retries=self.retries)
+        if is_completion_error(response):
+            raise RuntimeError(response)
+        self.cache.put(self.fingerprint, cache_key, response)
+        return response
+
+    def reduce(self, cache_key, instructions, summaries):
+        """
+        Combines summaries into one. If they don't fit in one request, groups of them
+        are combined first (concurrently), and so on until one summary is left.
+        """
+        level = 0
+        while True:
+            groups, group, tokens = [], [], 0
+            for summary in summaries:
+                summary_tokens = estimate_tokens(summary)
+                if group and tokens + summary_tokens > 2 * SUMMARY_SECTION_TOKENS:
+                    groups.append(group)
+                    group, tokens = [], 0
+                group.append(summary)
+                tokens += summary_tokens
+            groups.append(group)
+            if len(groups) == 1:
+                return self.summarize(cache_key, instructions, "\n\n".join(groups[0]))
+            futures = [self.executor.submit(self.summarize, f"{cache_key}:level{level}:{i}", instructions, "\n\n".join(group))
+                       for i, group in enumerate(groups)]
+            summaries = [future.result() for future in futures]
+            level += 1
+
+    def run(self):
+        # One cache connection is shared by all of the job's threads, and closed when it
+        # ends (after the requests still running have finished and been cached)
+        self.cache = SummaryCache()
+        try:
+            self.summarize_document()
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=True)
+            self.cache.close()
+
+    def summarize_document(self):
+        started = time.perf_counter()
+        cached = self.cache.get(self.fingerprint, "book")
+        if cached is not None:
+            self.on_progress("done", cached)
+            return
+        sections = self.split_sections()
+        if not sections:
+            self.on_progress("error", "The document has no text to summarise.")
+            return
+        chapters = self.chapters(sections)
+        self.on_progress("status", f"Summarising {len(sections)} sections in {len(chapters)} parts "
+                                   f"({self.concurrency} requests at a time)...")
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            # Map: summarise all sections concurrently
+            section_instructions = ("Summarize this part of a document in one or two paragraphs. Keep the key ideas, "
+                                    "definitions, results and formulas, and mention the page numbers.")
+            futures = {}
+            for first, last, text in sections:
+                key = f"section:{first}-{last}:{hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]}"
+                futures[self.executor.submit(self.summarize, key, section_instructions, text)] = (first, last)
+            section_summaries = {}
+            for done, future in enumerate(as_completed(futures), 1):
+                first, last = futures[future]
+                section_summaries[first, last] = f"[Pages {first + 1}-{last + 1}] {future.result()}"
+                if done % max(1, len(sections) // 4) == 0 or done == len(sections):
+                    self.on_progress("status", f"Summarised {done}/{len(sections)} sections...")
+
+            # Reduce: all chapters concurrently, then the whole document. The chapters run
+            # on their own threads, which submit their group requests to the pool
+            # (request_slots keeps the total number of requests within the limit)
+            chapter_instructions = ("Combine these summaries of consecutive parts of a chapter into one summary "
+                                    "of the chapter, in a few paragraphs. Keep page references.")
+
+            def reduce_chapter(chapter):
+                title, first, last, group = chapter
+                summary = self.reduce(f"chapter:{first}-{last}", chapter_instructions,
+                                      [section_summaries[section[0], section[1]] for section in group])
+                summary = f"{title} (pages {first + 1}-{last + 1}): {summary}"
+                self.on_progress("chapter", summary)
+                return summary
+
+            with ThreadPoolExecutor(max_workers=self.concurrency) as chapter_pool:
+                chapter_summaries = list(chapter_pool.map(reduce_chapter, chapters))
+            book_instructions = ("Combine these chapter summaries into a summary of the whole document: start with "
+                                 "a short overview, then the main ideas chapter by chapter.")
+            book = chapter_summaries[0] if len(chapter_summaries) == 1 else self.reduce("book", book_instructions, chapter_summaries)
+            self.cache.put(self.fingerprint, "book", book)
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.on_progress("error", f"Summary failed: {str(e)}")
+            return
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        print(f"Summary: {len(sections)} sections, {len(chapters)} chapters, {self.requests} requests "
+              f"in {time.perf_counter() - started:.1f}s")
+        self.on_progress("done", book)
+
+
+class PageRenderCache:
+    """
+    A memory-bounded cache of rendered pages with LRU (least recently used) eviction.
+
+    Entries are keyed on (page number, scale) so a page rendered at one zoom level is
+    never served for another. The size of each entry is the size of the pixmap it was
+    made from (width * height * channels). When the total size goes over the budget,
+    the least recently used entries are evicted.
+
+    Example:
+    cache = PageRenderCache(max_bytes=256 * 1024 * 1024)
+    cache.put((0, 2), photo, pix.width * pix.height * pix.n)
+    photo = cache.get((0, 2))  # None if the page is not cached
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (key -> (image, size in bytes), oldest first)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the cached image for a key and marks it as recently used.
+
+        Parameters:
+        - key (tuple): The cache key, e.g. (page number, scale)
+
+        Returns:
+        - The cached image, or None if the key is not in the cache
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, image, nbytes):
+        """
+        Adds an image to the cache, evicting least recently used entries if needed.
+
+        Parameters:
+        - key (tuple): The cache key, e.g. (page number, scale)
+        - image: The rendered image (for example an ImageTk.PhotoImage)
+        - nbytes (int): The size of the image in bytes
+        """
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (image, nbytes)
+        self.current_bytes += nbytes
+        # Evict the least recently used entries, but always keep the newest one
+        while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_bytes
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all entries (the hit/miss/eviction counters are kept).
+        """
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        """
+        Returns a dictionary with the cache counters and memory usage.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PageContentCache:
+    """
+    A bounded LRU cache of parsed page content for one document.
+
+    Loading a page and calling get_pixmap or get_text re-interprets the page's content
+    stream every time, which is slow for heavy vector pages. This cache parses each page
+    once into a fitz.DisplayList and, when text is needed, a fitz.TextPage, and reuses them
+    for every rendering (any scale or clip region) and text extraction of that page.
+
+    Each document handle needs its own cache (PyMuPDF objects must not be shared
+    between threads or processes).
+
+    Example:
+    content = PageContentCache(doc, max_pages=16)
+    pix = content.get_pixmap(0, 2)
+    words = content.get_words(0, clip=fitz.Rect(0, 0, 100, 100))
+    """
+    # Same flags as page.get_text uses by default
+    TEXT_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+    def __init__(self, doc, max_pages=PAGE_CONTENT_CACHE_PAGES):
+        self.doc = doc
+        self.max_pages = max_pages
+        self.entries = OrderedDict()  # (page number -> {"display_list": ..., "text_page": ...})
+
+    def _entry(self, page_num):
+        entry = self.entries.get(page_num)
+        if entry is None:
+            entry = {"display_list": self.doc[page_num].get_displaylist(), "text_page": None}
+            self.entries[page_num] = entry
+            while len(self.entries) > self.max_pages:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(page_num)
+        return entry
+
+    def display_list(self, page_num):
+        """
+        Returns the parsed display list of a page.
+        """
+        return self._entry(page_num)["display_list"]
+
+    def text_page(self, page_num):
+        """
+        Returns the text page of a page, created from its display list on first use.
+        """
+        entry = self._entry(page_num)
+        if entry["text_page"] is None:
+            entry["text_page"] = entry["display_list"].get_textpage(flags=self.TEXT_FLAGS)
+        return entry["text_page"]
+
+    def get_pixmap(self, page_num, scale, clip=None):
+        """
+        Renders a page (or a region of it) from its display list.
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        - scale (float): The zoom factor
+        - clip (fitz.Rect or None): Optional region of the page in PDF coordinates
+
+        Returns:
+        - fitz.Pixmap: The rendered RGB pixmap
+        """
+        return self.display_list(page_num).get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip, alpha=False)
+
+    def get_words(self, page_num, clip=None):
+        """
+        Returns the words of a page, like page.get_text("words").
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        - clip (fitz.Rect or None): If given, only words that intersect this rectangle are returned
+
+        Returns:
+        - list: (x0, y0, x1, y1, word, block_no, line_no, word_no) tuples
+        """
+        words = self.text_page(page_num).extractWORDS()
+        if clip is not None:
+            clip = fitz.Rect(clip)
+            words = [w for w in words if fitz.Rect(w[:4]).intersects(clip)]
+        return words
+
+    def get_text(self, page_num):
+        """
+        Returns the plain text of a page, like page.get_text("text").
+        """
+        return self.text_page(page_num).extractText()
+
+
+class PageWordIndex:
+    """
+    The words of one page with their bounding boxes, stored in compact NumPy arrays
+    with a uniform grid spatial index.
+
+    The page is divided into square cells of CELL_SIZE points, and every cell lists
+    the words that overlap it. Finding the words in a rectangle only looks at the
+    words in the cells the rectangle covers, so selections are answered without
+    extracting any text from the PDF.
+
+    Parameters:
+    - words (list): Word tuples as returned by page.get_text("words")
+    - page_rect (tuple): The page rectangle (x0, y0, x1, y1) in PDF coordinates
+
+    Example:
+    index = PageWordIndex(page.get_text("words"), tuple(page.rect))
+    ids = index.query(fitz.Rect(50, 50, 300, 120))
+    print(index.text(ids))
+    """
+    CELL_SIZE = 32  # (grid cell size in PDF points)
+
+    def __init__(self, words, page_rect):
+        count = len(words)
+        # Word geometry and line membership as arrays (one row per word, in reading order)
+        self.boxes = np.array([w[:4] for w in words], dtype=np.float32).reshape(count, 4)
+        self.line_ids = np.array([(w[5], w[6]) for w in words], dtype=np.int32).reshape(count, 2)
+        # All word strings concatenated into one string, with the start offset of each word
+        strings = [w[4] for w in words]
+        self.chars = "".join(strings)
+        self.offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum([len(word) for word in strings], out=self.offsets[1:])
+        self.line_count = len(np.unique(self.line_ids, axis=0)) if count else 0
+        # The lowercase search tokens of the words (a word like "entropy," or "Carnot's" has
+        # one or more), with the id of the word each came from, for highlighting search hits
+        tokens = [(word_id, token) for word_id, word in enumerate(strings) for token in re.findall(r"\w+", word.lower())]
+        self.tokens = np.array([token for _, token in tokens], dtype=str)
+        self.token_words = np.array([word_id for word_id, _ in tokens], dtype=np.int64)
+
+        # Build the grid: for every cell (row-major), the ids of the words overlapping it
+        self.origin_x, self.origin_y = page_rect[0], page_rect[1]
+        self.cols = max(1, int(np.ceil((page_rect[2] - page_rect[0]) / self.CELL_SIZE)))
+        self.rows = max(1, int(np.ceil((page_rect[3] - page_rect[1]) / self.CELL_SIZE)))
+        col0, row0 = self._cell(self.boxes[:, 0], self.boxes[:, 1])
+        col1, row1 = self._cell(self.boxes[:, 2], self.boxes[:, 3])
+        span_x = col1 - col0 + 1
+        cells_per_word = span_x * (row1 - row0 + 1)
+        word_ids = np.repeat(np.arange(count), cells_per_word)
+        # Position of each (word, cell) pair within its word's block of cells
+        local = np.arange(cells_per_word.sum()) - np.repeat(np.cumsum(cells_per_word) - cells_per_word, cells_per_word)
+        cell_cols = np.repeat(col0, cells_per_word) + local % np.repeat(span_x, cells_per_word)
+        cell_rows = np.repeat(row0, cells_per_word) + local // np.repeat(span_x, cells_per_word)
+        cells = cell_rows * self.cols + cell_cols
+        order = np.argsort(cells, kind="stable")
+        self.cell_words = word_ids[order]
+        # cell_start[c]:cell_start[c + 1] is the slice of cell_words for cell c
+        self.cell_start = np.searchsorted(cells[order], np.arange(self.cols * self.rows + 1))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _cell(self, x, y):
+        # Converts PDF coordinates to (column, row) grid cells, clamped to the grid
+        col = np.clip(np.floor((np.asarray(x) - self.origin_x) / self.CELL_SIZE), 0, self.cols - 1).astype(np.int64)
+        row = np.clip(np.floor((np.asarray(y) - self.origin_y) / self.CELL_SIZE), 0, self.rows - 1).astype(np.int64)
+        return col, row
+
+    def word(self, word_id):
+        """
+        Returns the text of one word.
+        """
+        return self.chars[self.offsets[word_id]:self.offsets[word_id + 1]]
+
+    def match(self, terms, prefix=None):
+        """
+        Returns the ids of the words that contain one of the search terms, in reading order.
+
+        Parameters:
+        - terms (list): Lowercase terms that must match a whole token
+        - prefix (str or None): A lowercase term that may also match the start of a token
+
+        Returns:
+        - numpy.ndarray: The word ids
+        """
+        hit = np.isin(self.tokens, terms)
+        if prefix:
+            hit |= np.char.startswith(self.tokens, prefix)
+        return np.unique(self.token_words[hit])
+
+    def query(self, rect):
+        """
+        Returns the ids of the words that intersect a rectangle, in reading order.
+
+        Parameters:
+        - rect (fitz.Rect or tuple): The rectangle (x0, y0, x1, y1) in PDF coordinates
+
+        Returns:
+        - numpy.ndarray: The word ids
+        """
+        x0, y0, x1, y1 = rect
+        if not len(self) or x1 <= x0 or y1 <= y0:
+            return np.zeros(0, dtype=np.int64)
+        col0, row0 = self._cell(x0, y0)
+        col1, row1 = self._cell(x1, y1)
+        # The cells of one grid row are contiguous, so each row is a single slice
+        parts = [self.cell_words[self.cell_start[row * self.cols + col0]:self.cell_start[row * self.cols + col1 + 1]]
+                 for row in range(row0, row1 + 1)]
+        candidates = np.unique(np.concatenate(parts))
+        boxes = self.boxes[candidates]
+        hit = (boxes[:, 0] < x1) & (boxes[:, 2] > x0) & (boxes[:, 1] < y1) & (boxes[:, 3] > y0)
+        return candidates[hit]
+
+    def text(self, word_ids):
+        """
+        Returns the text of a set of words, with words on the same line separated
+        by spaces and lines separated by newlines.
+
+        Parameters:
+        - word_ids (numpy.ndarray): Word ids in reading order
+        """
+        parts = []
+        previous_line = None
+        for word_id in word_ids:
+            line = tuple(self.line_ids[word_id])
+            if previous_line is not None:
+                parts.append(" " if line == previous_line else "\n")
+            parts.append(self.word(word_id))
+            previous_line = line
+        return "".join(parts)
+
+    def bbox(self, word_ids):
+        """
+        Returns the bounding box (x0, y0, x1, y1) around a set of words, or None if
+        the set is empty. Used to snap selections to word boundaries.
+        """
+        if not len(word_ids):
+            return None
+        boxes = self.boxes[word_ids]
+        return (float(boxes[:, 0].min()), float(boxes[:, 1].min()), float(boxes[:, 2].max()), float(boxes[:, 3].max()))
+
+
+def document_fingerprint(file_path, chunk_size=1 << 20):
+    """
+    Returns a fingerprint of a PDF file, used to key on-disk caches per document.
+
+    The fingerprint is the SHA-256 hash of the file contents, so it stays the same
+    when the file is renamed or moved and changes when the file is modified.
+
+    Parameters:
+    - file_path (str): The path to the PDF file
+    - chunk_size (int): Number of bytes read at a time
+
+    Returns:
+    - str: The hexadecimal fingerprint
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DocumentSearchIndex:
+    """
+    An on-disk full-text search index of PDF pages, using SQLite FTS5.
+
+    Every page of every indexed document is stored in one FTS5 table together with
+    the document fingerprint, so reopening a PDF reuses its index. Results are
+    ranked with FTS5's built-in BM25 ranking.
+
+    A connection must only be used by the thread that created the object.
+
+    Example:
+    index = DocumentSearchIndex()
+    for page_num, score, snippet in index.search(fingerprint, "heat equation"):
+        print(page_num + 1, snippet)
+    """
+    def __init__(self, db_path=SEARCH_INDEX_PATH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        # WAL mode lets the UI search while the background indexer is writing
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS documents (fingerprint TEXT PRIMARY KEY, page_count INTEGER, complete INTEGER)")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(text, fingerprint UNINDEXED, page UNINDEXED, tokenize='unicode61')")
+        self.conn.commit()
+
+    def is_complete(self, fingerprint):
+        """
+        Returns True if all pages of the document have been indexed.
+        """
+        row = self.conn.execute("SELECT complete FROM documents WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        return bool(row and row[0])
+
+    def reset(self, fingerprint, page_count):
+        """
+        Removes any (partial) index of a document before indexing it again.
+        """
+        self.conn.execute("DELETE FROM pages WHERE fingerprint = ?", (fingerprint,))
+        self.conn.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, 0)", (fingerprint, page_count))
+        self.conn.commit()
+
+    def add_pages(self, fingerprint, pages):
+        """
+        Adds pages to the index.
+
+        Parameters:
+        - fingerprint (str): The document fingerprint
+        - pages (list): (page number, text) tuples
+        """
+        self.conn.executemany("INSERT INTO pages (text, fingerprint, page) VALUES (?, ?, ?)",
+                              [(text, fingerprint, page_num) for page_num, text in pages])
+        self.conn.commit()
+
+    def mark_complete(self, fingerprint):
+        self.conn.execute("UPDATE documents SET complete = 1 WHERE fingerprint = ?", (fingerprint,))
+        self.conn.commit()
+
+    @staticmethod
+    def match_expression(query):
+        """
+        Converts a user query to an FTS5 MATCH expression: every word must appear,
+        and the last word may be a prefix (so results show up while typing).
+        Returns None if the query has no words.
+        """
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return None
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += "*"
+        return " ".join(quoted)
+
+    def search(self, fingerprint, query, limit=100):
+        """
+        Searches the pages of a document.
+
+        Parameters:
+        - fingerprint (str): The document fingerprint
+        - query (str): The search query
+        - limit (int): Maximum number of results
+
+        Returns:
+        - list: (page number, score, snippet) tuples, best match first
+        """
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        return self.conn.execute(
+            "SELECT page, bm25(pages), snippet(pages, 0, '[', ']', '...', 12) FROM pages "
+            "WHERE pages MATCH ? AND fingerprint = ? ORDER BY bm25(pages) LIMIT ?",
+            (expression, fingerprint, limit),
+        ).fetchall()
+
+    def page_texts(self, fingerprint):
+        """
+        Returns the indexed text of every page of a document as (page number, text)
+        tuples, in page order.
+        """
+        return self.conn.execute("SELECT page, text FROM pages WHERE fingerprint = ? ORDER BY page", (fingerprint,)).fetchall()
+
+
+class RetrievalIndex:
+    """
+    A BM25 index of the chunks of one document, used to find the parts of a PDF
+    that are relevant to a question.
+
+    The text of every page (from the full-text search index, so scanned pages are
+    included) is split into overlapping chunks of about RETRIEVAL_CHUNK_WORDS words
+    that never cross a page boundary, so every chunk can be cited by its page.
+
+    The index is a sparse term x chunk matrix stored in compressed sparse column form
+    with NumPy arrays: for term t, postings[term_start[t]:term_start[t + 1]] are the
+    chunks that contain it and weights[...] their precomputed BM25 weights. Scoring a
+    query is then a few array slices and additions. The index is saved to disk per
+    document (see RETRIEVAL_INDEX_DIR) and loaded again when the PDF is reopened.
+
+    Example:
+    index = RetrievalIndex.open(fingerprint)
+    for page_num, score, text in index.search("heat equation boundary conditions"):
+        print(page_num + 1, score, text[:80])
+    """
+    # BM25 parameters: term frequency saturation and document length normalisation
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, fingerprint, vocabulary, term_start, postings, weights, chunk_pages, chunks):
+        self.fingerprint = fingerprint
+        self.vocabulary = vocabulary  # (term -> term id)
+        self.term_start = term_start
+        self.postings = postings
+        self.weights = weights
+        self.chunk_pages = chunk_pages
+        self.chunks = chunks
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"\w+", text.lower())
+
+    @classmethod
+    def build(cls, fingerprint, pages, chunk_words=RETRIEVAL_CHUNK_WORDS):
+        """
+        Builds the index of a document.
+
+        Parameters:
+        - fingerprint (str): The document fingerprint
+        - pages (list): (page number, text) tuples
+        - chunk_words (int): Chunk size in words; consecutive chunks overlap by a fifth
+
+        Returns:
+        - RetrievalIndex: The index
+        """
+        chunks, chunk_pages = [], []
+        step = max(1, chunk_words * 4 // 5)
+        for page_num, text in pages:
+            words = text.split()
+            for start in range(0, max(1, len(words) - chunk_words + step), step):
+                chunk = " ".join(words[start:start + chunk_words])
+                if chunk:
+                    chunks.append(chunk)
+                    chunk_pages.append(page_num)
+
+        # Collect (term id, chunk id, term frequency) triples
+        vocabulary = {}
+        term_ids, chunk_ids, counts, lengths = [], [], [], []
+        for chunk_id, chunk in enumerate(chunks):
+            tokens = cls.tokenize(chunk)
+            lengths.append(len(tokens))
+            frequencies = {}
+            for token in tokens:
+                term_id = vocabulary.setdefault(token, len(vocabulary))
+                frequencies[term_id] = frequencies.get(term_id, 0) + 1
+            term_ids.extend(frequencies)
+            chunk_ids.extend([chunk_id] * len(frequencies))
+            counts.extend(frequencies.values())
+        term_ids = np.array(term_ids, dtype=np.int64)
+        chunk_ids = np.array(chunk_ids, dtype=np.int32)
+        counts = np.array(counts, dtype=np.float32)
+        lengths = np.array(lengths, dtype=np.float32)
+
+        # Sort the triples by term to get the compressed sparse column layout
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, chunk_ids, counts = term_ids[order], chunk_ids[order], counts[order]
+        document_frequency = np.bincount(term_ids, minlength=len(vocabulary))
+        term_start = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequency, out=term_start[1:])
+
+        # Precompute the BM25 weight of every (term, chunk) pair
+        n = max(1, len(chunks))
+        idf = np.log(1 + (n - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        average_length = lengths.mean() if len(lengths) else 1.0
+        length_norm = cls.K1 * (1 - cls.B + cls.B * lengths[chunk_ids] / average_length)
+        weights = idf[term_ids] * counts * (cls.K1 + 1) / (counts + length_norm)
+        return cls(fingerprint, vocabulary, term_start, chunk_ids, weights.astype(np.float32),
+                   np.array(chunk_pages, dtype=np.int32), chunks)
+
+    @staticmethod
+    def path(fingerprint):
+        return os.path.join(RETRIEVAL_INDEX_DIR, f"{fingerprint}.npz")
+
+    def save(self):
+        os.makedirs(RETRIEVAL_INDEX_DIR, exist_ok=True)
+        # The vocabulary and chunks are stored as JSON strings, so loading needs no pickle
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez_compressed(self.path(self.fingerprint), term_start=self.term_start, postings=self.postings,
+                            weights=self.weights, chunk_pages=self.chunk_pages,
+                            vocabulary=np.array(json.dumps(terms)), chunks=np.array(json.dumps(self.chunks)))
+
+    @classmethod
+    def load(cls, fingerprint):
+        with np.load(cls.path(fingerprint)) as data:
+            terms = json.loads(str(data["vocabulary"]))
+            return cls(fingerprint, {term: i for i, term in enumerate(terms)}, data["term_start"], data["postings"],
+                       data["weights"], data["chunk_pages"], json.loads(str(data["chunks"])))
+
+    @classmethod
+    def open(cls, fingerprint, search_db_path=SEARCH_INDEX_PATH):
+        """
+        Loads the index of a document from disk, or builds (and saves) it from the
+        full-text search index.
+
+        Returns:
+        - RetrievalIndex or None: None if the document has not been fully indexed yet
+        """
+        if os.path.exists(cls.path(fingerprint)):
+            try:
+                return cls.load(fingerprint)
+            except Exception as e:
+                print(f"Error loading retrieval index, rebuilding it: {str(e)}")
+        search_index = DocumentSearchIndex(search_db_path)
+        if not search_index.is_complete(fingerprint):
+            return None
+        started = time.perf_counter()
+        index = cls.build(fingerprint, search_index.page_texts(fingerprint))
+        index.save()
+        print(f"Retrieval index: {len(index.chunks)} chunks, {len(index.vocabulary)} terms, "
+              f"built in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return index
+
+    def search(self, query, top_k=RETRIEVAL_TOP_K):
+        """
+        Finds the chunks most relevant to a query.
+
+        Parameters:
+        - query (str): The question or text to match
+        - top_k (int): Maximum number of chunks
+
+        Returns:
+        - list: (page number, score, chunk text) tuples, best match first
+        """
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(self.tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is not None:
+                start, end = self.term_start[term_id], self.term_start[term_id + 1]
+                # (a chunk appears at most once per term, so plain fancy indexing is safe)
+                scores[self.postings[start:end]] += self.weights[start:end]
+        top_k = min(top_k, int(np.count_nonzero(scores)))
+        if top_k == 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(self.chunk_pages[i]), float(scores[i]), self.chunks[i]) for i in best]
+
+
+class OCRCache:
+    """
+    An on-disk cache of OCR results, stored in SQLite.
+
+    Entries are keyed on (document fingerprint, page number, DPI) and hold the page
+    text and its words with bounding boxes in PDF coordinates (in the same format as
+    page.get_text("words"), so they can be used to build a PageWordIndex). When a
+    page has been OCRed at several resolutions, the highest one is returned.
+
+    A connection must only be used by the thread that created the object.
+
+    Example:
+    cache = OCRCache()
+    entry = cache.get(fingerprint, 12)
+    if entry:
+        text, words = entry
+    """
+    def __init__(self, db_path=OCR_CACHE_PATH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ocr_pages (fingerprint TEXT, page INTEGER, dpi INTEGER, text TEXT, words TEXT, "
+                          "PRIMARY KEY (fingerprint, page, dpi))")
+        self.conn.commit()
+
+    def get(self, fingerprint, page_num):
+        """
+        Returns (text, words) for a page, or None if the page has not been OCRed.
+        """
+        row = self.conn.execute("SELECT text, words FROM ocr_pages WHERE fingerprint = ? AND page = ? ORDER BY dpi DESC LIMIT 1",
+                                (fingerprint, page_num)).fetchone()
+        if row is None:
+            return None
+        return row[0], [tuple(word) for word in json.loads(row[1])]
+
+    def cached_pages(self, fingerprint, min_dpi=0):
+        """
+        Returns the set of page numbers of a document that have OCR results at a
+        resolution of at least min_dpi.
+        """
+        rows = self.conn.execute("SELECT DISTINCT page FROM ocr_pages WHERE fingerprint = ? AND dpi >= ?", (fingerprint, min_dpi))
+        return {row[0] for row in rows}
+
+    def put(self, fingerprint, page_num, dpi, text, words):
+        self.conn.execute("INSERT OR REPLACE INTO ocr_pages VALUES (?, ?, ?, ?, ?)",
+                          (fingerprint, page_num, dpi, text, json.dumps(words)))
+        self.conn.commit()
+
+
+def preprocess_for_ocr(pix, source_dpi, target_dpi=OCR_TARGET_DPI, binarize=True, margin=4):
+    """
+    Prepares a rendered region for OCR or LaTeX recognition.
+
+    The stages work directly on the pixmap's samples as a NumPy array (a view, not a
+    copy) and are timed individually:
+    1. grayscale: weighted sum of the R, G and B channels in integer arithmetic
+    2. crop: trims blank (near-white) margins, keeping `margin` pixels around the ink
+    3. rescale: resizes to target_dpi (skipped if target_dpi is None or already close)
+    4. threshold: adaptive binarisation against the local mean in a window of about
+       a tenth of an inch, computed with an integral image; very dark pixels are always
+       ink, so the inside of thick strokes does not turn white (skipped if binarize is False)
+
+    Parameters:
+    - pix (fitz.Pixmap): The rendered region (RGB or grayscale, no alpha)
+    - source_dpi (float): The resolution the pixmap was rendered at
+    - target_dpi (int or None): The resolution to rescale to
+    - binarize (bool): Whether to apply adaptive thresholding
+    - margin (int): Number of blank pixels kept around the cropped content
+
+    Returns:
+    - tuple: (image, (crop_x, crop_y), timings) where image is a grayscale PIL image
+      (None if the region is blank), (crop_x, crop_y) is the position of the cropped
+      area in the source pixmap in pixels, and timings maps stage names to milliseconds
+    """
+    timings = {}
+    started = time.perf_counter()
+    samples = getattr(pix, "samples_mv", None) or pix.samples
+    pixels = np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+    # 1. Grayscale (ITU-R 601 weights scaled to 256)
+    if pix.n >= 3:
+        # (one channel at a time, so no uint16 copy of the whole RGB image is made)
+        weighted = np.multiply(pixels[:, :, 0], 77, dtype=np.uint16)
+        weighted += np.multiply(pixels[:, :, 1], 150, dtype=np.uint16)
+        weighted += np.multiply(pixels[:, :, 2], 29, dtype=np.uint16)
+        gray = (weighted >> 8).astype(np.uint8)
+    else:
+        gray = pixels[:, :, 0]
+    timings["grayscale"] = (time.perf_counter() - started) * 1000
+
+    # 2. Crop blank margins
+    started = time.perf_counter()
+    ink = gray < 250
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if not len(rows):
+        timings["crop"] = (time.perf_counter() - started) * 1000
+        return None, (0, 0), timings
+    top = max(0, rows[0] - margin)
+    bottom = min(gray.shape[0], rows[-1] + 1 + margin)
+    left = max(0, cols[0] - margin)
+    right = min(gray.shape[1], cols[-1] + 1 + margin)
+    gray = gray[top:bottom, left:right]
+    timings["crop"] = (time.perf_counter() - started) * 1000
+
+    # 3. Rescale to the target resolution
+    started = time.perf_counter()
+    dpi = source_dpi
+    if target_dpi and abs(target_dpi / source_dpi - 1) > 0.05:
+        factor = target_dpi / source_dpi
+        size = (max(1, round(gray.shape[1] * factor)), max(1, round(gray.shape[0] * factor)))
+        gray = np.asarray(Image.fromarray(gray).resize(size, Image.BILINEAR))
+        dpi = target_dpi
+    timings["rescale"] = (time.perf_counter() - started) * 1000
+
+    # 4. Adaptive threshold: a pixel is ink if it is darker than the mean of its window minus a constant
+    if binarize:
+        started = time.perf_counter()
+        radius = max(1, int(dpi / 20))
+        size = 2 * radius + 1
+        height, width = gray.shape
+        # The integral image is kept in uint32 and may wrap around on large pages; the
+        # window sums are differences of it, which are still exact since they are small.
+        # It is padded by radius on every side with copies of its edge values, which clips
+        # the windows at the image border, so every window sum is a difference of four
+        # shifted slices (no index arrays needed).
+        integral = np.zeros((height + 1 + 2 * radius, width + 1 + 2 * radius), dtype=np.uint32)
+        inner = integral[radius + 1:radius + 1 + height, radius + 1:radius + 1 + width]
+        gray.cumsum(axis=0, dtype=np.uint32, out=inner)
+        inner.cumsum(axis=1, dtype=np.uint32, out=inner)
+        integral[radius + 1:radius + 1 + height, radius + 1 + width:] = inner[:, -1:]
+        integral[radius + 1 + height:] = integral[radius + height]
+        rows = np.arange(height)
+        cols = np.arange(width)
+        window_rows = (np.minimum(rows + radius + 1, height) - np.maximum(rows - radius, 0)).astype(np.int32)
+        window_cols = (np.minimum(cols + radius + 1, width) - np.maximum(cols - radius, 0)).astype(np.int32)
+        result = np.empty_like(gray)
+        # Work in strips of rows, so the temporary arrays stay small
+        strip = 256
+        for y in range(0, height, strip):
+            end = min(height, y + strip)
+            window_sum = (integral[y + size:end + size, size:size + width] - integral[y:end, size:size + width]
+                          - integral[y + size:end + size, :width] + integral[y:end, :width]).view(np.int32)
+            window_area = window_rows[y:end, None] * window_cols[None, :]
+            part = gray[y:end]
+            ink = (part * window_area < window_sum - 10 * window_area) | (part < 96)
+            result[y:end] = np.where(ink, 0, 255)
+        gray = result
+        timings["threshold"] = (time.perf_counter() - started) * 1000
+
+    return Image.fromarray(gray), (int(left), int(top)), timings
+
+
+def ocr_image(img, dpi, origin=(0, 0)):
+    """
+    Runs Tesseract on a page image and returns its text and word boxes.
+
+    Parameters:
+    - img (PIL.Image): The page (or region) image
+    - dpi (int): The resolution the image was rendered at
+    - origin (tuple): PDF coordinates of the image's top-left corner
+
+    Returns:
+    - tuple: (text, words) where words are (x0, y0, x1, y1, word, block_no, line_no, word_no)
+      tuples in PDF coordinates, like page.get_text("words")
+    """
+    data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
+    to_points = 72 / dpi  # (PDF points per image pixel)
+    words = []
+    lines = []
+    previous_line = None
+    for i, word in enumerate(data["text"]):
+        if not word.strip():
+            continue
+        block = data["block_num"][i]
+        # Tesseract numbers lines per paragraph, so combine both into one line number
+        line = data["par_num"][i] * 1000 + data["line_num"][i]
+        x0 = origin[0] + data["left"][i] * to_points
+        y0 = origin[1] + data["top"][i] * to_points
+        x1 = x0 + data["width"][i] * to_points
+        y1 = y0 + data["height"][i] * to_points
+        words.append((x0, y0, x1, y1, word, block, line, data["word_num"][i]))
+        if (block, line) != previous_line:
+            lines.append([])
+            previous_line = (block, line)
+        lines[-1].append(word)
+    return "\n".join(" ".join(line) for line in lines), words
+
+
+class PytesseractEngine:
+    """
+    OCR engine that runs pytesseract directly.
+
+    Every call starts a new tesseract process, which loads the language model again
+    and receives the image through a temporary file. Used when tesserocr is not
+    installed, and as the baseline in the OCR benchmark.
+    """
+    name = "pytesseract"
+
+    def image_to_string(self, img):
+        return pytesseract.image_to_string(img, lang=OCR_LANG)
+
+    def close(self):
+        pass
+
+
+def _tesseract_worker_main(conn, lang):
+    """
+    Entry point of a warm Tesseract worker process.
+
+    The process loads Tesseract once through its C API (tesserocr) and then OCRs the
+    raw grayscale image buffers it receives over the pipe, with no temporary files.
+    A None request stops the process.
+
+    Parameters:
+    - conn (multiprocessing.connection.Connection): The process end of the pipe
+    - lang (str): Tesseract language(s)
+    """
+    # One thread per engine: the pool provides the parallelism
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    from tesserocr import PyTessBaseAPI
+
+    with PyTessBaseAPI(lang=lang) as api:
+        conn.send("ready")
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            width, height, data = request
+            try:
+                api.SetImageBytes(data, width, height, 1, width)
+                conn.send(("ok", api.GetUTF8Text()))
+            except Exception as e:
+                conn.send(("error", str(e)))
+
+
+class TesseractPool:
+    """
+    OCR engine that keeps a pool of long-lived Tesseract worker processes.
+
+    Each worker loads Tesseract and its language model once (through tesserocr), so
+    a call only costs the recognition itself. Images are sent to the workers as raw
+    pixel buffers over a pipe instead of temporary files. Calls from several threads
+    run in parallel on different workers.
+
+    Example:
+    engine = TesseractPool(workers=2)
+    text = engine.image_to_string(img)
+    """
+    name = "tesserocr pool"
+
+    def __init__(self, workers=OCR_ENGINE_WORKERS, lang=OCR_LANG):
+        context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.idle = queue.Queue()  # (pipes of workers that are not busy)
+        for _ in range(max(1, workers)):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_tesseract_worker_main, args=(child_conn, lang), daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append((process, conn))
+        # Wait until every worker has loaded its model
+        for _, conn in self.processes:
+            if conn.recv() != "ready":
+                raise RuntimeError("Tesseract worker failed to start")
+            self.idle.put(conn)
+
+    def image_to_string(self, img):
+        """
+        OCRs an image on the next free worker.
+
+        Parameters:
+        - img (PIL.Image): The image
+
+        Returns:
+        - str: The recognised text
+        """
+        img = img.convert("L")
+        conn = self.idle.get()
+        try:
+            conn.send((img.width, img.height, img.tobytes()))
+            status, result = conn.recv()
+        finally:
+            self.idle.put(conn)
+        if status != "ok":
+            raise RuntimeError(f"Tesseract error: {result}")
+        return result
+
+    def close(self):
+        for process, conn in self.processes:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=1)
+
+
+def create_ocr_engine():
+    """
+    Returns the best available OCR engine: a TesseractPool if tesserocr is installed,
+    otherwise a PytesseractEngine.
+    """
+    if importlib.util.find_spec("tesserocr") is not None:
+        try:
+            return TesseractPool()
+        except Exception as e:
+            print(f"Error starting Tesseract pool, using pytesseract: {str(e)}")
+    else:
+        print("tesserocr is not installed, using pytesseract for OCR")
+    return PytesseractEngine()
+
+
+def benchmark_ocr(path, runs=20):
+    """
+    Measures the per-call latency of the OCR engines on a small image, like the
+    region of a text selection, and prints the results.
+
+    Parameters:
+    - path (str): An image file, or a PDF (a 300x75 point region at the top-left of
+      its first page is used, rendered at 2x)
+    - runs (int): Number of calls per engine
+    """
+    if path.lower().endswith(".pdf"):
+        doc = fitz.open(path)
+        pix = doc[0].get_pixmap(matrix=fitz.Matrix(2, 2), clip=fitz.Rect(0, 0, 300, 75))
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    else:
+        img = Image.open(path).convert("RGB")
+    print(f"OCR benchmark: {img.width}x{img.height} image, {runs} calls per engine")
+
+    engines = [PytesseractEngine()]
+    if importlib.util.find_spec("tesserocr") is not None:
+        started = time.perf_counter()
+        engines.append(TesseractPool())
+        print(f"  tesserocr pool started in {(time.perf_counter() - started) * 1000:.0f} ms (one-time cost)")
+    else:
+        print("  tesserocr is not installed, only the pytesseract path is measured")
+
+    for engine in engines:
+        engine.image_to_string(img)  # (warm-up call)
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            engine.image_to_string(img)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"  {engine.name:16s} mean {statistics.mean(timings):7.1f} ms  median {statistics.median(timings):7.1f} ms  p95 {p95:7.1f} ms")
+        engine.close()
+
+
+def _latex_worker_main(conn, torch_threads):
+    """
+    Entry point of the LaTeX OCR worker process.
+
+    The process loads the pix2tex model once and then answers batches of equation
+    images it receives over the pipe. Each request is a list of (mode, width, height,
+    pixels) images and the reply is a list of ("ok", latex) or ("error", message)
+    results in the same order. A None request stops the process.
+
+    Parameters:
+    - conn (multiprocessing.connection.Connection): The process end of the pipe
+    - torch_threads (int): Number of CPU threads torch may use
+    """
+    # Limit the threads of torch and the math libraries below it (this must happen
+    # before torch is imported) and run at a lower priority than the UI process
+    os.environ["OMP_NUM_THREADS"] = str(torch_threads)
+    os.environ["MKL_NUM_THREADS"] = str(torch_threads)
+    if hasattr(os, "nice"):
+        os.nice(5)
+    try:
+        import torch
+        from pix2tex.cli import LatexOCR
+        torch.set_num_threads(torch_threads)
+        torch.set_num_interop_threads(1)
+        model = LatexOCR()
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ready", None))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        results = []
+        # No gradients are needed for inference, which saves memory and time
+        with torch.inference_mode():
+            for mode, width, height, data in request:
+                try:
+                    results.append(("ok", model(Image.frombytes(mode, (width, height), data))))
+                except Exception as e:
+                    results.append(("error", str(e)))
+        conn.send(results)
+
+
+class LatexWorker:
+    """
+    Recognises LaTeX in equation images in a separate process, so the Tk thread never
+    waits for the model.
+
+    The worker process loads the pix2tex model once and stays warm. Images submitted
+    while the model is busy (or still loading) are queued and sent together as one
+    batch of up to max_batch images. Results are passed to callback(latex, error) on
+    the dispatcher thread, so the callback must hand them over to the Tk thread (for
+    example with root.after).
+
+    Example:
+    worker = LatexWorker()
+    worker.submit(img, lambda latex, error: print(latex or error))
+    """
+    def __init__(self, torch_threads=LATEX_TORCH_THREADS, max_batch=LATEX_MAX_BATCH):
+        self.max_batch = max(1, max_batch)
+        self.pending = []  # ((image, callback, owner) tuples waiting for the worker)
+        self.condition = threading.Condition()
+        self.running = True
+        self.error = None  # (why the worker stopped, if it failed to start)
+
+        # Use the "spawn" start method: forking a process that already runs threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_latex_worker_main, args=(child_conn, torch_threads), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, img, callback, owner=None, urgent=False):
+        """
+        Queues an image for recognition.
+
+        Parameters:
+        - img (PIL.Image): The equation image
+        - callback (function): Called as callback(latex, error) with the LaTeX string,
+          or with None and an error message if recognition failed
+        - owner (object): Identifies the submitter, so its queued images can be discarded
+        - urgent (bool): Put the image in front of the queue (used for interactive requests)
+        """
+        with self.condition:
+            if self.running:
+                if urgent:
+                    self.pending.insert(0, (img, callback, owner))
+                else:
+                    self.pending.append((img, callback, owner))
+                self.condition.notify()
+                return
+        callback(None, self.error or "LaTeX OCR worker is not running")
+
+    def discard(self, owner):
+        """
+        Drops the queued images of an owner without calling their callbacks.
+        """
+        with self.condition:
+            self.pending = [item for item in self.pending if item[2] is not owner]
+
+    def recognize(self, img, timeout=LATEX_RECOGNIZE_TIMEOUT):
+        """
+        Recognises an image and waits for the result.
+
+        Parameters:
+        - img (PIL.Image): The equation image
+        - timeout (float): Seconds to wait (including loading the model, if it is still loading)
+
+        Returns:
+        - str or None: The LaTeX string, or None if recognition failed or timed out
+        """
+        done = threading.Event()
+        result = []
+        self.submit(img, lambda latex, error: (result.append(latex), done.set()), urgent=True)
+        done.wait(timeout)
+        return result[0] if result else None
+
+    def close(self):
+        """
+        Stops the dispatcher thread and the worker process.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    @staticmethod
+    def run_callback(callback, latex, error):
+        # An error in a callback must not stop the dispatcher thread
+        try:
+            callback(latex, error)
+        except Exception as e:
+            print(f"Error in LaTeX OCR callback: {str(e)}")
+
+    def dispatch(self):
+        # Runs on the dispatcher thread: wait for the model, then send queued images in batches
+        try:
+            status, error = self.conn.recv()
+        except (EOFError, OSError) as e:
+            status, error = "error", str(e)
+        if status == "ready":
+            startup_timer.mark("LaTeX OCR model loaded")
+        else:
+            print(f"Error loading LaTeX OCR model: {error}")
+            self.error = f"LaTeX OCR model could not be loaded: {error}"
+            self.running = False
+
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                if not self.running:
+                    # Fail everything that is still queued
+                    batch, self.pending = batch + self.pending, []
+            if not self.running:
+                for _, callback, _ in batch:
+                    self.run_callback(callback, None, self.error or "LaTeX OCR worker is not running")
+                break
+
+            started = time.perf_counter()
+            # Items that are not images fail on their own, without affecting the rest of the batch
+            items = []
+            for img, callback, _ in batch:
+                try:
+                    items.append(((img.mode, img.width, img.height, img.tobytes()), callback))
+                except Exception as e:
+                    self.run_callback(callback, None, f"Not an image: {str(e)}")
+            if not items:
+                continue
+            try:
+                self.conn.send([item for item, _ in items])
+                results = self.conn.recv()
+            except (EOFError, OSError) as e:
+                print(f"LaTeX OCR process stopped: {str(e)}")
+                with self.condition:
+                    self.error = f"LaTeX OCR process stopped: {str(e)}"
+                    self.running = False
+                results = [("error", self.error)] * len(items)
+            except Exception as e:
+                # Fail this batch, but keep the dispatcher running for the next ones
+                print(f"Error in LaTeX OCR batch: {str(e)}")
+                results = [("error", f"LaTeX OCR failed: {str(e)}")] * len(items)
+            print(f"LaTeX OCR: {len(items)} image(s) in {(time.perf_counter() - started) * 1000:.0f} ms")
+            for (_, callback), (status, result) in zip(items, results):
+                if status == "ok":
+                    self.run_callback(callback, result, None)
+                else:
+                    self.run_callback(callback, None, result)
+        try:
+            self.conn.send(None)
+            self.conn.close()
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+
+
+class EquationCache:
+    """
+    An on-disk cache of the equations found on pages and their LaTeX, stored in SQLite.
+
+    Equations are keyed on (document fingerprint, page number, region), where the
+    region is the equation's rectangle in PDF coordinates. Pages that have been
+    fully scanned are recorded too, so pages without equations are not scanned again.
+
+    A connection must only be used by the thread that created the object.
+
+    Example:
+    cache = EquationCache()
+    for rect, latex in cache.get_page(fingerprint, 3):
+        print(rect, latex)
+    """
+    def __init__(self, db_path=EQUATION_CACHE_PATH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS equations (fingerprint TEXT, page INTEGER, x0 REAL, y0 REAL, x1 REAL, y1 REAL, "
+                          "latex TEXT, PRIMARY KEY (fingerprint, page, x0, y0, x1, y1))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scanned_pages (fingerprint TEXT, page INTEGER, PRIMARY KEY (fingerprint, page))")
+        self.conn.commit()
+
+    def get_page(self, fingerprint, page_num):
+        """
+        Returns the equations of a page as (rect, latex) pairs in reading order.
+        """
+        rows = self.conn.execute("SELECT x0, y0, x1, y1, latex FROM equations WHERE fingerprint = ? AND page = ? ORDER BY y0, x0",
+                                 (fingerprint, page_num))
+        return [(tuple(row[:4]), row[4]) for row in rows]
+
+    def scanned_pages(self, fingerprint):
+        """
+        Returns the set of page numbers of a document whose equations are all cached.
+        """
+        rows = self.conn.execute("SELECT page FROM scanned_pages WHERE fingerprint = ?", (fingerprint,))
+        return {row[0] for row in rows}
+
+    def put(self, fingerprint, page_num, rect, latex):
+        self.conn.execute("INSERT OR REPLACE INTO equations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (fingerprint, page_num, *[round(value, 2) for value in rect], latex))
+        self.conn.commit()
+
+    def mark_scanned(self, fingerprint, page_num):
+        self.conn.execute("INSERT OR REPLACE INTO scanned_pages VALUES (?, ?)", (fingerprint, page_num))
+        self.conn.commit()
+
+
+def find_equation_regions(page):
+    """
+    Finds the regions of a page that probably contain equations.
+
+    Two kinds of candidates are used:
+    - text set in math fonts (see MATH_FONT_PATTERN): a line that is mostly math is a
+      displayed equation and is taken whole; in other lines, each run of math spans
+      (together with the digits, operators and brackets between them) is an inline
+      equation. Regions that touch vertically (like the parts of a fraction) are merged.
+    - image blocks shaped like a line of text (wide and not too tall), as equations
+      are often embedded as images
+
+    Parameters:
+    - page (fitz.Page): The page
+
+    Returns:
+    - list: fitz.Rect regions in PDF coordinates, in reading order
+    """
+    regions = []
+    for block in page.get_text("dict")["blocks"]:
+        if block["type"] == 1:
+            x0, y0, x1, y1 = block["bbox"]
+            if 8 <= y1 - y0 <= 120 and x1 - x0 >= 1.5 * (y1 - y0) and x1 - x0 < 0.9 * page.rect.width:
+                regions.append(fitz.Rect(block["bbox"]))
+            continue
+        for line in block["lines"]:
+            spans = [span for span in line["spans"] if span["text"].strip()]
+            math = [bool(MATH_FONT_PATTERN.search(span["font"])) for span in spans]
+            math_chars = sum(len(span["text"].strip()) for span, is_math in zip(spans, math) if is_math)
+            total_chars = sum(len(span["text"].strip()) for span in spans)
+            if math_chars < 2:
+                continue
+            if math_chars >= 0.5 * total_chars:
+                regions.append(fitz.Rect(line["bbox"]))
+                continue
+            # Inline math: grow runs of math spans over the symbols between them
+            run = None
+            for span, is_math in zip(spans, math):
+                if is_math or (run is not None and re.fullmatch(r"[\s\d=+\-*/^_()\[\],.<>|]+", span["text"])):
+                    run = fitz.Rect(span["bbox"]) if run is None else run | fitz.Rect(span["bbox"])
+                elif run is not None:
+                    regions.append(run)
+                    run = None
+            if run is not None:
+                regions.append(run)
+
+    # Merge regions that overlap or touch vertically and overlap horizontally
+    merged = []
+    for rect in sorted(regions, key=lambda r: (r.y0, r.x0)):
+        for i, other in enumerate(merged):
+            grown = fitz.Rect(other.x0, other.y0 - 0.3 * other.height, other.x1, other.y1 + 0.3 * other.height)
+            if grown.intersects(rect):
+                merged[i] = other | rect
+                break
+        else:
+            merged.append(fitz.Rect(rect))
+
+    # Add a small margin so the symbols are not cut off, and drop tiny regions
+    margin = 2
+    return [(rect + (-margin, -margin, margin, margin)) & page.rect
+            for rect in sorted(merged, key=lambda r: (r.y0, r.x0)) if rect.width >= 6]
+
+
+def _equation_page_task(file_path, page_num, scale):
+    """
+    Finds the equations on one page and renders them, in a worker process.
+
+    Returns:
+    - list: (rect, mode, width, height, pixels) for every equation region, with the
+      region as a tuple in PDF coordinates and the image cropped to its content
+    """
+    doc = _ocr_worker_documents.get(file_path)
+    if doc is None:
+        doc = _ocr_worker_documents[file_path] = fitz.open(file_path)
+    page = doc[page_num]
+    crops = []
+    for rect in find_equation_regions(page):
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=rect)
+        img, _, _ = preprocess_for_ocr(pix, 72 * scale, target_dpi=None, binarize=False)
+        if img is not None:
+            crops.append((tuple(rect), img.mode, img.width, img.height, img.tobytes()))
+    return crops
+
+
+class EquationExtractionJob:
+    """
+    Finds the equations on a range of pages and converts them to LaTeX in the background.
+
+    Equation regions are found and cropped in a worker process (see
+    find_equation_regions), and the crops are queued on the LaTeX OCR worker, which
+    recognises them in batches. The LaTeX of every region is stored in the equation
+    cache; pages that are already cached are skipped.
+
+    on_progress(page_num, done, total, converted) is called from the job's thread after
+    every finished page, and once more with page_num None at the end.
+
+    Example:
+    job = EquationExtractionJob("paper.pdf", fingerprint, range(0, 5), latex_worker, print)
+    job.start()
+    """
+    def __init__(self, file_path, fingerprint, pages, latex_worker, on_progress=None):
+        self.file_path = file_path
+        self.fingerprint = fingerprint
+        self.pages = list(pages)
+        self.latex_worker = latex_worker
+        self.on_progress = on_progress
+        self.cancelled = threading.Event()
+        self.executor = None
+        self.equations_per_minute = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def cancel(self):
+        """
+        Stops the job; equations that are already being recognised are still cached.
+        """
+        self.cancelled.set()
+        self.latex_worker.discard(self)
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self):
+        if self.fingerprint is None:
+            self.fingerprint = document_fingerprint(self.file_path)
+        cache = EquationCache()
+        scanned = cache.scanned_pages(self.fingerprint)
+        pages = [page_num for page_num in self.pages if page_num not in scanned]
+        results = queue.Queue()  # ((page_num, rect, latex, error) from the LaTeX worker's thread)
+        remaining = {}  # (page number -> equations still being recognised)
+        done = len(self.pages) - len(pages)
+        converted = 0
+        started = None
+
+        def finish_page(page_num):
+            nonlocal done
+            del remaining[page_num]
+            cache.mark_scanned(self.fingerprint, page_num)
+            done += 1
+            if self.on_progress:
+                self.on_progress(page_num, done, len(self.pages), converted)
+
+        def handle_result(page_num, rect, latex, error):
+            nonlocal converted
+            if latex:
+                cache.put(self.fingerprint, page_num, rect, latex)
+                converted += 1
+            else:
+                print(f"Error converting equation on page {page_num + 1}: {error}")
+            remaining[page_num] -= 1
+            if remaining[page_num] == 0:
+                finish_page(page_num)
+
+        def drain(block):
+            # Store the results that have arrived; with block, wait for at least one
+            while remaining and not self.cancelled.is_set():
+                try:
+                    handle_result(*results.get(timeout=0.5 if block else 0))
+                    block = False
+                except queue.Empty:
+                    if not block:
+                        return
+
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+        try:
+            futures = {self.executor.submit(_equation_page_task, self.file_path, page_num, EQUATION_RENDER_SCALE): page_num
+                       for page_num in pages}
+            for future in as_completed(futures):
+                if self.cancelled.is_set():
+                    break
+                page_num = futures[future]
+                try:
+                    crops = future.result()
+                except Exception as e:
+                    print(f"Error finding equations on page {page_num + 1}: {str(e)}")
+                    continue
+                remaining[page_num] = len(crops)
+                if not crops:
+                    finish_page(page_num)
+                if started is None and crops:
+                    started = time.perf_counter()
+                for rect, mode, width, height, data in crops:
+                    img = Image.frombytes(mode, (width, height), data)
+                    self.latex_worker.submit(img, lambda latex, error, page_num=page_num, rect=rect: results.put((page_num, rect, latex, error)),
+                                             owner=self)
+                # Keep the LaTeX worker busy, but don't queue up crops for the whole document
+                drain(block=sum(remaining.values()) > 4 * LATEX_MAX_BATCH)
+            while remaining and not self.cancelled.is_set():
+                drain(block=True)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+        if started is not None and converted:
+            elapsed = time.perf_counter() - started
+            self.equations_per_minute = converted / elapsed * 60
+            print(f"Equation extraction: {converted} equations in {elapsed:.1f}s ({self.equations_per_minute:.1f} equations/min)")
+        if self.on_progress:
+            self.on_progress(None, done, len(self.pages), converted)
+
+
+def parse_page_range(text, page_count):
+    """
+    Parses a page range typed by the user, like "3", "3-7" or "1-2, 5".
+
+    Parameters:
+    - text (str): The page range (1-based page numbers, inclusive)
+    - page_count (int): Number of pages in the document
+
+    Returns:
+    - list: 0-based page numbers, in order and without duplicates
+
+    Raises:
+    - ValueError: If the range is not valid
+    """
+    pages = []
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        first = int(first)
+        last = int(last) if last.strip() else first
+        if not 1 <= first <= last <= page_count:
+            raise ValueError(f"Pages must be between 1 and {page_count}")
+        pages.extend(page_num for page_num in range(first - 1, last) if page_num not in pages)
+    return pages
+
+
+def export_equations_tex(path, equations, title=""):
+    """
+    Writes equations to a .tex file that compiles on its own.
+
+    Parameters:
+    - path (str): The .tex file to write
+    - equations (list): (page number, rect, latex) for every equation
+    - title (str): Written as a comment at the top of the file
+    """
+    lines = [f"% Equations extracted from {title}" if title else "% Extracted equations",
+             r"\documentclass{article}", r"\usepackage{amsmath,amssymb}", r"\begin{document}", ""]
+    for page_num, rect, latex in equations:
+        lines.append(f"% Page {page_num + 1}, region ({', '.join(f'{value:.1f}' for value in rect)})")
+        lines.append(r"\[")
+        lines.append(latex)
+        lines.append(r"\]")
+        lines.append("")
+    lines.append(r"\end{document}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# Documents opened by the current OCR worker process (file path -> fitz.Document)
+_ocr_worker_documents = {}
+
+def _ocr_page_task(file_path, page_num, dpi):
+    """
+    OCRs one page in an OCR worker process.
+
+    Pages that have a text layer are skipped. The document stays open in the worker
+    process for the next pages.
+
+    Returns:
+    - tuple or None: (text, words) as returned by ocr_image, or None if the page has a text layer
+    """
+    doc = _ocr_worker_documents.get(file_path)
+    if doc is None:
+        doc = _ocr_worker_documents[file_path] = fitz.open(file_path)
+    page = doc[page_num]
+    if page.get_text().strip():
+        return None
+    pix = page.get_pixmap(dpi=dpi)
+    img, (crop_x, crop_y), _ = preprocess_for_ocr(pix, dpi, target_dpi=None)
+    if img is None:
+        return "", []
+    # The word boxes are relative to the cropped image
+    return ocr_image(img, dpi, origin=(page.rect.x0 + crop_x * 72 / dpi, page.rect.y0 + crop_y * 72 / dpi))
+
+
+def _render_region_task(file_path, page_num, dpi, clip=None, binarize=True):
+    """
+    Renders a page, or a region of it, and prepares it for OCR in a worker process
+    (see preprocess_for_ocr), so rendering and cleaning up a page at the OCR resolution
+    never blocks the Tk thread.
+
+    Parameters:
+    - file_path (str): The path to the PDF file
+    - page_num (int): The 0-based page number
+    - dpi (float): The resolution to render at
+    - clip (tuple or None): Optional (x0, y0, x1, y1) region of the page in PDF coordinates
+    - binarize (bool): Whether to binarise the image (not for LaTeX recognition)
+
+    Returns:
+    - tuple or None: (mode, width, height, pixels) of the prepared image, or None if it is blank
+    """
+    doc = _ocr_worker_documents.get(file_path)
+    if doc is None:
+        doc = _ocr_worker_documents[file_path] = fitz.open(file_path)
+    pix = doc[page_num].get_pixmap(dpi=dpi, clip=fitz.Rect(clip) if clip else None)
+    img, _, _ = preprocess_for_ocr(pix, dpi, target_dpi=None, binarize=binarize)
+    if img is None:
+        return None
+    return img.mode, img.width, img.height, img.tobytes()
+
+
+class DocumentOCRJob:
+    """
+    OCRs all image-only (scanned) pages of a document in the background.
+
+    Pages are OCRed in a pool of worker processes, one page per task, using all cores.
+    They are submitted in reading order starting from a given page (the rest of the
+    document first, then the pages before it), and pages already in the OCR cache at
+    this resolution or higher are skipped. Results are stored in the OCR cache as
+    they arrive.
+
+    on_page(page_num, done, total) is called from the job's thread after every page,
+    including pages that failed (once with page_num None if there is nothing to do).
+
+    Example:
+    job = DocumentOCRJob("scan.pdf", fingerprint, start_page=10, on_page=print)
+    job.start()
+    """
+    def __init__(self, file_path, fingerprint, start_page=0, dpi=OCR_DPI, workers=OCR_WORKERS, on_page=None):
+        self.file_path = file_path
+        self.fingerprint = fingerprint
+        self.start_page = start_page
+        self.dpi = dpi
+        self.workers = workers
+        self.on_page = on_page
+        self.cancelled = threading.Event()
+        self.executor = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def cancel(self):
+        """
+        Stops the job; pages that are already being OCRed are finished and cached.
+        """
+        self.cancelled.set()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self):
+        started = time.perf_counter()
+        if self.fingerprint is None:
+            self.fingerprint = document_fingerprint(self.file_path)
+        cache = OCRCache()
+        doc = fitz.open(self.file_path)
+        page_count = len(doc)
+        doc.close()
+        # Pages OCRed at a lower resolution (e.g. by the search indexer) are OCRed again
+        done_pages = cache.cached_pages(self.fingerprint, min_dpi=self.dpi)
+        order = list(range(self.start_page, page_count)) + list(range(0, self.start_page))
+        order = [page_num for page_num in order if page_num not in done_pages]
+
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        futures = {}
+        for page_num in order:
+            if self.cancelled.is_set():
+                break
+            futures[self.executor.submit(_ocr_page_task, self.file_path, page_num, self.dpi)] = page_num
+        done = 0
+        try:
+            for future in as_completed(futures):
+                if self.cancelled.is_set():
+                    break
+                page_num = futures[future]
+                done += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # A failed page still counts as done, so the progress reaches the total
+                    print(f"Error OCRing page {page_num + 1}: {str(e)}")
+                    result = None
+                if result is not None:
+                    cache.put(self.fingerprint, page_num, self.dpi, *result)
+                if self.on_page:
+                    self.on_page(page_num, done, len(futures))
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if not futures and self.on_page:
+            # Nothing to do: every page was already cached
+            self.on_page(None, 0, 0)
+        print(f"OCR job: {done} pages in {time.perf_counter() - started:.1f}s")
+
+
+def _index_document_process(file_path, db_path, conn):
+    """
+    Entry point of the background indexing process.
+
+    Computes the document fingerprint, and unless the document is already fully
+    indexed, extracts the text of every page (OCRing pages without a text layer)
+    into the search index. Progress messages are sent over the pipe:
+    ("fingerprint", fingerprint), ("progress", done, total) and ("done", fingerprint, reused).
+
+    Parameters:
+    - file_path (str): The path to the PDF file
+    - db_path (str): The path to the search index database
+    - conn (multiprocessing.connection.Connection): The process end of the pipe
+    """
+    fingerprint = document_fingerprint(file_path)
+    index = DocumentSearchIndex(db_path)
+    if index.is_complete(fingerprint):
+        conn.send(("done", fingerprint, True))
+        return
+    conn.send(("fingerprint", fingerprint))
+
+    doc = fitz.open(file_path)
+    index.reset(fingerprint, len(doc))
+    ocr_cache = OCRCache()
+    batch = []
+    for page_num in range(len(doc)):
+        page = doc[page_num]
+        text = page.get_text()
+        if not text.strip():
+            # Scanned page: use the cached OCR result, or OCR it now and cache the result
+            cached = ocr_cache.get(fingerprint, page_num)
+            if cached:
+                text = cached[0]
+            else:
+                pix = page.get_pixmap(dpi=SEARCH_OCR_DPI)
+                img, (crop_x, crop_y), _ = preprocess_for_ocr(pix, SEARCH_OCR_DPI, target_dpi=None)
+                text, words = "", []
+                if img is not None:
+                    text, words = ocr_image(img, SEARCH_OCR_DPI, origin=(page.rect.x0 + crop_x * 72 / SEARCH_OCR_DPI,
+                                                                          page.rect.y0 + crop_y * 72 / SEARCH_OCR_DPI))
+                ocr_cache.put(fingerprint, page_num, SEARCH_OCR_DPI, text, words)
+        batch.append((page_num, text))
+        if len(batch) >= 50 or page_num == len(doc) - 1:
+            index.add_pages(fingerprint, batch)
+            batch = []
+            conn.send(("progress", page_num + 1, len(doc)))
+    index.mark_complete(fingerprint)
+    doc.close()
+    conn.send(("done", fingerprint, False))
+
+
+class RenderJob:
+    """
+    A request to render one page (or a clipped region of a page) at a given scale.
+
+    A preview job renders the page cheaply at PREVIEW_SCALE and scales the result up
+    to the size of the full-resolution page, so it can be shown in its place until
+    the full-resolution page is ready. A "words" job extracts the page's words for
+    its PageWordIndex instead of rendering anything.
+
+    Parameters:
+    - page_num (int): The 0-based page number
+    - scale (float): The zoom factor (2 means twice the PDF resolution)
+    - clip (tuple or None): Optional (x0, y0, x1, y1) region of the page in PDF coordinates
+    - preview (bool): Whether this is a low-resolution preview job
+    - kind (str): "render" or "words"
+    """
+    def __init__(self, page_num, scale, clip=None, preview=False, kind="render"):
+        self.page_num = page_num
+        self.scale = scale
+        self.clip = clip
+        self.preview = preview
+        self.kind = kind
+        # The scale the page is actually rasterised at
+        self.render_scale = min(PREVIEW_SCALE, scale) if preview else scale
+        # The key under which the result is stored in the page cache
+        self.key = (page_num, scale) if clip is None else (page_num, scale, tuple(clip))
+        if preview:
+            self.key += ("preview",)
+        if kind == "words":
+            self.key = (page_num, "words")
+
+
+def _render_process_main(file_path, conn):
+    """
+    Entry point of the page render process.
+
+    PyMuPDF is not thread-safe, so pages are rendered in a separate process with its
+    own document handle. The process receives (kind, page_num, scale, clip) requests
+    over a pipe and sends back the raw pixmap samples ("render") or the page rect and
+    words of the page ("words"). A None request stops the process.
+
+    Parameters:
+    - file_path (str): The path to the PDF file
+    - conn (multiprocessing.connection.Connection): The process end of the pipe
+    """
+    doc = fitz.open(file_path)
+    # Each page is parsed once and rendered from its display list at every scale and clip
+    content = PageContentCache(doc)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        kind, page_num, scale, clip = request
+        try:
+            if kind == "words":
+                conn.send(("ok", tuple(content.display_list(page_num).rect), content.get_words(page_num)))
+            else:
+                pix = content.get_pixmap(page_num, scale, clip=fitz.Rect(clip) if clip else None)
+                conn.send(("ok", pix.width, pix.height, pix.samples))
+        except Exception as e:
+            conn.send(("error", str(e)))
+    doc.close()
+
+
+class PageRenderWorker:
     """
-    Sends a completion request to the AI model and returns the response.
+    Renders pages in a background process so page turns never block the Tk thread.
 
-    Parameters:
-    - messages (list): A list of message dictionaries to send to the AI
-    - max_retries (int): Maximum number of retry attempts
-    - retry_delay (int): Delay in seconds between retry attempts
+    A dispatcher thread feeds render jobs to the render process one at a time, in
+    priority order, and calls on_rendered(worker, job, image) with a PIL image for
+    every finished render job and on_words(worker, job, index) with a PageWordIndex
+    for every finished "words" job. Both are called from the dispatcher thread, so
+    they must hand the result over to the Tk thread (for example with root.after).
 
-    Returns:
-    - str: The content of the AI's response, or an error message
+    Submitting a new list of jobs replaces all jobs that have not started yet, so
+    prefetch requests for pages the user is no longer near are dropped.
+
+    Example:
+    worker = PageRenderWorker("book.pdf", on_rendered, on_words)
+    worker.submit([RenderJob(0, 2), RenderJob(1, 2), RenderJob(0, 2, kind="words")])
     """
-    for attempt in range(max_retries):
-        try:
-            completion = client.chat.completions.create(
-                model=model,
-                messages=messages,
-            )
-            return completion.choices[0].message.content
-        except OpenAIError as e:
-            if attempt < max_retries - 1:
-                print(f"Error occurred: {str(e)}. Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+    def __init__(self, file_path, on_rendered, on_words=None):
+        self.on_rendered = on_rendered
+        self.on_words = on_words
+        self.pending = OrderedDict()  # (job key -> job, highest priority first)
+        self.in_flight_key = None  # (key of the job currently being rendered)
+        self.condition = threading.Condition()
+        self.running = True
+
+        # Use the "spawn" start method: forking a process that already runs threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_render_process_main, args=(file_path, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, jobs):
+        """
+        Replaces the pending jobs with a new list of jobs. A job for the page that
+        is being rendered right now is skipped, as its result is already on the way.
+
+        Parameters:
+        - jobs (list): RenderJob objects, highest priority first
+        """
+        with self.condition:
+            self.pending = OrderedDict((job.key, job) for job in jobs if job.key != self.in_flight_key)
+            self.condition.notify()
+
+    def close(self):
+        """
+        Stops the dispatcher thread and the render process.
+        """
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify()
+
+    def dispatch(self):
+        # Runs on the dispatcher thread: send one job at a time and wait for the result
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                _, job = self.pending.popitem(last=False)
+                self.in_flight_key = job.key
+            try:
+                self.conn.send((job.kind, job.page_num, job.render_scale, job.clip))
+                reply = self.conn.recv()
+            except (EOFError, OSError) as e:
+                print(f"Render process stopped: {str(e)}")
+                break
+            if reply[0] == "ok" and job.kind == "words":
+                # Build the spatial index here so the Tk thread only has to store it
+                _, page_rect, words = reply
+                if self.on_words:
+                    self.on_words(self, job, PageWordIndex(words, page_rect))
+            elif reply[0] == "ok":
+                _, width, height, samples = reply
+                img = Image.frombytes("RGB", (width, height), samples)
+                if job.render_scale != job.scale:
+                    # Scale the preview up to the size of the full-resolution page
+                    factor = job.scale / job.render_scale
+                    img = img.resize((round(width * factor), round(height * factor)), Image.BILINEAR)
+                self.on_rendered(self, job, img)
             else:
-                return f"Error: Unable to get a response from the AI after {max_retries} attempts. Please try again later."
-        except Exception as e:
-            return f"Unexpected error: {str(e)}"
+                print(f"Error rendering page {job.page_num + 1}: {reply[1]}")
+            with self.condition:
+                self.in_flight_key = None
+        try:
+            self.conn.send(None)
+            self.conn.close()
+        except OSError:
+            pass
+        self.process.join(timeout=1)
 
 
 # Main application class
@@ -150,10 +3705,9 @@ class PDFStudyAssistant:
         self.main_frame = ttk.Frame(self.root)
         self.main_frame.pack(fill=tk.BOTH, expand=True)
 
-        # Initialize conversation with system message
-        self.messages = [
-            {"role": "system", "content": "You are a helpful study assistant with the ability to analyze PDF content and answer questions about it. You can also perform web searches to gather additional information. When you need to search the web, simply include '/search' followed by your query in your response. For example, if you need to find information about climate change, you could say 'Let me search for more information. /search latest research on climate change'. Use this search capability when you need to provide up-to-date information or when the context from the PDF is insufficient to answer a question comprehensively. If the initial search results don't contain the exact information needed, you can perform a subsequent search using one of the links provided in the previous search results. For instance, you might say 'Let me check one of the provided links for more specific information. /search https://example.com specific query'. This allows you to dig deeper into reliable sources for more detailed or precise information. Remember, do not include square brackets in your search queries."}
-        ]
+        # Initialize conversation with system message (the conversation is kept
+        # within a token budget, see ConversationContext)
+        self.conversation = ConversationContext("You are a helpful study assistant with the ability to analyze PDF content and answer questions about it. You have tools to search the web, read web pages, read pages of the PDF the user has open, and read a region of a PDF page with OCR or convert an equation in it to LaTeX. Use them when the context you were given is insufficient to answer a question comprehensively or when up-to-date information is needed. You can call several tools at once when they don't depend on each other, and call more tools after seeing their results, for example to read one of the pages a web search found. Cite the PDF pages and web pages you use.")
         
         # Initialize various attributes
         self.pdf_canvas = None  # (A widget for displaying graphics)
@@ -167,17 +3721,148 @@ class PDFStudyAssistant:
         self.selection_rectangle = None
 
         self.current_pdf = None
-        self.latex_ocr = LatexOCR()
-
-        self.ddgs = DDGS()
+        # Warm OCR engine for interactive OCR, created on first use (see the ocr_engine property)
+        self._ocr_engine = None
+        self._ocr_engine_lock = threading.Lock()
+        # The LaTeX OCR worker and the DuckDuckGo client are created lazily (see the
+        # latex_worker and ddgs properties) so they don't delay the first window
+        self._latex_worker = None
+        self._latex_worker_lock = threading.Lock()
+        self._ddgs = None
+        self._web_cache = None
+        # The process that renders pages and regions for OCR off the Tk thread (see render_region_for_ocr)
+        self.region_executor = None
+        self.region_executor_lock = threading.Lock()
+        # The threads that run the AI's tool calls (see run_tool_calls)
+        self.tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
         self.chat_model = "claude-3-haiku"  # You can change this to any of the available models
         self.current_page = 0
-        self.page_cache = {}  # (A dictionary to store rendered pages for quick access)
+        # Scale factor used to render pages (2 doubles the resolution in both directions)
+        self.scale_factor = 2
+        # (A memory-bounded cache storing rendered pages for quick access)
+        self.page_cache = PageRenderCache(PAGE_CACHE_BUDGET_MB * 1024 * 1024)
+        # Parsed page content of the current PDF (created when a PDF is loaded)
+        self.page_content = None
+        # Word indexes of recently used pages (page number -> PageWordIndex), built in the background
+        self.word_indexes = OrderedDict()
+        # Full-text search: fingerprint of the current PDF (known once the background
+        # indexer has hashed the file), the indexing process and the current search
+        self.document_fingerprint = None
+        self.index_process = None
+        self.search_index = None
+        self.search_results = []
+        self.search_position = 0
+        self.search_query = ""
+        self.search_highlight = None  # ((page number, list of terms) to highlight, or None)
+        # Current PDF file, background whole-document OCR job and OCR cache (for the Tk thread)
+        self.current_pdf_path = None
+        self.ocr_job = None
+        self.ocr_cache = None
+        # Background equation extraction job and equation cache (for the Tk thread)
+        self.equation_job = None
+        self.equation_cache = None
+        # Retrieval index of the current PDF (loaded on the AI thread when first needed)
+        self.retrieval_index = None
+        # Background whole-document summary job
+        self.summary_job = None
+        # Background page renderer (created when a PDF is loaded)
+        self.render_worker = None
+        # Reading direction (+1 forward, -1 backward), used to decide which pages to prefetch
+        self.reading_direction = 1
+        # Time of the last navigation request, used to measure page turn latency
+        self.page_requested_at = None
+        # State for tiled rendering of large pages: the (page, scale) being shown in
+        # tiles and the tiles currently placed on the canvas (tile key -> canvas item)
+        self.tiled_page_key = None
+        self.tile_items = {}
+        self.view_update_pending = False
+        # State for continuous scroll mode: page geometry (PDF rects of all pages and
+        # the y offset of each page at the current scale) and the canvas items that
+        # show the pages near the viewport (page number -> slot). Slots of pages that
+        # scroll away are hidden and reused for other pages.
+        self.continuous_mode = False
+        self.page_rects = None
+        self.page_offsets = []
+        self.layout_height = 0
+        self.layout_scale = None
+        self.page_slots = {}
+        self.free_page_slots = []
         
-        # Set up the initial UI and AI processing queue
-        self.ai_queue = queue.Queue()  # (A thread-safe data structure for communication between threads)
+        # Number of equation placeholders created in the chat history (used for their tags)
+        self.latex_placeholder_count = 0
+        self.ai_status_update_pending = False
+
+        # Set up the initial UI and AI task scheduler
+        self.ai_scheduler = None
         self.setup_initial_ui()
         self.start_ai_thread()
+        startup_timer.mark("ui built")
+
+    @property
+    def latex_worker(self):
+        """
+        The LaTeX OCR worker process (see LatexWorker), started on first use.
+
+        The worker loads the pix2tex model (torch and the model weights take several
+        seconds) in its own process, so it is never loaded on the Tk thread.
+        """
+        with self._latex_worker_lock:
+            if self._latex_worker is None:
+                self._latex_worker = LatexWorker()
+        return self._latex_worker
+
+    @property
+    def ocr_engine(self):
+        """
+        The OCR engine used for selections and submissions (see create_ocr_engine),
+        started on first use or by the background loaders after startup.
+        """
+        with self._ocr_engine_lock:
+            if self._ocr_engine is None:
+                self._ocr_engine = create_ocr_engine()
+                startup_timer.mark(f"OCR engine ready ({self._ocr_engine.name})")
+        return self._ocr_engine
+
+    @property
+    def ddgs(self):
+        """
+        The DuckDuckGo client, created on first use.
+        """
+        if self._ddgs is None:
+            from duckduckgo_search import DDGS
+            self._ddgs = DDGS()
+        return self._ddgs
+
+    @property
+    def web_cache(self):
+        """
+        The cache of web search results and fetched pages, opened on first use.
+        """
+        if self._web_cache is None:
+            self._web_cache = WebCache()
+        return self._web_cache
+
+    def on_first_window(self):
+        """
+        Called once the first window has been drawn.
+
+        This method records the time to first window, prints the startup timing
+        report and starts the background loaders for the heavy parts of the app.
+        """
+        startup_timer.mark("first window drawn")
+        startup_timer.report()
+        self.start_background_loaders()
+
+    def start_background_loaders(self):
+        """
+        Starts background threads that load the model catalog, the warm OCR engine
+        and (optionally) the LaTeX OCR model, so they are ready by the time the user
+        needs them.
+        """
+        threading.Thread(target=load_model_info, daemon=True).start()
+        threading.Thread(target=lambda: self.ocr_engine, daemon=True).start()
+        if PRELOAD_LATEX_OCR:
+            threading.Thread(target=lambda: self.latex_worker, daemon=True).start()
 
     def setup_initial_ui(self):
         """
@@ -261,7 +3946,17 @@ class PDFStudyAssistant:
         h_scrollbar = ttk.Scrollbar(self.left_panel, orient=tk.HORIZONTAL, command=self.pdf_canvas.xview)
         h_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
 
-        self.pdf_canvas.configure(yscrollcommand=v_scrollbar.set, xscrollcommand=h_scrollbar.set)
+        # Every time the visible part of the canvas changes (scrolling or resizing), the canvas
+        # calls these commands; they update the scrollbars and the visible tiles of large pages
+        def on_yscroll(first, last):
+            v_scrollbar.set(first, last)
+            self.schedule_view_update()
+
+        def on_xscroll(first, last):
+            h_scrollbar.set(first, last)
+            self.schedule_view_update()
+
+        self.pdf_canvas.configure(yscrollcommand=on_yscroll, xscrollcommand=on_xscroll)
 
         # Bind mouse wheel event to the canvas
         self.pdf_canvas.bind("<MouseWheel>", self.on_mousewheel)  # For Windows and MacOS
@@ -297,6 +3992,15 @@ class PDFStudyAssistant:
         self.send_button = ttk.Button(self.input_frame, text="Send", command=self.send_message)
         self.send_button.pack(side=tk.RIGHT)
 
+        # Add a readout of the AI task queue and a button to cancel AI tasks
+        self.ai_status_frame = ttk.Frame(self.right_panel)
+        self.ai_status_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.ai_status_var = tk.StringVar(self.root, value="AI: idle")
+        self.ai_status_label = ttk.Label(self.ai_status_frame, textvariable=self.ai_status_var)
+        self.ai_status_label.pack(side=tk.LEFT, padx=5)
+        self.cancel_ai_button = ttk.Button(self.ai_status_frame, text="Cancel...", command=self.show_cancel_menu)
+        self.cancel_ai_button.pack(side=tk.RIGHT)
+
         # Create a toolbar (a frame with buttons) at the bottom of the window
         self.toolbar = ttk.Frame(self.root)
         self.toolbar.pack(side=tk.BOTTOM, fill=tk.X)
@@ -314,6 +4018,18 @@ class PDFStudyAssistant:
         self.submit_pdf_button = ttk.Button(self.toolbar, text="Submit PDF to AI", command=self.submit_pdf_to_ai, state=tk.DISABLED)
         self.submit_pdf_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.summary_button = ttk.Button(self.toolbar, text="Summarize PDF", command=self.toggle_document_summary)
+        self.summary_button.pack(side=tk.LEFT, padx=5, pady=5)
+
+        self.ocr_button = ttk.Button(self.toolbar, text="OCR Document", command=self.toggle_document_ocr)
+        self.ocr_button.pack(side=tk.LEFT, padx=5, pady=5)
+
+        self.equations_button = ttk.Button(self.toolbar, text="Find Equations", command=self.toggle_equation_extraction)
+        self.equations_button.pack(side=tk.LEFT, padx=5, pady=5)
+
+        self.export_equations_button = ttk.Button(self.toolbar, text="Export Equations", command=self.export_equations)
+        self.export_equations_button.pack(side=tk.LEFT, padx=5, pady=5)
+
         self.prev_page_button = ttk.Button(self.toolbar, text="Previous Page", command=self.prev_page)
         self.prev_page_button.pack(side=tk.LEFT, padx=5, pady=5)
 
@@ -323,6 +4039,9 @@ class PDFStudyAssistant:
         self.toggle_ai_button = ttk.Button(self.toolbar, text="Toggle AI", command=self.toggle_ai_panel)
         self.toggle_ai_button.pack(side=tk.RIGHT, padx=5, pady=5)
 
+        self.continuous_button = ttk.Button(self.toolbar, text="Continuous Scroll", command=self.toggle_continuous_mode)
+        self.continuous_button.pack(side=tk.RIGHT, padx=5, pady=5)
+
         # ... (existing code)
 
         # Add page navigation to the toolbar
@@ -341,6 +4060,21 @@ class PDFStudyAssistant:
         self.total_pages_label = ttk.Label(self.page_nav_frame, textvariable=self.total_pages_var)
         self.total_pages_label.pack(side=tk.LEFT)
 
+        # Add a search box to the toolbar (Enter jumps to the next hit)
+        self.search_var = tk.StringVar(self.root)
+        self.search_entry = ttk.Entry(self.toolbar, textvariable=self.search_var, width=20)
+        self.search_entry.pack(side=tk.LEFT, padx=5, pady=5)
+        self.search_entry.bind('<Return>', self.search_document)
+        self.search_status_var = tk.StringVar(self.root)
+        self.search_status_label = ttk.Label(self.toolbar, textvariable=self.search_status_var)
+        self.search_status_label.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Add a zoom selector to the toolbar
+        self.zoom_var = tk.StringVar(self.root)
+        self.zoom_var.set(f"{self.scale_factor:g}x")
+        self.zoom_menu = ttk.Combobox(self.toolbar, textvariable=self.zoom_var, values=[f"{level:g}x" for level in ZOOM_LEVELS], width=5, state="readonly")
+        self.zoom_menu.pack(side=tk.LEFT, padx=5, pady=5)
+        self.zoom_menu.bind("<<ComboboxSelected>>", self.change_zoom)
 
         # Add font selection options
         self.setup_font_options()
@@ -352,17 +4086,42 @@ class PDFStudyAssistant:
         # Setup selection bindings for text selection in the PDF
         self.setup_selection_bindings()
 
+        # Page Up / Page Down turn pages (holding the key repeats quickly, which the
+        # progressive renderer handles by showing previews and dropping stale renders)
+        self.root.bind("<Next>", lambda event: self.next_page())
+        self.root.bind("<Prior>", lambda event: self.prev_page())
+
     def go_to_page(self, event=None):
         try:
             page_num = int(self.current_page_var.get()) - 1  # Convert to 0-based index
             if 0 <= page_num < len(self.current_pdf):
+                self.reading_direction = -1 if page_num < self.current_page else 1
                 self.current_page = page_num
+                self.page_requested_at = time.perf_counter()
                 self.display_page()
             else:
                 messagebox.showwarning("Invalid Page", "Please enter a valid page number.")
         except ValueError:
             messagebox.showwarning("Invalid Input", "Please enter a valid number.")
 
+    def change_zoom(self, event=None):
+        """
+        Changes the zoom level of the PDF viewer.
+
+        This method is called when the user picks a zoom level. The page is shown
+        at the new scale and the scroll position is kept at the same relative place.
+        """
+        scale = float(self.zoom_var.get().rstrip("x"))
+        if scale == self.scale_factor or not self.current_pdf:
+            return
+        x_fraction = self.pdf_canvas.xview()[0]
+        y_fraction = self.pdf_canvas.yview()[0]
+        self.scale_factor = scale
+        self.page_requested_at = time.perf_counter()
+        self.display_page()
+        self.pdf_canvas.xview_moveto(x_fraction)
+        self.pdf_canvas.yview_moveto(y_fraction)
+
 
     def setup_font_options(self):
         """
@@ -467,6 +4226,14 @@ class PDFStudyAssistant:
         if self.selection_start:
             x0, y0 = self.selection_start
             x1, y1 = self.get_adjusted_coords(event.x, event.y)
+            # Snap the rectangle to the boundaries of the words it touches, if the page's
+            # word index is ready (the lookup is a fast spatial index query)
+            page_num, rect = self.canvas_to_page_rect(x0, y0, x1, y1)
+            index = self.word_indexes.get(page_num)
+            if index is not None:
+                bbox = index.bbox(index.query(rect))
+                if bbox:
+                    x0, y0, x1, y1 = self.page_rect_to_canvas(page_num, bbox)
             if self.selection_rectangle:
                 self.pdf_canvas.delete(self.selection_rectangle)
             self.selection_rectangle = self.pdf_canvas.create_rectangle(x0, y0, x1, y1, outline="blue", fill="blue", stipple="gray50")
@@ -485,72 +4252,83 @@ class PDFStudyAssistant:
         if self.selection_start:
             x0, y0 = self.selection_start
             x1, y1 = self.get_adjusted_coords(event.x, event.y)
-            page = self.current_pdf[self.current_page]
-            # Create a rectangle (rect) in PDF coordinates
-            # The scale_factor is used to convert from screen coordinates to PDF coordinates
-            #
-            # PDF coordinates:
-            # - Origin (0,0) is at the bottom-left corner of the page
-            # - Units are typically in points (1/72 of an inch)
-            #
-            # Screen coordinates:
-            # - Origin (0,0) is at the top-left corner of the canvas
-            # - Units are in pixels
-            #
-            # The scale_factor represents the ratio of screen pixels to PDF points
-            # For example, if scale_factor is 2, it means 2 screen pixels = 1 PDF point
-            #
-            # We divide by scale_factor to convert from screen coordinates to PDF coordinates:
-            # PDF_coordinate = screen_coordinate / scale_factor
-            
-            rect = fitz.Rect(
-                min(x0, x1) / self.scale_factor,  # left (convert smaller x to PDF coordinate)
-                min(y0, y1) / self.scale_factor,  # top (convert smaller y to PDF coordinate)
-                max(x0, x1) / self.scale_factor,  # right (convert larger x to PDF coordinate)
-                max(y0, y1) / self.scale_factor   # bottom (convert larger y to PDF coordinate)
-            )
+            # Create a rectangle (rect) in PDF coordinates on the page under the selection
+            # (see canvas_to_page_rect for how screen coordinates are converted)
+            page_num, rect = self.canvas_to_page_rect(x0, y0, x1, y1)
 
             # Debug print
             print(f"Selection rectangle: {rect}")
             print(f"Scale factor: {self.scale_factor}")
             
-            words = page.get_text("words", clip=rect)
-            text_block = page.get_text("block", clip=rect)
-            text_raw = page.get_text("text", clip=rect)
+            # The words come from the page's word index, so nothing is extracted from the PDF
+            index = self.get_word_index(page_num)
+            word_ids = index.query(rect)
 
             # Debug print
-            print(f"Extracted words: {words}")
-            print(f"Extracted text block: {text_block}")
-            print(f"Extracted text raw: {text_raw}")
+            print(f"Selected words: {len(word_ids)}")
             
             
-            selected_text = " ".join(w[4] for w in words)
-            # If no text is extracted, try OCR
+            selected_text = index.text(word_ids)
+            # If no text is extracted (and the page has not been OCRed in the background), OCR
+            # the selected area on a scheduler thread; on_selection_text gets the result
             if not selected_text.strip():
-                # Extract image from the selected area
-                pix = page.get_pixmap(matrix=fitz.Matrix(self.scale_factor, self.scale_factor), clip=rect)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                
-                # Perform OCR on the image
-                selected_text = pytesseract.image_to_string(img)
-            
-            # Debug print
-            print(f"Selected text: '{selected_text}'")
-            
-            if selected_text.strip():
-                self.copy_to_clipboard(selected_text)
-                messagebox.showinfo("Selection", "Text copied to clipboard!")
+                self.submit_selection_ocr(page_num, rect)
             else:
-                 # Try getting text without clipping
-                full_text = page.get_text("text")
-                print(f"Full page text: {full_text[:100]}...")  # Print first 100 characters
-                messagebox.showinfo("Selection", "No text selected.")
+                self.on_selection_text(page_num, selected_text)
 
             self.selection_start = None
             if self.selection_rectangle:
                 self.pdf_canvas.delete(self.selection_rectangle)
                 self.selection_rectangle = None
 
+    def submit_selection_ocr(self, page_num, rect):
+        """
+        OCRs a selected area of a scanned page in the background.
+
+        The area is rendered at the OCR resolution and cleaned up in a worker process
+        (see render_region_for_ocr) and OCRed by the OCR engine on a scheduler thread,
+        so the window stays responsive; the text is handed to on_selection_text with
+        root.after.
+        """
+        render_worker = self.render_worker
+
+        def run(task):
+            started = time.perf_counter()
+            try:
+                img = self.render_region_for_ocr(page_num, tuple(rect))
+                text = self.ocr_engine.image_to_string(img) if img is not None else ""
+            except Exception as e:
+                print(f"Error OCRing the selection: {str(e)}")
+                text = ""
+            print(f"Selection OCR: {(time.perf_counter() - started) * 1000:.0f} ms")
+            if task.cancelled.is_set():
+                return
+
+            def deliver():
+                # (ignore the result if another document has been opened since)
+                if render_worker is self.render_worker:
+                    self.on_selection_text(page_num, text)
+
+            self.root.after(0, deliver)
+
+        self.ai_scheduler.submit(AITask("ocr", None, PRIORITY_INTERACTIVE, run, label=f"OCR selection on page {page_num + 1}"))
+
+    def on_selection_text(self, page_num, selected_text):
+        """
+        Copies the text of a selection to the clipboard (runs on the Tk thread).
+        """
+        # Debug print
+        print(f"Selected text: '{selected_text}'")
+        
+        if selected_text.strip():
+            self.copy_to_clipboard(selected_text)
+            messagebox.showinfo("Selection", "Text copied to clipboard!")
+        else:
+             # Try getting text without clipping
+            full_text = self.page_content.get_text(page_num)
+            print(f"Full page text: {full_text[:100]}...")  # Print first 100 characters
+            messagebox.showinfo("Selection", "No text selected.")
+
 
 
     def copy_selected_text(self):
@@ -591,12 +4369,42 @@ class PDFStudyAssistant:
         """
         try:
             self.current_pdf = fitz.open(file_path)
+            self.current_pdf_path = file_path
+            if self.ocr_job:
+                self.ocr_job.cancel()
+                self.ocr_job = None
+            if self.equation_job:
+                self.equation_job.cancel()
+                self.equation_job = None
+            if self.summary_job:
+                self.summary_job.cancel()
+                self.ai_scheduler.cancel_owner(self.summary_job)
+                self.summary_job = None
+            # Parsed page content shared by all UI-thread rendering and text extraction
+            self.page_content = PageContentCache(self.current_pdf)
             self.current_page = 0
-            self.page_cache = {}
+            self.reading_direction = 1
+            self.page_cache.clear()
+            self.word_indexes.clear()
+            self.search_results = []
+            self.search_query = ""
+            self.search_highlight = None
+            self.page_rects = None
+            self.layout_scale = None
+            self.continuous_mode = False
+            # Start a render process with its own handle on the new document
+            if self.render_worker:
+                self.render_worker.close()
+            try:
+                self.render_worker = PageRenderWorker(file_path, self.on_page_rendered_threadsafe, self.on_words_indexed_threadsafe)
+            except Exception as e:
+                print(f"Error starting render process, rendering on the UI thread: {str(e)}")
+                self.render_worker = None
             self.setup_main_ui()
             self.update_total_pages()
             self.display_page()
             self.submit_pdf_button.config(state=tk.NORMAL)
+            self.start_document_indexing(file_path)
             messagebox.showinfo("Success", "PDF loaded successfully!")
         except Exception as e:
             messagebox.showerror("Error", f"Error loading PDF: {str(e)}")
@@ -631,69 +4439,867 @@ class PDFStudyAssistant:
         Displays the current PDF page on the canvas.
 
         This method is called when the current page is changed or when the
-        PDF is loaded. It renders the PDF page as an image and displays it
-        on the canvas.
+        PDF is loaded. If the page is in the page cache it is shown right away;
+        otherwise a placeholder is shown and the background render process first
+        renders a fast low-resolution preview and then the full-resolution page.
+        Neighbouring pages in the reading direction are prefetched.
+
+        Very large pages (posters, drawings, high zoom levels) are shown in tiles
+        instead, see display_tiled_page. In continuous scroll mode the view is
+        scrolled to the current page instead, see display_continuous.
         """
         if self.current_pdf and self.pdf_canvas:
-            if self.current_page in self.page_cache:
-                photo = self.page_cache[self.current_page]
+            if self.page_requested_at is None:
+                self.page_requested_at = time.perf_counter()
+
+            if self.continuous_mode:
+                self.display_continuous()
+            elif self.render_worker and self.use_tiled_rendering(self.current_page):
+                self.display_tiled_page()
             else:
-                page = self.current_pdf[self.current_page]
-                # Set the scale factor to 2 to increase the resolution of the PDF page
-                self.scale_factor = 2
+                self.tiled_page_key = None
 
-                # Create a high-resolution pixmap (image) of the PDF page
-                # The fitz.Matrix(2, 2) doubles the resolution in both x and y directions
-                pix = page.get_pixmap(matrix=fitz.Matrix(self.scale_factor, self.scale_factor))
+                # Pages are cached per (page, scale) so a different zoom level never shows a stale image
+                cache_key = (self.current_page, self.scale_factor)
+                photo = self.page_cache.get(cache_key)
+                if photo is None and self.render_worker is None:
+                    # No render process available: render on the UI thread
+                    photo = self.render_page(self.current_page, self.scale_factor)
 
-                # Convert the pixmap to a PIL (Python Imaging Library) Image
-                # This step is necessary because Tkinter can't directly use the pixmap
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                if photo is not None:
+                    self.show_page_image(photo)
+                else:
+                    self.show_page_placeholder()
+
+                # Ask the render process for the current page (if needed) and the neighbouring pages
+                self.schedule_page_renders()
+
+            # Update the line numbers displayed alongside the PDF
+            self.update_line_numbers()
+
+            # Update the current page number in the entry widget
+            self.current_page_var.set(str(self.current_page + 1))
+
+            # Update the total pages (in case it has changed)
+            self.total_pages_var.set(f"/ {len(self.current_pdf)}")
+
+    def render_page(self, page_num, scale):
+        """
+        Renders a page on the UI thread and stores it in the page cache.
+
+        This is only used when the background render process is not available.
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        - scale (float): The zoom factor
+
+        Returns:
+        - ImageTk.PhotoImage: The rendered page
+        """
+        # Create a high-resolution pixmap (image) of the PDF page from its cached display list
+        # A scale of 2 doubles the resolution in both x and y directions
+        pix = self.page_content.get_pixmap(page_num, scale)
+
+        # Convert the pixmap to a PIL (Python Imaging Library) Image
+        # This step is necessary because Tkinter can't directly use the pixmap
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+        # Convert the PIL Image to a Tkinter-compatible PhotoImage
+        # This is the format that Tkinter can display on the canvas
+        photo = ImageTk.PhotoImage(img)
+
+        # Store the photo in the page cache for faster access in the future.
+        # Its size in memory is counted as width * height * channels of the pixmap.
+        self.page_cache.put((page_num, scale), photo, pix.width * pix.height * pix.n)
+        return photo
+
+    def schedule_page_renders(self):
+        """
+        Sends the render jobs for the current page and the pages around it to the
+        render process.
+
+        If the current page is not cached, a low-resolution preview of it comes
+        first, then the full-resolution page, then PREFETCH_PAGES pages in the
+        reading direction and one page in the opposite direction. Pages that are
+        already cached are skipped. Jobs from earlier calls that have not started
+        yet are replaced, which cancels the renders of pages the user has left.
+        """
+        if not self.render_worker:
+            return
+        direction = self.reading_direction
+        candidates = [self.current_page]
+        candidates += [self.current_page + direction * i for i in range(1, PREFETCH_PAGES + 1)]
+        candidates.append(self.current_page - direction)
+
+        jobs = []
+        if (self.current_page, self.scale_factor) not in self.page_cache and PREVIEW_SCALE < self.scale_factor:
+            jobs.append(RenderJob(self.current_page, self.scale_factor, preview=True))
+        for page_num in candidates:
+            if 0 <= page_num < len(self.current_pdf) and (page_num, self.scale_factor) not in self.page_cache:
+                # Pages shown in tiles are not prefetched as a whole
+                if page_num != self.current_page and self.use_tiled_rendering(page_num):
+                    continue
+                jobs.append(RenderJob(page_num, self.scale_factor))
+        self.render_worker.submit(jobs + self.word_index_jobs(candidates))
+
+    def use_tiled_rendering(self, page_num):
+        """
+        Returns True if a page is too large to render as a single image at the
+        current zoom level and should be rendered in tiles instead.
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        """
+        rect = self.current_pdf[page_num].rect
+        pixels = rect.width * self.scale_factor * rect.height * self.scale_factor
+        return pixels > TILED_RENDER_MIN_MEGAPIXELS * 1000000
+
+    def display_tiled_page(self):
+        """
+        Shows the current page in tiles.
+
+        The scrollable region is set to the full size of the page at the current
+        zoom level (computed from page.rect, without rendering anything), and only
+        the tiles that intersect the visible part of the canvas are rendered, so
+        memory use and latency depend on the window size rather than the page size.
+        """
+        rect = self.current_pdf[self.current_page].rect
+        self.pdf_canvas.delete("all")
+        self.pdf_canvas.image = None
+        self.tile_items = {}
+        self.tiled_page_key = (self.current_page, self.scale_factor)
+        self.pdf_canvas.config(scrollregion=(0, 0, rect.width * self.scale_factor, rect.height * self.scale_factor))
+        self.draw_search_highlights()
+        self.update_visible_tiles()
+
+    def schedule_view_update(self):
+        """
+        Schedules an update of the visible tiles (for a page shown in tiles) or the
+        visible pages (in continuous scroll mode) once the UI is idle, so a burst of
+        scroll events results in a single update.
+        """
+        if (self.tiled_page_key is not None or self.continuous_mode) and not self.view_update_pending:
+            self.view_update_pending = True
+            self.root.after_idle(self.update_view)
+
+    def update_view(self):
+        self.view_update_pending = False
+        if self.continuous_mode:
+            self.update_visible_pages()
+        else:
+            self.update_visible_tiles()
+
+    def update_visible_tiles(self):
+        """
+        Places the cached tiles that intersect the visible part of the canvas (plus
+        a margin of one tile) and asks the render process for the missing ones,
+        closest to the centre of the view first. Tiles that scrolled out of view
+        are removed from the canvas (they stay in the page cache).
+        """
+        if self.tiled_page_key != (self.current_page, self.scale_factor):
+            return
+        scale = self.scale_factor
+        rect = self.current_pdf[self.current_page].rect
+        page_width = rect.width * scale
+        page_height = rect.height * scale
+
+        # Visible region of the canvas in canvas coordinates, plus a margin of one tile
+        left = self.pdf_canvas.canvasx(0) - TILE_SIZE
+        top = self.pdf_canvas.canvasy(0) - TILE_SIZE
+        right = self.pdf_canvas.canvasx(self.pdf_canvas.winfo_width()) + TILE_SIZE
+        bottom = self.pdf_canvas.canvasy(self.pdf_canvas.winfo_height()) + TILE_SIZE
+        center_x = (left + right) / 2
+        center_y = (top + bottom) / 2
+
+        first_col = max(0, int(left // TILE_SIZE))
+        last_col = min(int((page_width - 1) // TILE_SIZE), int(right // TILE_SIZE))
+        first_row = max(0, int(top // TILE_SIZE))
+        last_row = min(int((page_height - 1) // TILE_SIZE), int(bottom // TILE_SIZE))
+
+        visible = set()
+        missing = []
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                # Tile region in PDF coordinates
+                x0 = col * TILE_SIZE
+                y0 = row * TILE_SIZE
+                x1 = min(x0 + TILE_SIZE, page_width)
+                y1 = min(y0 + TILE_SIZE, page_height)
+                clip = (round(rect.x0 + x0 / scale, 3), round(rect.y0 + y0 / scale, 3),
+                        round(rect.x0 + x1 / scale, 3), round(rect.y0 + y1 / scale, 3))
+                job = RenderJob(self.current_page, scale, clip=clip)
+                visible.add(job.key)
+                if job.key in self.tile_items:
+                    continue
+                if job.key in self.page_cache:
+                    self.place_tile(job, self.page_cache.get(job.key))
+                else:
+                    distance = (x0 + TILE_SIZE / 2 - center_x) ** 2 + (y0 + TILE_SIZE / 2 - center_y) ** 2
+                    missing.append((distance, job))
+
+        # Remove tiles that are no longer near the visible region
+        for key in list(self.tile_items):
+            if key not in visible:
+                self.pdf_canvas.delete(self.tile_items.pop(key))
+
+        missing.sort(key=lambda item: item[0])
+        self.render_worker.submit([job for _, job in missing] + self.word_index_jobs([self.current_page]))
+
+        if not missing and self.page_requested_at is not None:
+            elapsed = time.perf_counter() - self.page_requested_at
+            print(f"Page {self.current_page + 1} tiles shown in {elapsed * 1000:.1f} ms")
+            self.page_requested_at = None
+
+    def place_tile(self, job, photo):
+        """
+        Places a rendered tile on the canvas.
+
+        Parameters:
+        - job (RenderJob): The render job of the tile
+        - photo (ImageTk.PhotoImage): The rendered tile
+        """
+        rect = self.current_pdf[job.page_num].rect
+        x = round((job.clip[0] - rect.x0) * job.scale)
+        y = round((job.clip[1] - rect.y0) * job.scale)
+        item = self.pdf_canvas.create_image(x, y, anchor=tk.NW, image=photo, tags="tile")
+        # Keep selection and highlight rectangles above the tiles
+        self.pdf_canvas.tag_lower(item)
+        self.tile_items[job.key] = item
+
+    def word_index_jobs(self, page_nums):
+        """
+        Returns "words" jobs for the pages (among page_nums) that have no word index yet.
+        They are appended after the render jobs, so indexing never delays a page turn.
+
+        Parameters:
+        - page_nums (iterable): 0-based page numbers
+        """
+        return [RenderJob(page_num, 0, kind="words") for page_num in page_nums
+                if 0 <= page_num < len(self.current_pdf) and page_num not in self.word_indexes]
+
+    def on_words_indexed_threadsafe(self, worker, job, index):
+        # Called on the render dispatcher thread: hand the result over to the Tk thread
+        self.root.after(0, self.on_words_indexed, worker, job, index)
+
+    def on_words_indexed(self, worker, job, index):
+        """
+        Stores a word index built in the background (runs on the Tk thread).
+        """
+        if worker is not self.render_worker:
+            return
+        self.store_word_index(job.page_num, index)
+        if job.page_num == self.current_page:
+            self.update_line_numbers()
+            self.draw_search_highlights()
+
+    def store_word_index(self, page_num, index):
+        # A page without a text layer gets its words from the OCR cache, if it has been OCRed
+        if not len(index):
+            cached = self.get_cached_ocr(page_num)
+            if cached and cached[1]:
+                index = PageWordIndex(cached[1], tuple(self.page_content.display_list(page_num).rect))
+        self.word_indexes[page_num] = index
+        self.word_indexes.move_to_end(page_num)
+        while len(self.word_indexes) > WORD_INDEX_CACHE_PAGES:
+            self.word_indexes.popitem(last=False)
+
+    def get_word_index(self, page_num):
+        """
+        Returns the word index of a page.
+
+        The index is normally built in the background when the page is shown; if it
+        is not ready yet, it is built now from the page's cached text page. Scanned
+        pages use the word boxes from the OCR cache.
+
+        Parameters:
+        - page_num (int): The 0-based page number
+
+        Returns:
+        - PageWordIndex: The word index of the page
+        """
+        index = self.word_indexes.get(page_num)
+        if index is None:
+            index = PageWordIndex(self.page_content.get_words(page_num), tuple(self.page_content.display_list(page_num).rect))
+            self.store_word_index(page_num, index)
+        else:
+            self.word_indexes.move_to_end(page_num)
+        return index
+
+    def get_cached_ocr(self, page_num):
+        """
+        Returns the cached OCR result (text, words) of a page of the current PDF, or
+        None if the page has not been OCRed (or the document fingerprint is not known yet).
+        """
+        if not self.document_fingerprint:
+            return None
+        if self.ocr_cache is None:
+            self.ocr_cache = OCRCache()
+        return self.ocr_cache.get(self.document_fingerprint, page_num)
+
+    def toggle_document_ocr(self):
+        """
+        Starts or stops OCRing all scanned pages of the current PDF in the background.
+
+        This method is called when the user clicks the "OCR Document" button. Pages
+        are OCRed in reading order starting from the current page, and the results
+        are cached on disk, so later selections, submissions and searches read the
+        cached text instead of running Tesseract.
+        """
+        if not self.current_pdf:
+            return
+        if self.ocr_job:
+            self.ocr_job.cancel()
+            self.ocr_job = None
+            self.ocr_button.config(text="OCR Document")
+            return
+
+        def on_page(page_num, done, total):
+            # Called on the OCR job's thread
+            self.root.after(0, self.on_document_ocr_progress, job, page_num, done, total)
+
+        job = DocumentOCRJob(self.current_pdf_path, self.document_fingerprint, start_page=self.current_page, on_page=on_page)
+        self.ocr_job = job
+        self.ocr_button.config(text="Stop OCR")
+        job.start()
+
+    def on_document_ocr_progress(self, job, page_num, done, total):
+        """
+        Receives progress from the background OCR job (runs on the Tk thread).
+        """
+        if job is not self.ocr_job:
+            return
+        if self.document_fingerprint is None:
+            self.document_fingerprint = job.fingerprint
+        # The page's word index may have been built before its OCR result existed
+        self.word_indexes.pop(page_num, None)
+        if page_num == self.current_page:
+            self.update_line_numbers()
+        self.ocr_button.config(text=f"Stop OCR ({done}/{total})")
+        if done == total:
+            self.ocr_job = None
+            self.ocr_button.config(text="OCR Document")
+
+    def ask_page_range(self, title):
+        """
+        Asks the user for a range of pages, starting with the current page.
+
+        Returns:
+        - list or None: 0-based page numbers, or None if the user cancelled
+        """
+        text = simpledialog.askstring(title, "Pages (e.g. 3, 3-7 or 1-2, 5):", initialvalue=str(self.current_page + 1), parent=self.root)
+        if not text:
+            return None
+        try:
+            return parse_page_range(text, len(self.current_pdf))
+        except ValueError as e:
+            messagebox.showerror(title, f"Invalid page range: {str(e)}")
+            return None
+
+    def toggle_equation_extraction(self):
+        """
+        Starts or stops finding the equations on a range of pages and converting
+        them to LaTeX in the background.
+
+        This method is called when the user clicks the "Find Equations" button.
+        Equation regions are found from the text layer (math fonts) and image blocks,
+        recognised by the LaTeX OCR worker in batches and cached on disk, so they
+        can be exported with "Export Equations".
+        """
+        if not self.current_pdf:
+            return
+        if self.equation_job:
+            self.equation_job.cancel()
+            self.equation_job = None
+            self.equations_button.config(text="Find Equations")
+            return
+        pages = self.ask_page_range("Find Equations")
+        if not pages:
+            return
+
+        def on_progress(page_num, done, total, converted):
+            # Called on the extraction job's thread
+            self.root.after(0, self.on_equation_progress, job, page_num, done, total, converted)
+
+        job = EquationExtractionJob(self.current_pdf_path, self.document_fingerprint, pages, self.latex_worker, on_progress)
+        self.equation_job = job
+        self.equations_button.config(text="Stop Equations")
+        job.start()
+
+    def on_equation_progress(self, job, page_num, done, total, converted):
+        """
+        Receives progress from the equation extraction job (runs on the Tk thread).
+        """
+        if job is not self.equation_job:
+            return
+        if self.document_fingerprint is None:
+            self.document_fingerprint = job.fingerprint
+        if page_num is not None:
+            self.equations_button.config(text=f"Stop Equations ({done}/{total})")
+            return
+        self.equation_job = None
+        self.equations_button.config(text="Find Equations")
+        summary = f"{converted} equations converted on {done} of {total} pages."
+        if job.equations_per_minute:
+            summary += f" ({job.equations_per_minute:.1f} equations/min)"
+        messagebox.showinfo("Find Equations", summary)
+
+    def export_equations(self):
+        """
+        Exports the cached equations of a range of pages to a .tex file.
+
+        This method is called when the user clicks the "Export Equations" button.
+        Pages whose equations have not been found yet are reported to the user.
+        """
+        if not self.current_pdf:
+            return
+        if not self.document_fingerprint:
+            messagebox.showinfo("Export Equations", "The document is still being indexed, please try again in a moment.")
+            return
+        pages = self.ask_page_range("Export Equations")
+        if not pages:
+            return
+        if self.equation_cache is None:
+            self.equation_cache = EquationCache()
+        scanned = self.equation_cache.scanned_pages(self.document_fingerprint)
+        missing = [page_num + 1 for page_num in pages if page_num not in scanned]
+        if missing:
+            messagebox.showinfo("Export Equations", f"Use \"Find Equations\" on these pages first: {', '.join(map(str, missing))}")
+            return
+        equations = [(page_num, rect, latex) for page_num in pages
+                     for rect, latex in self.equation_cache.get_page(self.document_fingerprint, page_num)]
+        if not equations:
+            messagebox.showinfo("Export Equations", "No equations were found on these pages.")
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".tex", filetypes=[("LaTeX files", "*.tex")])
+        if path:
+            export_equations_tex(path, equations, title=os.path.basename(self.current_pdf_path))
+            messagebox.showinfo("Export Equations", f"{len(equations)} equations exported to {path}")
+
+    def on_page_rendered_threadsafe(self, worker, job, img):
+        # Called on the render dispatcher thread: hand the result over to the Tk thread
+        self.root.after(0, self.on_page_rendered, worker, job, img)
+
+    def on_page_rendered(self, worker, job, img):
+        """
+        Receives a page rendered by the render process (runs on the Tk thread).
+
+        The image is wrapped in a PhotoImage, stored in the page cache and shown if
+        it is the page the user is looking at.
+
+        Parameters:
+        - worker (PageRenderWorker): The worker that rendered the page
+        - job (RenderJob): The finished render job
+        - img (PIL.Image): The rendered page
+        """
+        # Ignore results for a document that has since been replaced
+        if worker is not self.render_worker:
+            return
+        if job.clip is not None:
+            # A tile of a page shown in tiles
+            photo = ImageTk.PhotoImage(img)
+            self.page_cache.put(job.key, photo, img.width * img.height * len(img.getbands()))
+            if (job.page_num, job.scale) == self.tiled_page_key and job.key not in self.tile_items:
+                self.place_tile(job, photo)
+                self.schedule_view_update()
+            return
+        if self.continuous_mode:
+            # Previews are not used in continuous scroll mode
+            if not job.preview:
+                photo = ImageTk.PhotoImage(img)
+                self.page_cache.put(job.key, photo, img.width * img.height * len(img.getbands()))
+                slot = self.page_slots.get(job.page_num)
+                if slot and job.scale == self.layout_scale:
+                    self.set_slot_image(job.page_num, slot, photo)
+            return
+        if job.preview:
+            # Previews are not cached; only show them if the user is still on the page
+            # and the full-resolution page has not arrived yet
+            full_key = (job.page_num, job.scale)
+            if full_key == (self.current_page, self.scale_factor) and full_key not in self.page_cache:
+                self.show_page_image(ImageTk.PhotoImage(img), preview=True)
+            return
+        photo = ImageTk.PhotoImage(img)
+        self.page_cache.put(job.key, photo, img.width * img.height * len(img.getbands()))
+        if job.key == (self.current_page, self.scale_factor):
+            self.show_page_image(photo)
+
+    def show_page_image(self, photo, preview=False):
+        """
+        Shows a rendered page on the canvas.
+
+        Parameters:
+        - photo (ImageTk.PhotoImage): The rendered page
+        - preview (bool): Whether the image is a low-resolution preview
+        """
+        # Clear any existing content on the PDF canvas
+        self.pdf_canvas.delete("all")
+
+        # Set the scrollable region of the canvas to match the size of the photo
+        # This ensures that scrollbars appear if the image is larger than the canvas
+        self.pdf_canvas.config(scrollregion=(0, 0, photo.width(), photo.height()))
+
+        # Place the photo on the canvas at the top-left corner (0, 0)
+        # 'anchor=tk.NW' means the image's northwest (top-left) corner will be at (0, 0)
+        self.pdf_canvas.create_image(0, 0, anchor=tk.NW, image=photo)
+
+        # Store a reference to the photo in the canvas object
+        # This prevents the image from being garbage collected by Python
+        self.pdf_canvas.image = photo
+
+        self.draw_search_highlights()
+
+        # Report the time from the navigation request until the page was shown
+        if self.page_requested_at is not None:
+            elapsed = time.perf_counter() - self.page_requested_at
+            if preview:
+                print(f"Page {self.current_page + 1} preview shown in {elapsed * 1000:.1f} ms")
+            else:
+                print(f"Page {self.current_page + 1} shown in {elapsed * 1000:.1f} ms")
+                self.page_requested_at = None
+
+    def show_page_placeholder(self):
+        """
+        Shows a placeholder while the current page is being rendered.
+        """
+        self.pdf_canvas.delete("all")
+        self.pdf_canvas.create_text(20, 20, anchor=tk.NW, text=f"Rendering page {self.current_page + 1}...", fill="gray")
+        self.pdf_canvas.image = None
+
+    def toggle_continuous_mode(self):
+        """
+        Toggles between showing one page at a time and continuous scrolling
+        through all pages.
+
+        This method is called when the user clicks the "Continuous Scroll" button.
+        """
+        if not self.current_pdf:
+            return
+        self.continuous_mode = not self.continuous_mode
+        self.continuous_button.config(text="Single Page" if self.continuous_mode else "Continuous Scroll")
+        self.pdf_canvas.delete("all")
+        self.pdf_canvas.image = None
+        self.tiled_page_key = None
+        self.tile_items = {}
+        self.layout_scale = None
+        self.page_slots = {}
+        self.free_page_slots = []
+        self.page_requested_at = time.perf_counter()
+        self.display_page()
+
+    def layout_pages(self):
+        """
+        Computes the position of every page for continuous scroll mode.
+
+        The layout only uses the page sizes (page.rect), so nothing is rendered.
+        The page rects are read once per document and reused for every zoom level.
+        """
+        if self.page_rects is None:
+            self.page_rects = [page.rect for page in self.current_pdf]
+        scale = self.scale_factor
+        self.page_offsets = []
+        y = 0
+        width = 0
+        for rect in self.page_rects:
+            self.page_offsets.append(y)
+            y += rect.height * scale + CONTINUOUS_PAGE_GAP
+            width = max(width, rect.width * scale)
+        self.layout_height = max(1, y - CONTINUOUS_PAGE_GAP)
+        self.layout_scale = scale
+
+        # Drop the canvas items of the previous layout
+        self.pdf_canvas.delete("all")
+        self.pdf_canvas.image = None
+        self.page_slots = {}
+        self.free_page_slots = []
+        self.pdf_canvas.config(scrollregion=(0, 0, width, self.layout_height))
+
+    def display_continuous(self):
+        """
+        Scrolls the continuous view to the current page.
+        """
+        if self.layout_scale != self.scale_factor:
+            self.layout_pages()
+        self.pdf_canvas.yview_moveto(self.page_offsets[self.current_page] / self.layout_height)
+        self.update_visible_pages()
+        self.draw_search_highlights()
+
+    def update_visible_pages(self):
+        """
+        Shows the pages that intersect the viewport (plus a margin of one viewport
+        height above and below) in continuous scroll mode.
+
+        Pages that scrolled out of range give their canvas items back to a pool,
+        and missing pages are requested from the render process, closest to the
+        viewport first. Only a small, constant number of pages is ever kept on the
+        canvas, however long the document is.
+        """
+        if not self.continuous_mode or self.layout_scale != self.scale_factor:
+            return
+        top = self.pdf_canvas.canvasy(0)
+        height = self.pdf_canvas.winfo_height()
+        bottom = top + height
+
+        # Find the range of pages near the viewport with a binary search on the page offsets
+        first = max(0, bisect.bisect_right(self.page_offsets, top - height) - 1)
+        last = min(len(self.page_offsets) - 1, max(first, bisect.bisect_right(self.page_offsets, bottom + height) - 1))
+
+        # Recycle the slots of pages that are no longer near the viewport
+        for page_num in list(self.page_slots):
+            if page_num < first or page_num > last:
+                slot = self.page_slots.pop(page_num)
+                self.pdf_canvas.itemconfigure(slot["frame"], state=tk.HIDDEN)
+                self.pdf_canvas.itemconfigure(slot["image"], image="", state=tk.HIDDEN)
+                slot["photo"] = None
+                self.free_page_slots.append(slot)
+
+        missing = []
+        for page_num in range(first, last + 1):
+            slot = self.page_slots.get(page_num)
+            if slot is None:
+                slot = self.acquire_page_slot(page_num)
+            key = (page_num, self.scale_factor)
+            if slot["photo"] is None:
+                if key in self.page_cache:
+                    self.set_slot_image(page_num, slot, self.page_cache.get(key))
+                else:
+                    center = self.page_offsets[page_num] + self.page_rects[page_num].height * self.scale_factor / 2
+                    missing.append((abs(center - (top + bottom) / 2), RenderJob(page_num, self.scale_factor)))
+        if self.render_worker:
+            missing.sort(key=lambda item: item[0])
+            self.render_worker.submit([job for _, job in missing] + self.word_index_jobs(range(first, last + 1)))
+        else:
+            for _, job in missing:
+                self.set_slot_image(job.page_num, self.page_slots[job.page_num], self.render_page(job.page_num, job.scale))
+
+        # The current page is the one at the upper third of the viewport
+        page_num = max(0, bisect.bisect_right(self.page_offsets, top + height / 3) - 1)
+        if page_num != self.current_page:
+            self.reading_direction = 1 if page_num > self.current_page else -1
+            self.current_page = page_num
+            self.current_page_var.set(str(self.current_page + 1))
+            self.update_line_numbers()
+
+    def acquire_page_slot(self, page_num):
+        """
+        Returns the canvas items (a page frame and an image) used to show a page in
+        continuous scroll mode, reusing a free slot if there is one.
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        """
+        if self.free_page_slots:
+            slot = self.free_page_slots.pop()
+        else:
+            slot = {
+                "frame": self.pdf_canvas.create_rectangle(0, 0, 0, 0, outline="gray", fill="#f0f0f0"),
+                "image": self.pdf_canvas.create_image(0, 0, anchor=tk.NW),
+                "photo": None,
+            }
+            # Keep the pages below selection and highlight rectangles
+            self.pdf_canvas.tag_lower(slot["image"])
+            self.pdf_canvas.tag_lower(slot["frame"])
+        rect = self.page_rects[page_num]
+        y = self.page_offsets[page_num]
+        self.pdf_canvas.coords(slot["frame"], 0, y, rect.width * self.scale_factor, y + rect.height * self.scale_factor)
+        self.pdf_canvas.coords(slot["image"], 0, y)
+        self.pdf_canvas.itemconfigure(slot["frame"], state=tk.NORMAL)
+        self.pdf_canvas.itemconfigure(slot["image"], state=tk.NORMAL)
+        self.page_slots[page_num] = slot
+        return slot
+
+    def set_slot_image(self, page_num, slot, photo):
+        """
+        Shows a rendered page in its slot in continuous scroll mode.
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        - slot (dict): The canvas items of the page
+        - photo (ImageTk.PhotoImage): The rendered page
+        """
+        # The slot keeps a reference to the photo so it is not garbage collected
+        # while it is shown, even if the page cache evicts it
+        slot["photo"] = photo
+        self.pdf_canvas.itemconfigure(slot["image"], image=photo)
+        if page_num == self.current_page and self.page_requested_at is not None:
+            elapsed = time.perf_counter() - self.page_requested_at
+            print(f"Page {page_num + 1} shown in {elapsed * 1000:.1f} ms")
+            self.page_requested_at = None
+
+    def canvas_to_page_rect(self, x0, y0, x1, y1):
+        """
+        Converts a rectangle drawn on the canvas to a page number and a rectangle
+        in PDF coordinates on that page.
+
+        PDF coordinates:
+        - Origin (0,0) is at the top-left corner of the page (as used by PyMuPDF)
+        - Units are points (1/72 of an inch)
+
+        Canvas coordinates:
+        - Origin (0,0) is at the top-left corner of the canvas
+        - Units are pixels
 
-                # Convert the PIL Image to a Tkinter-compatible PhotoImage
-                # This is the format that Tkinter can display on the canvas
-                photo = ImageTk.PhotoImage(img)
+        The scale_factor represents the ratio of screen pixels to PDF points.
+        For example, if scale_factor is 2, it means 2 screen pixels = 1 PDF point,
+        so we divide by scale_factor to convert: PDF_coordinate = canvas_coordinate / scale_factor.
+        In continuous scroll mode the page is the one under the top of the rectangle,
+        and the page's offset is subtracted first.
 
-                # Store the photo in the page cache for faster access in the future
-                self.page_cache[self.current_page] = photo
+        Parameters:
+        - x0, y0, x1, y1 (float): Two corners of the rectangle in canvas coordinates
 
-            # Clear any existing content on the PDF canvas
-            self.pdf_canvas.delete("all")
+        Returns:
+        - tuple: (page number, fitz.Rect)
+        """
+        page_num = self.current_page
+        offset = 0
+        if self.continuous_mode and self.page_offsets:
+            page_num = max(0, bisect.bisect_right(self.page_offsets, min(y0, y1)) - 1)
+            offset = self.page_offsets[page_num]
+        rect = fitz.Rect(
+            min(x0, x1) / self.scale_factor,             # left (convert smaller x to PDF coordinate)
+            (min(y0, y1) - offset) / self.scale_factor,  # top (convert smaller y to PDF coordinate)
+            max(x0, x1) / self.scale_factor,             # right (convert larger x to PDF coordinate)
+            (max(y0, y1) - offset) / self.scale_factor   # bottom (convert larger y to PDF coordinate)
+        )
+        return page_num, rect
+
+    def start_document_indexing(self, file_path):
+        """
+        Starts building (or reusing) the full-text search index of a PDF in a
+        background process.
 
-            # Set the scrollable region of the canvas to match the size of the photo
-            # This ensures that scrollbars appear if the image is larger than the canvas
-            self.pdf_canvas.config(scrollregion=(0, 0, photo.width(), photo.height()))
+        Parameters:
+        - file_path (str): The path to the PDF file
+        """
+        if self.index_process and self.index_process.is_alive():
+            self.index_process.terminate()
+        self.document_fingerprint = None
+        self.search_status_var.set("Indexing...")
+
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(target=_index_document_process, args=(file_path, SEARCH_INDEX_PATH, child_conn), daemon=True)
+        process.start()
+        child_conn.close()
+        self.index_process = process
+
+        def watch():
+            # Forward progress messages to the Tk thread until the process finishes
+            while True:
+                try:
+                    message = parent_conn.recv()
+                except (EOFError, OSError):
+                    break
+                self.root.after(0, self.on_index_progress, process, message)
+            parent_conn.close()
+
+        threading.Thread(target=watch, daemon=True).start()
+
+    def on_index_progress(self, process, message):
+        """
+        Receives a progress message from the indexing process (runs on the Tk thread).
+        """
+        if process is not self.index_process:
+            return
+        if message[0] in ("fingerprint", "done"):
+            self.document_fingerprint = message[1]
+        if message[0] == "progress":
+            self.search_status_var.set(f"Indexing {message[1]}/{message[2]}")
+        elif message[0] == "done":
+            self.search_status_var.set("Index reused" if message[2] else "Index ready")
+
+    def search_document(self, event=None):
+        """
+        Searches the current PDF and jumps to the next hit.
 
-            # Place the photo on the canvas at the top-left corner (0, 0)
-            # 'anchor=tk.NW' means the image's northwest (top-left) corner will be at (0, 0)
-            self.pdf_canvas.create_image(0, 0, anchor=tk.NW, image=photo)
+        This method is called when the user presses Enter in the search box. A new
+        query jumps to the best-ranked page; pressing Enter again with the same query
+        moves to the next hit. The matching words are highlighted on the page.
+        """
+        query = self.search_var.get().strip()
+        if not query or not self.current_pdf:
+            return
+        if not self.document_fingerprint:
+            self.search_status_var.set("Index not ready yet")
+            return
+        if query != self.search_query:
+            if self.search_index is None:
+                self.search_index = DocumentSearchIndex()
+            started = time.perf_counter()
+            self.search_results = self.search_index.search(self.document_fingerprint, query)
+            print(f"Search for '{query}': {len(self.search_results)} hits in {(time.perf_counter() - started) * 1000:.1f} ms")
+            self.search_query = query
+            self.search_position = 0
+        else:
+            self.search_position += 1
 
-            # Store a reference to the photo in the canvas object
-            # This prevents the image from being garbage collected by Python
-            self.pdf_canvas.image = photo
+        if not self.search_results:
+            self.search_status_var.set("No hits")
+            self.search_highlight = None
+            return
+        self.search_position %= len(self.search_results)
+        page_num, _, snippet = self.search_results[self.search_position]
+        print(f"Search hit on page {page_num + 1}: {snippet}")
+        self.search_status_var.set(f"Hit {self.search_position + 1}/{len(self.search_results)} (p. {page_num + 1})")
+        self.search_highlight = (page_num, [term.lower() for term in re.findall(r"\w+", query)])
+        self.reading_direction = -1 if page_num < self.current_page else 1
+        self.current_page = page_num
+        self.page_requested_at = time.perf_counter()
+        self.display_page()
+
+    def draw_search_highlights(self):
+        """
+        Draws boxes around the words of the current search on the page that is
+        being shown (the last query word may match as a prefix, like the search).
+        """
+        self.pdf_canvas.delete("search_hit")
+        if not self.search_highlight or self.search_highlight[0] != self.current_page:
+            return
+        page_num, terms = self.search_highlight
+        # The word index is built in the background; the hits are drawn when it arrives (see on_words_indexed)
+        index = self.word_indexes.get(page_num)
+        if index is None:
+            if self.render_worker:
+                return
+            index = self.get_word_index(page_num)
+        else:
+            self.word_indexes.move_to_end(page_num)
+        for word_id in index.match(terms, prefix=terms[-1] if terms else None):
+            x0, y0, x1, y1 = self.page_rect_to_canvas(page_num, index.boxes[word_id])
+            self.pdf_canvas.create_rectangle(x0, y0, x1, y1, outline="orange", width=2, tags="search_hit")
 
-            # Update the line numbers displayed alongside the PDF
-            self.update_line_numbers()
+    def page_rect_to_canvas(self, page_num, rect):
+        """
+        Converts a rectangle in PDF coordinates on a page to canvas coordinates
+        (the inverse of canvas_to_page_rect).
 
-            # Update the current page number in the entry widget
-            self.current_page_var.set(str(self.current_page + 1))
+        Parameters:
+        - page_num (int): The 0-based page number
+        - rect (tuple): The rectangle (x0, y0, x1, y1) in PDF coordinates
 
-            # Update the total pages (in case it has changed)
-            self.total_pages_var.set(f"/ {len(self.current_pdf)}")
+        Returns:
+        - tuple: The rectangle (x0, y0, x1, y1) in canvas coordinates
+        """
+        offset = self.page_offsets[page_num] if self.continuous_mode and self.page_offsets else 0
+        x0, y0, x1, y1 = rect
+        return (x0 * self.scale_factor, y0 * self.scale_factor + offset,
+                x1 * self.scale_factor, y1 * self.scale_factor + offset)
 
     def update_line_numbers(self):
         """
         Updates the line numbers for the current PDF page.
 
-        This method is called when the current page is changed or when the
-        PDF is loaded. It extracts the text from the PDF page and displays
-        the line numbers on the left side of the PDF viewer.
+        This method is called when the current page is changed, when the
+        PDF is loaded and when the page's word index arrives from the
+        background. The number of lines comes from the word index, so no text
+        is extracted on the UI thread; until the index is ready the gutter is empty.
         """
         # Update line numbers for the current page
-        page = self.current_pdf[self.current_page]
-        text = page.get_text("text")
-        lines = text.split('\n')
-        line_numbers = '\n'.join(str(i) for i in range(1, len(lines) + 1))
+        index = self.word_indexes.get(self.current_page)
+        line_count = index.line_count if index is not None else 0
+        if index is None and not self.render_worker:
+            line_count = self.get_word_index(self.current_page).line_count
+        line_numbers = '\n'.join(str(i) for i in range(1, line_count + 1))
         self.line_numbers.config(state='normal')
         self.line_numbers.delete('1.0', tk.END)
         self.line_numbers.insert('1.0', line_numbers)
@@ -759,12 +5365,12 @@ class PDFStudyAssistant:
 
     def end_highlight(self, event):
         """
-        Ends the text highlighting process and submits the highlighted text.
+        Ends the text highlighting process and starts LaTeX recognition.
 
         This method is called when the user releases the mouse button after
-        highlighting text in the PDF viewer. It extracts the highlighted text
-        and submits it to the AI for analysis. If the highlighted area contains
-        a mathematical equation, it attempts to convert it to LaTeX.
+        highlighting text in the PDF viewer. The highlighted area is sent to the
+        LaTeX OCR worker; the result is handled by on_latex_recognized, so the
+        window stays responsive while the model runs.
 
         Parameters:
         - event (tk.Event): The mouse button release event
@@ -772,40 +5378,60 @@ class PDFStudyAssistant:
         if self.highlight_start:
             x0, y0 = self.highlight_start
             x1, y1 = self.get_adjusted_coords(event.x, event.y)
-            page = self.current_pdf[self.current_page]
-            rect = fitz.Rect(min(x0, x1)/self.scale_factor, min(y0, y1)/self.scale_factor, 
-                            max(x0, x1)/self.scale_factor, max(y0, y1)/self.scale_factor)
+            page_num, rect = self.canvas_to_page_rect(x0, y0, x1, y1)
             
-            # Extract image from the highlighted area
-            pix = page.get_pixmap(matrix=fitz.Matrix(self.scale_factor, self.scale_factor), clip=rect)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+            # Extract image from the highlighted area (rendered from the page's cached display list)
+            pix = self.page_content.get_pixmap(page_num, self.scale_factor, clip=rect)
+
+            # Convert to grayscale and crop the blank margins so pix2tex only sees the equation
+            img, _, timings = preprocess_for_ocr(pix, 72 * self.scale_factor, target_dpi=None, binarize=False)
+            print("LaTeX preprocessing: " + ", ".join(f"{stage} {ms:.1f} ms" for stage, ms in timings.items()))
+            if img is None:
+                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
             
-            try:
-                # Convert to LaTeX
-                latex = self.latex_ocr(img)
-                
-                if latex:
-                    self.highlighted_text = f"${latex}$"
-                    self.copy_to_clipboard(self.highlighted_text)
-                    messagebox.showinfo("Highlight", "LaTeX expression copied to clipboard!")
-                else:
-                    # If LaTeX conversion fails, fall back to text extraction
-                    words = page.get_text("words", clip=rect)
-                    self.highlighted_text = " ".join(w[4] for w in words)
-                    self.copy_to_clipboard(self.highlighted_text)
-                    messagebox.showinfo("Highlight", "Text copied to clipboard!")
-            except Exception as e:
-                print(f"Error in LaTeX conversion: {str(e)}")
-                # Fall back to text extraction
-                words = page.get_text("words", clip=rect)
-                self.highlighted_text = " ".join(w[4] for w in words)
-                self.copy_to_clipboard(self.highlighted_text)
-                messagebox.showinfo("Highlight", "Error in LaTeX conversion. Copied as text.")
+            # Convert to LaTeX in the worker process; the result arrives on the worker's
+            # dispatcher thread and is handed over to the Tk thread with root.after
+            render_worker = self.render_worker
+            self.latex_worker.submit(img, lambda latex, error: self.root.after(
+                0, self.on_latex_recognized, render_worker, page_num, rect, latex, error), urgent=True)
 
             self.highlight_start = None
-            if self.highlight_rectangle:
-                self.pdf_canvas.delete(self.highlight_rectangle)
-                self.highlight_rectangle = None
+
+    def on_latex_recognized(self, render_worker, page_num, rect, latex, error):
+        """
+        Handles the result of LaTeX recognition for a highlight (called on the Tk thread).
+
+        The LaTeX expression is copied to the clipboard. If recognition failed, the
+        text of the highlighted area is copied instead.
+
+        Parameters:
+        - render_worker (PageRenderWorker): The render worker when the highlight was made,
+          used to ignore results for a document that has been closed since
+        - page_num (int): The highlighted page
+        - rect (fitz.Rect): The highlighted area in PDF coordinates
+        - latex (str or None): The recognised LaTeX expression
+        - error (str or None): Why recognition failed
+        """
+        if self.highlight_rectangle:
+            self.pdf_canvas.delete(self.highlight_rectangle)
+            self.highlight_rectangle = None
+        if render_worker is not self.render_worker:
+            return
+
+        if latex:
+            self.highlighted_text = f"${latex}$"
+            self.copy_to_clipboard(self.highlighted_text)
+            messagebox.showinfo("Highlight", "LaTeX expression copied to clipboard!")
+        else:
+            # If LaTeX conversion fails, fall back to the text from the page's word index
+            index = self.get_word_index(page_num)
+            self.highlighted_text = index.text(index.query(rect))
+            self.copy_to_clipboard(self.highlighted_text)
+            if error:
+                print(f"Error in LaTeX conversion: {error}")
+                messagebox.showinfo("Highlight", "Error in LaTeX conversion. Copied as text.")
+            else:
+                messagebox.showinfo("Highlight", "Text copied to clipboard!")
 
         if self.highlighted_text:
             self.submit_highlight_button.config(state=tk.NORMAL)
@@ -828,64 +5454,106 @@ class PDFStudyAssistant:
         """
         # Submit highlighted text to AI for analysis
         if self.highlighted_text:
-            self.ai_queue.put(("highlight", self.highlighted_text))
+            self.submit_ai_task("highlight", self.highlighted_text)
             self.highlighted_text = ""
             self.submit_highlight_button.config(state=tk.DISABLED)
 
     def submit_pdf_to_ai(self):
         """
-        Submits the entire PDF content to the AI for analysis.
-
-        This method extracts text from the current page and the last two pages (if available)
-        of the PDF and submits it to the AI for analysis. It uses OCR for scanned or
-        photographed pages.
+        Asks a question about the PDF and submits it to the AI with the relevant parts
+        of the document.
+
+        The parts of the whole document that best match the question are found with
+        the retrieval index (see RetrievalIndex) on the AI thread and sent with page
+        numbers, so the AI can cite them. Without a question, the text of the current
+        page is used to find related parts. The current page's text is also sent, and
+        is used on its own if the document has not been indexed yet (it is OCRed if
+        it is a scanned page).
         """
         if self.current_pdf:
-            total_pages = len(self.current_pdf)
-            pages_to_submit = []
-
-            # Add the current page
-            pages_to_submit.append(self.current_page)
-
-            # Add the last two pages if they exist and are different from the current page
-            if total_pages > 1:
-                if self.current_page != total_pages - 1:
-                    pages_to_submit.append(total_pages - 1)
-                if total_pages > 2 and self.current_page != total_pages - 2:
-                    pages_to_submit.append(total_pages - 2)
-
-            # Remove duplicates and sort
-            pages_to_submit = sorted(set(pages_to_submit))
-
-            full_text = ""
-            for page_num in pages_to_submit:
-                page = self.current_pdf[page_num]
-                
-                # Try to get text using PyMuPDF
-                page_text = page.get_text()
-                
-                # If no text is extracted, use OCR
-                if not page_text.strip():
-                    # Convert page to image
-                    pix = page.get_pixmap()
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    
-                    # Perform OCR
-                    page_text = pytesseract.image_to_string(img)
-                
-                full_text += f"Page {page_num + 1}:\n{page_text}\n\n"
-
-            # Truncate the text if it's too long
-            max_chars = 8000  # Adjust this value as needed
-            if len(full_text) > max_chars:
-                full_text = full_text[:max_chars] + "... [truncated]"
-
-            self.ai_queue.put(("pdf", full_text))
-            messagebox.showinfo("PDF Submitted", "The content of the current page and the last two pages (if available) has been submitted to the AI for analysis.")
+            question = simpledialog.askstring("Submit PDF to AI", "What would you like to know about this PDF?\n"
+                                              "(Leave empty to discuss the current page.)", parent=self.root)
+            if question is None:
+                return
+            page_num = self.current_page
+
+            # Try to get text using PyMuPDF (from the page's cached text page)
+            page_text = self.page_content.get_text(page_num)
+
+            # If no text is extracted, use the cached OCR text (see "OCR Document")
+            if not page_text.strip():
+                cached = self.get_cached_ocr(page_num)
+                if cached:
+                    page_text = cached[0]
+
+            # If there is still no text, the page is OCRed on the AI thread (see page_dump)
+            self.submit_ai_task("pdf", (question.strip(), (page_num, page_text if page_text.strip() else None)))
+            messagebox.showinfo("PDF Submitted", "Your question and the relevant parts of the PDF have been submitted to the AI for analysis.")
         else:
             messagebox.showerror("Error", "No PDF is currently loaded.")
 
 
+    def toggle_document_summary(self):
+        """
+        Starts or stops summarising the whole PDF in the background.
+
+        This method is called when the user clicks the "Summarize PDF" button. The
+        document is summarised section by section with several AI requests at a time,
+        then chapter by chapter (see DocumentSummaryJob). Progress and chapter
+        summaries appear in the chat as they are ready, and the summary is cached,
+        so summarising the same PDF again is instant.
+        """
+        if not self.current_pdf:
+            messagebox.showerror("Error", "No PDF is currently loaded.")
+            return
+        if self.summary_job:
+            self.summary_job.cancel()
+            self.ai_scheduler.cancel_owner(self.summary_job)
+            self.summary_job = None
+            self.summary_button.config(text="Summarize PDF")
+            self.update_chat_history("Summary stopped.\n")
+            return
+        search_index = self.search_index or DocumentSearchIndex()
+        self.search_index = search_index
+        if not self.document_fingerprint or not search_index.is_complete(self.document_fingerprint):
+            messagebox.showinfo("Summarize PDF", "The document is still being indexed, please try again in a moment.")
+            return
+
+        def on_progress(kind, text):
+            # Called on the summary job's threads
+            self.root.after(0, self.on_summary_progress, job, kind, text)
+
+        # The summary's requests go through the AI scheduler as background tasks, so
+        # chat messages and highlights are answered first
+        job = DocumentSummaryJob(self.document_fingerprint, search_index.page_texts(self.document_fingerprint),
+                                 toc=self.current_pdf.get_toc(), on_progress=on_progress,
+                                 complete=lambda messages, max_retries: self.scheduled_completion(messages, max_retries, owner=job))
+        self.summary_job = job
+        self.summary_button.config(text="Stop Summary")
+        job.start()
+
+    def on_summary_progress(self, job, kind, text):
+        """
+        Shows the progress of the summary job in the chat (runs on the Tk thread).
+        """
+        if job is not self.summary_job:
+            return
+        if kind == "status":
+            self.update_chat_history(f"Summary: {text}\n")
+        elif kind == "chapter":
+            self.update_chat_history(f"Chapter summary - {text}\n")
+        else:
+            self.summary_job = None
+            self.summary_button.config(text="Summarize PDF")
+            if kind == "error":
+                self.update_chat_history(f"Error: {text}\n")
+            else:
+                self.update_chat_history(f"Document summary:\n{text}\n")
+                # Let follow-up questions refer to the summary (added between answers, see submit_ai_task)
+                self.ai_scheduler.submit(AITask("summary", None, PRIORITY_INTERACTIVE,
+                                                lambda task: self.conversation.add("assistant", f"Summary of the document:\n{text}"),
+                                                label="add the document summary to the conversation", serial="conversation"))
+
     def send_message(self):
         """
         Sends a user message to the AI.
@@ -897,26 +5565,16 @@ class PDFStudyAssistant:
         user_message = self.user_input.get()
         self.update_chat_history(f"You: {user_message}\n")
         
+        # /chat and /search go over the network, so they run on the AI scheduler's
+        # threads like AI requests (see command_worker) and the window stays responsive
         if user_message.startswith("/chat "):
             query = user_message[6:]  # Remove "/chat " from the beginning
-            try:
-                response = self.ddgs.chat(query, model=self.chat_model)
-                self.update_chat_history(f"DuckDuckGo AI: {response}\n")
-            except Exception as e:
-                error_message = f"Error in DuckDuckGo chat: {str(e)}"
-                self.update_chat_history(f"Error: {error_message}\n")
-
-
+            self.submit_ai_task("chat", query)
         elif user_message.startswith("/search "):
             query = user_message[8:]  # Remove "/search " from the beginning
-            search_results = self.perform_web_search(query)
-            result_text = "Search Results:\n"
-            for result in search_results:
-                result_text += f"- {result['title']}: {result['href']}\n"
-            self.update_chat_history(result_text)
-            self.ai_queue.put(("search", result_text))
+            self.submit_ai_task("web_search", query)
         else:
-            self.ai_queue.put(("message", user_message))
+            self.submit_ai_task("message", user_message)
         
         self.user_input.delete(0, tk.END)
 
@@ -934,25 +5592,180 @@ class PDFStudyAssistant:
         """
         # Update chat history with new messages
         self.chat_history.config(state='normal')
-    
+        self.insert_chat_content(tk.END, message)
+        self.chat_history.insert(tk.END, '\n')
+        self.chat_history.config(state='disabled')
+        self.chat_history.see(tk.END)
+
+    def insert_chat_content(self, index, message):
+        """
+        Inserts text into the chat history, showing $$...$$ blocks as rendered equations.
+
+        The chat history must be in the 'normal' state.
+
+        Parameters:
+        - index (str): Where to insert (a text index or mark, e.g. tk.END)
+        - message (str): The text; it must not end inside a $$ block
+        """
         # Split the message into parts
         parts = message.split('$$')
         
         for i, part in enumerate(parts):
                 if i % 2 == 0:
                     # Regular text
-                    self.chat_history.insert(tk.END, part)
+                    self.chat_history.insert(index, part)
                 else:
-                    # LaTeX content
-                    latex_image = render_latex(part)
-                    self.chat_history.image_create(tk.END, image=latex_image)
-                    # Keep a reference to prevent garbage collection
-                    self.chat_history.images.append(latex_image)
-        
-        self.chat_history.insert(tk.END, '\n')
+                    # LaTeX content: show cached equations right away; the others get a
+                    # placeholder that is replaced when the background renderer is done
+                    cached = latex_renderer.cached(part)
+                    if cached is not None:
+                        self.insert_chat_image(index, ImageTk.PhotoImage(cached))
+                    else:
+                        self.latex_placeholder_count += 1
+                        tag = f"latex_{self.latex_placeholder_count}"
+                        self.chat_history.insert(index, "[rendering equation...]", (tag,))
+                        latex_renderer.render_async(part, 12, 100, lambda img, error, tag=tag, latex=part: self.root.after(
+                            0, self.on_latex_rendered, tag, latex, img, error))
+
+    def begin_ai_stream(self, stream):
+        """
+        Starts showing a streaming AI answer in the chat history (runs on the Tk thread).
+
+        The answer is inserted at the stream's own text mark, so messages (and other
+        answers) added to the chat while it is still arriving don't end up in the
+        middle of it.
+
+        Parameters:
+        - stream (ChatStream): The state of the answer
+        """
+        self.chat_history.config(state='normal')
+        self.chat_history.insert(tk.END, "AI: \n")
+        # (the mark sits before the newline just inserted, and moves along as text is inserted at it)
+        self.chat_history.mark_set(stream.mark, "end-2c")
+        self.chat_history.mark_gravity(stream.mark, tk.RIGHT)
+        self.chat_history.config(state='disabled')
+        self.chat_history.see(tk.END)
+        stream.active = True
+
+    def queue_stream_delta(self, stream, text):
+        """
+        Adds a piece of a streaming AI answer (called on the AI thread).
+
+        Pieces are collected and drawn together by flush_ai_stream at most every
+        STREAM_REFRESH_MS milliseconds, instead of redrawing the chat for every token.
+        """
+        with stream.lock:
+            stream.received = True
+            stream.pending.append(text)
+            if stream.flush_scheduled:
+                return
+            stream.flush_scheduled = True
+        self.root.after(STREAM_REFRESH_MS, self.flush_ai_stream, stream)
+
+    def flush_ai_stream(self, stream, final=False):
+        """
+        Draws the pieces of the streaming AI answer that have arrived (runs on the Tk thread).
+
+        An equation is only drawn once its closing $$ has arrived; until then the
+        text from its opening $$ on is held back.
+
+        Parameters:
+        - stream (ChatStream): The state of the answer
+        - final (bool): Draw everything, including an equation that was never closed
+        """
+        with stream.lock:
+            text = stream.tail + "".join(stream.pending)
+            stream.pending = []
+            stream.flush_scheduled = False
+        if not stream.active:
+            return
+        if final:
+            cut = len(text)
+        elif text.count("$$") % 2:
+            # An equation is still open: hold it back
+            cut = text.rfind("$$")
+        elif text.endswith("$"):
+            # This may be the first half of a $$
+            cut = len(text) - 1
+        else:
+            cut = len(text)
+        ready, stream.tail = text[:cut], text[cut:]
+        if not ready:
+            return
+        unclosed = ""
+        if ready.count("$$") % 2:
+            # Only at the end: show an equation that was never closed as plain text
+            ready, unclosed = ready[:ready.rfind("$$")], ready[ready.rfind("$$"):]
+        self.chat_history.config(state='normal')
+        self.insert_chat_content(stream.mark, ready)
+        self.chat_history.insert(stream.mark, unclosed)
+        self.chat_history.config(state='disabled')
+        self.chat_history.see(tk.END)
+
+    def end_ai_stream(self, stream, response, stats):
+        """
+        Finishes a streaming AI answer and shows its timing (runs on the Tk thread).
+
+        Parameters:
+        - stream (ChatStream): The state of the answer
+        - response (str): The full answer (shown now if nothing was streamed, e.g. an error)
+        - stats (dict or None): Timing from completion_stream
+        """
+        self.flush_ai_stream(stream, final=True)
+        stream.active = False
+        self.chat_history.config(state='normal')
+        if stats is None:
+            # Pieces that were streamed (like " [cancelled]" for a request cancelled before
+            # its first token) are already shown
+            if not stream.received:
+                self.insert_chat_content(stream.mark, response)
+        elif "cached" in stats:
+            cache_stats = get_response_cache().stats()
+            summary = f"cached answer ({stats['cached']} match), cache hit rate {cache_stats['hit_rate']:.0%}"
+            print(f"AI response: {summary}")
+            self.chat_history.insert(stream.mark, f"\n({summary})", ("stream_stats",))
+            self.chat_history.tag_configure("stream_stats", foreground="gray")
+        else:
+            summary = f"first token after {stats['first_token']:.2f} s, {stats['tokens_per_second']:.1f} tokens/s"
+            print(f"AI response: {stats['tokens']} tokens, {summary}")
+            self.chat_history.insert(stream.mark, f"\n({summary})", ("stream_stats",))
+            self.chat_history.tag_configure("stream_stats", foreground="gray")
+        self.chat_history.mark_unset(stream.mark)
         self.chat_history.config(state='disabled')
         self.chat_history.see(tk.END)
 
+    def insert_chat_image(self, index, photo):
+        """
+        Inserts an image into the chat history at a text index.
+        """
+        self.chat_history.image_create(index, image=photo)
+        # Keep a reference to prevent garbage collection
+        self.chat_history.images.append(photo)
+
+    def on_latex_rendered(self, tag, latex, img, error):
+        """
+        Replaces the placeholder of an equation in the chat history with the rendered
+        image, or with the LaTeX source if it could not be rendered (runs on the Tk thread).
+
+        Parameters:
+        - tag (str): The text tag of the placeholder
+        - latex (str): The LaTeX source
+        - img (PIL.Image or None): The rendered equation
+        - error (str or None): Why rendering failed
+        """
+        ranges = self.chat_history.tag_ranges(tag)
+        if not ranges:
+            return
+        self.chat_history.config(state='normal')
+        start, end = ranges[0], ranges[1]
+        self.chat_history.delete(start, end)
+        if img is not None:
+            self.insert_chat_image(start, ImageTk.PhotoImage(img))
+        else:
+            print(f"Error rendering LaTeX: {error}")
+            self.chat_history.insert(start, f"$${latex}$$")
+        self.chat_history.config(state='disabled')
+
     def toggle_ai_panel(self):
         """
         Toggles the visibility of the AI chat panel.
@@ -979,6 +5792,8 @@ class PDFStudyAssistant:
         # Go to previous page of PDF
         if self.current_page > 0:
             self.current_page -= 1
+            self.reading_direction = -1
+            self.page_requested_at = time.perf_counter()
             self.display_page()
 
     def next_page(self):
@@ -991,6 +5806,8 @@ class PDFStudyAssistant:
         # Go to next page of PDF
         if self.current_pdf and self.current_page < len(self.current_pdf) - 1:
             self.current_page += 1
+            self.reading_direction = 1
+            self.page_requested_at = time.perf_counter()
             self.display_page()
 
     def on_mousewheel(self, event):
@@ -1018,112 +5835,534 @@ class PDFStudyAssistant:
 
     def start_ai_thread(self):
         """
-        Starts a separate thread for AI processing.
+        Starts the AI task scheduler.
 
-        This method creates and starts a daemon thread that runs the ai_worker
-        function, allowing AI processing to occur in the background without
-        blocking the main UI thread.
+        The scheduler runs AI tasks on background threads (at most AI_CONCURRENCY at
+        a time, of which at most AI_BACKGROUND_CONCURRENCY are document jobs), so AI
+        processing never blocks the main UI thread.
         """
-        threading.Thread(target=self.ai_worker, daemon=True).start()
+        self.ai_scheduler = AIScheduler(on_change=self.on_ai_scheduler_change)
 
-    def ai_worker(self):
+    def submit_ai_task(self, kind, content):
         """
-        Worker function for the AI processing thread.
+        Queues a task for the AI.
 
-        This function runs in a separate thread and continuously processes
-        tasks from the AI queue. It handles different types of tasks (highlight,
-        message, pdf) and updates the chat history with AI responses.
+        Chat messages, web searches and DuckDuckGo chats get the interactive priority,
+        highlights and questions about the PDF the highlight priority, so a quick
+        question is never stuck behind a long analysis. The tasks that add turns to the
+        conversation (see ai_worker) run one at a time, in the order they were sent, so
+        every answer is built on its own question.
+
+        Parameters:
+        - kind (str): "message", "search", "highlight" or "pdf" (see ai_worker), or
+          "chat" or "web_search" for the /chat and /search commands (see command_worker)
+        - content: The task's input
         """
-        while True:
-            # Get a task from the queue
-            task_type, content = self.ai_queue.get()
-            
+        priority = PRIORITY_INTERACTIVE if kind in ("message", "search", "chat", "web_search") else PRIORITY_HIGHLIGHT
+        run = self.command_worker if kind in ("chat", "web_search") else self.ai_worker
+        text = content[0] if kind == "pdf" else content
+        label = f"{kind}: {text[:40]}" + ("..." if len(text) > 40 else "")
+        serial = None if kind in ("chat", "web_search") else "conversation"
+        return self.ai_scheduler.submit(AITask(kind, content, priority, run, label=label, serial=serial))
+
+    def scheduled_completion(self, messages, max_retries=3, owner=None):
+        """
+        Runs a completion() request as a background-priority task of the AI scheduler
+        and waits for the result (called on a document job's threads).
+
+        Returns:
+        - str: The response, or an error message if the task was cancelled
+        """
+        result = []
+        task = AITask("background", None, PRIORITY_BACKGROUND,
+                      lambda task: result.append(completion(messages, max_retries=max_retries)),
+                      label="document summary request", owner=owner)
+        self.ai_scheduler.submit(task)
+        task.done.wait()
+        if not result:
+            return "Error: Request cancelled"
+        return result[0]
+
+    def on_ai_scheduler_change(self):
+        # Called on any thread: update the readout on the Tk thread (at most once per event loop pass)
+        if not self.ai_status_update_pending:
+            self.ai_status_update_pending = True
+            self.root.after(0, self.update_ai_status)
+
+    def update_ai_status(self):
+        """
+        Shows the number of running and queued AI tasks and the waiting times.
+        """
+        self.ai_status_update_pending = False
+        if not hasattr(self, "ai_status_var"):
+            return
+        stats = self.ai_scheduler.stats()
+        queued = sum(stats["queued"].values())
+        cache_text = ""
+        if _response_cache is not None:
+            cache_stats = _response_cache.stats()
+            cache_text = (f", cache {cache_stats['hit_rate']:.0%} hits ({cache_stats['exact_hits']} exact, "
+                          f"{cache_stats['near_hits']} near, {cache_stats['misses']} misses)")
+        if not stats["running"] and not queued:
+            self.ai_status_var.set(f"AI: idle (avg wait {stats['average_wait']:.1f} s){cache_text}")
+            return
+        parts = ", ".join(f"{count} {name}" for name, count in stats["queued"].items() if count)
+        text = f"AI: {stats['running']} running, {queued} queued"
+        if queued:
+            text += f" ({parts}), longest wait {stats['longest_wait']:.1f} s"
+        self.ai_status_var.set(text + f", avg wait {stats['average_wait']:.1f} s{cache_text}")
+        if queued:
+            # Keep the waiting time current while tasks are waiting
+            self.root.after(1000, self.on_ai_scheduler_change)
+
+    def show_cancel_menu(self):
+        """
+        Shows a menu of the running and queued AI tasks, to cancel one or all of them.
+        """
+        menu = tk.Menu(self.root, tearoff=0)
+        tasks = self.ai_scheduler.tasks()
+        for task in tasks:
+            state = "Running" if task.started_at is not None else "Queued"
+            menu.add_command(label=f"{state}: {task.label}", command=lambda task=task: self.cancel_ai_task(task))
+        if tasks:
+            menu.add_separator()
+            menu.add_command(label="Cancel all", command=lambda: self.cancel_ai_tasks(tasks))
+        else:
+            menu.add_command(label="No AI tasks", state=tk.DISABLED)
+        menu.tk_popup(self.cancel_ai_button.winfo_rootx(), self.cancel_ai_button.winfo_rooty())
+
+    def cancel_ai_task(self, task):
+        self.ai_scheduler.cancel(task)
+        if task.owner is None:
+            self.update_chat_history(f"Cancelled {task.label}\n")
+
+    def cancel_ai_tasks(self, tasks):
+        for task in tasks:
+            self.cancel_ai_task(task)
+
+    def command_worker(self, task):
+        """
+        Runs a /chat or /search command (runs on a scheduler thread).
+
+        The result is posted to the chat history with root.after, together with how
+        long the request took. The results of a /search are then given to the AI.
+
+        Parameters:
+        - task (AITask): A "chat" task (content is the message for DuckDuckGo AI) or
+          a "web_search" task (content is the search query)
+        """
+        started = time.perf_counter()
+        if task.kind == "chat":
             try:
-                # Process the task based on its type
-                if task_type == "highlight":
-                    self.messages.append({"role": "user", "content": f"Analyze this highlighted text: {content}"})
-                elif task_type == "message":
-                    self.messages.append({"role": "user", "content": content})
-                elif task_type == "pdf":
-                    self.messages.append({"role": "user", "content": f"Here's the full content of the PDF: {content[:9000]}... [truncated]"})
-                elif task_type == "search":
-                    self.messages.append({"role": "user", "content": f"Here are the search results: {content}"})
-            
-                # Get the AI's response
-                response = completion(self.messages)
-                self.messages.append({"role": "assistant", "content": response})
-            
-                # Check if the AI response contains a search command
-                if "/search" in response:
-                    search_query = response.split("/search", 1)[1].strip()
-                    search_results = self.perform_web_search(search_query)
-                    
-                    if search_results:
-                        result_text = "AI-initiated Search Results:\n"
-                        for result in search_results:
-                            if isinstance(result, dict) and 'title' in result and 'href' in result:
-                                result_text += f"- {result['title']}: {result['href']}\n"
-                            else:
-                                result_text += f"- {str(result)}\n"
-                        self.root.after(0, self.update_chat_history, result_text)
-                        self.messages.append({"role": "user", "content": result_text})
-                        response += f"\n\nI've performed a search for '{search_query}'. Here are the results:\n{result_text}"
-                    else:
-                        no_results_message = f"No results found for the search query: '{search_query}'"
-                        self.root.after(0, self.update_chat_history, no_results_message)
-                        self.messages.append({"role": "user", "content": no_results_message})
-                        response += f"\n\n{no_results_message}"
-            
-                # Update the chat history in the main thread
-                self.root.after(0, self.update_chat_history, f"AI: {response}\n")
-            
+                # A DuckDuckGo chat remembers the conversation, so a failed message is not retried
+                response = io_layer.run(io_layer.call_blocking(
+                    self.ddgs.chat, task.content, model=self.chat_model, retries=1, what="DuckDuckGo chat"))
+                message = f"DuckDuckGo AI ({time.perf_counter() - started:.1f} s): {response}\n"
             except Exception as e:
-                error_message = f"An unexpected error occurred: {str(e)}"
-                self.root.after(0, self.update_chat_history, f"AI: {error_message}\n")
-            
-            # Mark the task as done
-            self.ai_queue.task_done()
+                message = f"Error: Error in DuckDuckGo chat: {str(e)}\n"
+            if not task.cancelled.is_set():
+                self.root.after(0, self.update_chat_history, message)
+            return
+
+        search_results, bundle, pages_read = self.research_web(task.content)
+        elapsed = time.perf_counter() - started
+        print(f"Web search: {len(search_results)} results in {elapsed:.2f} s")
+        if task.cancelled.is_set():
+            return
+        result_lines = ""
+        for result in search_results:
+            result_lines += f"- {result['title']}: {result['href']}\n"
+        self.root.after(0, self.update_chat_history, f"Search Results ({elapsed:.1f} s, {pages_read} pages read):\n{result_lines}")
+        result_text = f"Search Results:\n{result_lines}"
+        if bundle:
+            result_text += f"\nExcerpts from the result pages:\n\n{bundle}\n"
+        self.submit_ai_task("search", result_text)
+
+    def ai_worker(self, task):
+        """
+        Processes one AI task (runs on a scheduler thread).
+
+        It handles the different types of tasks (highlight, message, pdf, search) and
+        streams the AI response into the chat history. The AI may call tools (see
+        AI_TOOLS) before it answers: the calls of each round run at the same time
+        (see run_tool_calls), their results are sent back, and the time of every call
+        is shown in the chat.
+
+        Parameters:
+        - task (AITask): The task; its kind and content say what to do
+        """
+        task_type, content = task.kind, task.content
+        cache_key = None
+        try:
+            # Process the task based on its type
+            # (Document text is passed as an excerpt, so it is kept when old turns are summarised)
+            if task_type == "highlight":
+                self.conversation.add("user", f"Analyze this highlighted text: {content}", excerpt=f"Highlighted text: {content}")
+                # Cached under the highlighted text only; nearly the same highlight is a hit too
+                cache_key = {"prompt": content, "scope": self.document_fingerprint or ""}
+            elif task_type == "message":
+                # Questions about the open PDF get the relevant parts of the document
+                excerpts = self.retrieve_excerpts(content)
+                if excerpts:
+                    self.conversation.add("user", f"Relevant excerpts from the PDF:\n\n{excerpts}\n\n{content}\n"
+                                                  "(Cite the pages you use, like (p. 3).)", excerpt=excerpts)
+                else:
+                    self.conversation.add("user", content)
+            elif task_type == "pdf":
+                question, page = content
+                page_text = self.page_dump(page)
+                excerpts = self.retrieve_excerpts(question or page_text)
+                # (page_text starts with "Page N:")
+                if excerpts:
+                    excerpt = f"Current page:\n{page_text}\nRelevant excerpts from the PDF:\n\n{excerpts}"
+                else:
+                    excerpt = f"Current page:\n{page_text}"
+                question = question or "Please explain the current page."
+                self.conversation.add("user", f"{excerpt}\n\n{question}\n(Cite the pages you use, like (p. 3).)", excerpt=excerpt)
+                # Cached under the question, within the document and page: the page text would make
+                # any two questions about it look alike, so only exactly the same question is a hit
+                page_hash = hashlib.sha256(page_text.encode("utf-8")).hexdigest()
+                cache_key = {"prompt": question, "scope": f"{self.document_fingerprint or ''}:{page_hash}", "near": False}
+            elif task_type == "search":
+                self.conversation.add("user", f"Here are the search results: {content}")
+        
+            # Answer, letting the AI call tools (see AI_TOOLS) for up to TOOL_MAX_ITERATIONS
+            # rounds; the tool calls and their results are only kept for this answer
+            messages = self.conversation.build_messages()
+            tool_turns = []
+            steps = []  # (round, tool name, seconds) of every tool call, for the timing report
+            # Analyses of document text (highlights and PDF questions) are cached, so the
+            # same passage asked about again is answered instantly; chat depends on the
+            # conversation and is always sent
+            use_cache = cache_key is not None
+            for iteration in range(TOOL_MAX_ITERATIONS + 1):
+                # Stream the AI's response into the chat history as it is generated
+                stream = ChatStream(f"ai_stream_{task.id}_{iteration}")
+                self.root.after(0, self.begin_ai_stream, stream)
+                calls = []
+                response, stats = completion_stream(messages + tool_turns,
+                                                    lambda text, stream=stream: self.queue_stream_delta(stream, text),
+                                                    cancelled=task.cancelled, use_cache=use_cache and not tool_turns, cache_key=cache_key,
+                                                    tools=AI_TOOLS,
+                                                    tool_choice="none" if iteration == TOOL_MAX_ITERATIONS else "auto",
+                                                    tool_calls=calls)
+                if not calls or task.cancelled.is_set():
+                    self.root.after(0, self.end_ai_stream, stream, response, stats)
+                    break
+                self.root.after(0, self.end_ai_stream, stream, response or "(using tools)", stats)
+
+                # Run the tool calls of this round at the same time and send back their results
+                started = time.perf_counter()
+                results = run_tool_calls(calls, self.tool_handlers(), self.tool_executor)
+                tool_turns.append({"role": "assistant", "content": response or None, "tool_calls": [
+                    {"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": call["arguments"]}}
+                    for call in calls]})
+                timings = []
+                for call, result, seconds in results:
+                    tool_turns.append({"role": "tool", "tool_call_id": call["id"], "content": result})
+                    steps.append((iteration + 1, call["name"], seconds))
+                    timings.append(f"{call['name']}({call['arguments'][:60]}) {seconds:.2f} s")
+                report = f"Tools, round {iteration + 1} ({time.perf_counter() - started:.2f} s): " + ", ".join(timings)
+                print(report)
+                self.root.after(0, self.update_chat_history, report)
+                if task.cancelled.is_set():
+                    break
+
+            if steps:
+                # (An answer that used tools is not cached: its web results may be out of date next time)
+                print(f"Tool use: {len(steps)} calls in {max(step[0] for step in steps)} rounds, "
+                      f"{sum(step[2] for step in steps):.2f} s of tool time")
+            self.conversation.add("assistant", response)
+        
+        except Exception as e:
+            error_message = f"An unexpected error occurred: {str(e)}"
+            self.root.after(0, self.update_chat_history, f"AI: {error_message}\n")
+
+
+    def page_dump(self, page, max_chars=8000):
+        """
+        Returns the text of the page sent with a question about the PDF (runs on the AI thread).
+
+        Parameters:
+        - page (tuple): (page number, text), where text is None for a scanned page that
+          has not been OCRed; the page is then OCRed now (see render_region_for_ocr)
+        - max_chars (int): Longer text is truncated
+
+        Returns:
+        - str: The text of the page, starting with "Page N:"
+        """
+        page_num, page_text = page
+        if page_text is None:
+            try:
+                img = self.render_region_for_ocr(page_num)
+                # Perform OCR with the warm OCR engine
+                page_text = self.ocr_engine.image_to_string(img) if img is not None else ""
+            except Exception as e:
+                print(f"Error OCRing page {page_num + 1}: {str(e)}")
+                page_text = ""
+        full_text = f"Page {page_num + 1}:\n{page_text}\n\n"
+
+        # Truncate the text if it's too long
+        if len(full_text) > max_chars:
+            full_text = full_text[:max_chars] + "... [truncated]"
+        return full_text
+
+    def render_region_for_ocr(self, page_num, clip=None, dpi=OCR_TARGET_DPI, binarize=True, timeout=None):
+        """
+        Renders a page of the current PDF, or a region of it, and prepares it for OCR in
+        the region render process (see _render_region_task), and waits for the result
+        (runs on a background thread).
+
+        Parameters:
+        - page_num (int): The 0-based page number
+        - clip (tuple or None): Optional (x0, y0, x1, y1) region in PDF coordinates
+        - dpi (float): The resolution to render at
+        - binarize (bool): Whether to binarise the image
+        - timeout (float or None): Seconds to wait for the image (TimeoutError is raised after that)
+
+        Returns:
+        - PIL.Image or None: The prepared image, or None if the region is blank
+        """
+        with self.region_executor_lock:
+            if self.region_executor is None:
+                # A single warm process that keeps the documents open between requests
+                context = multiprocessing.get_context("spawn")
+                self.region_executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            executor = self.region_executor
+        future = executor.submit(_render_region_task, self.current_pdf_path, page_num, dpi, clip, binarize)
+        try:
+            result = future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+        if result is None:
+            return None
+        mode, width, height, pixels = result
+        return Image.frombytes(mode, (width, height), pixels)
+
+    def retrieve_excerpts(self, query):
+        """
+        Finds the parts of the current PDF that are relevant to a query (runs on the AI thread).
+
+        Parameters:
+        - query (str): The question or text to match
 
+        Returns:
+        - str or None: The best chunks, each labelled with its page, or None if no
+          PDF is open, it has not been indexed yet or nothing matches
+        """
+        fingerprint = self.document_fingerprint
+        if not fingerprint or not query.strip():
+            return None
+        if self.retrieval_index is None or self.retrieval_index.fingerprint != fingerprint:
+            self.retrieval_index = RetrievalIndex.open(fingerprint)
+            if self.retrieval_index is None:
+                print("Retrieval: the document is still being indexed, sending the current page only")
+                return None
+        started = time.perf_counter()
+        results = self.retrieval_index.search(query)
+        print(f"Retrieval: {len(results)} chunks in {(time.perf_counter() - started) * 1000:.1f} ms "
+              f"(pages {', '.join(str(page_num + 1) for page_num, _, _ in results)})")
+        if not results:
+            return None
+        return "\n\n".join(f"[Page {page_num + 1}] {text}" for page_num, _, text in results)
 
-    def perform_web_search(self, query, max_results=5):
+    def perform_web_search(self, query, max_results=5, timeout=None):
         #Performs a web search using DuckDuckGo and returns the results.
         
         """Args:
             query (str): The search query.
             max_results (int): Maximum number of results to return.
+            timeout (float or None): Seconds the search may take.
         
         Returns:
             list: A list of dictionaries containing search results.
        """
         try:
-            with DDGS() as ddgs:
-                results = list(ddgs.text(query, max_results=max_results))
+            # Results of the same search in the last WEB_CACHE_TTL seconds are reused
+            results = self.web_cache.get_search(query, max_results)
+            if results is not None:
+                print(f"Web search: cached results for '{query}'")
+                return results
+            # The shared DuckDuckGo client keeps its connections open between searches, and
+            # the search runs under the network layer's limiter and retry rules
+            results = io_layer.run(io_layer.call_blocking(
+                lambda: list(self.ddgs.text(query, max_results=max_results)), what="web search"), timeout)
             
             if not results:
                 return [{"title": "No results found", "href": ""}]
             
+            self.web_cache.put_search(query, max_results, results)
             return results
         except Exception as e:
             print(f"Error performing web search: {str(e)}")
             return [{"title": f"Error performing web search: {str(e)}", "href": ""}]
     
-    def convert_to_latex(self, text):
+    def research_web(self, query, max_pages=WEB_FETCH_PAGES, deadline=None):
         """
-        Attempts to convert text to LaTeX using pix2tex.
+        Searches the web and reads the top results (runs on a scheduler thread).
+
+        The pages of the first max_pages results are downloaded at the same time
+        (see fetch_pages), or taken from the web cache, and their text is turned into
+        a compact bundle of excerpts for the AI (see build_excerpt_bundle).
 
         Parameters:
-        - text (str): The text to convert
+        - query (str): The search query
+        - max_pages (int): Number of result pages to read
+        - deadline (float or None): time.monotonic() time by which the search and the
+          downloads must be finished (see run_tool_calls)
 
         Returns:
-        - str or None: The LaTeX string if conversion was successful, None otherwise
+        - tuple: (search results, excerpt bundle or "", number of pages read)
         """
-        try:
-            latex = self.latex_ocr(text)
-            if latex and latex != text:  # If conversion successful and different from input
-                return latex
-        except Exception as e:
-            print(f"Error converting text to LaTeX: {str(e)}")
-        return None
+        results = self.perform_web_search(query, timeout=time_left(deadline) if deadline else None)
+        urls = []
+        for result in results:
+            href = result.get("href", "")
+            if href.startswith(("http://", "https://")) and href not in urls:
+                urls.append(href)
+        urls = urls[:max(0, max_pages)]
+        if not urls:
+            return results, "", 0
+        started = time.perf_counter()
+        pages = self.web_cache.get_pages(urls)
+        missing = [url for url in urls if url not in pages]
+        if missing:
+            fetched = fetch_pages(missing, timeout=min(WEB_FETCH_TIMEOUT, time_left(deadline)) if deadline else WEB_FETCH_TIMEOUT)
+            self.web_cache.put_pages(fetched)
+            pages.update(fetched)
+        bundle = build_excerpt_bundle(results, pages)
+        print(f"Web pages: {len(pages)} of {len(urls)} read ({len(urls) - len(missing)} cached) in "
+              f"{time.perf_counter() - started:.2f} s, {len(bundle)} characters of excerpts")
+        return results, bundle, len(pages)
+
+    def run_on_ui_thread(self, func, *args, timeout=30):
+        """
+        Runs a function on the Tk thread and waits for its result (called on a
+        background thread, e.g. by an AI tool that reads the open PDF, since the
+        document may only be used on the Tk thread). Exceptions raised by func are
+        raised here.
+        """
+        done = threading.Event()
+        outcome = []
+
+        def run():
+            try:
+                outcome.append((True, func(*args)))
+            except Exception as e:
+                outcome.append((False, e))
+            finally:
+                done.set()
+
+        self.root.after(0, run)
+        if not done.wait(timeout):
+            raise TimeoutError("the window did not respond in time")
+        succeeded, value = outcome[0]
+        if not succeeded:
+            raise value
+        return value
+
+    def tool_handlers(self):
+        """
+        Returns the functions that carry out the AI's tool calls (see AI_TOOLS), by tool name.
+        """
+        return {
+            "web_search": self.tool_web_search,
+            "fetch_page": self.tool_fetch_page,
+            "read_pdf_page": self.tool_read_pdf_page,
+            "ocr_region": self.tool_ocr_region,
+            "latex_region": self.tool_latex_region,
+        }
+
+    # The tool handlers run on the tool threads and wait at most until their deadline (see run_tool_calls)
+
+    def tool_web_search(self, deadline, query):
+        results, bundle, _ = self.research_web(query, deadline=deadline)
+        text = "\n".join(f"[{number}] {result.get('title', '')}: {result.get('href', '')}" for number, result in enumerate(results, 1))
+        if bundle:
+            text += f"\n\nExcerpts from the result pages:\n\n{bundle}"
+        return text
+
+    def tool_fetch_page(self, deadline, url):
+        if not url.startswith(("http://", "https://")):
+            raise ValueError("only http and https addresses can be read")
+        pages = self.web_cache.get_pages([url])
+        if not pages:
+            pages = fetch_pages([url], timeout=min(WEB_FETCH_TIMEOUT, time_left(deadline)))
+            self.web_cache.put_pages(pages)
+        if url not in pages:
+            return "The page could not be read (it is not a web page, or the request failed)."
+        title, paragraphs = pages[url]
+        return f"{title}\n\n" + "\n\n".join(paragraphs)
+
+    def tool_read_pdf_page(self, deadline, page):
+        text = self.run_on_ui_thread(self.read_page_text, int(page) - 1, timeout=time_left(deadline))
+        if text is None:
+            # A scanned page that has not been OCRed yet
+            img = self.render_region_for_ocr(int(page) - 1, timeout=time_left(deadline))
+            text = self.ocr_engine.image_to_string(img) if img is not None else ""
+        return f"Page {page}:\n{text.strip() or '(the page has no text)'}"
+
+    def tool_ocr_region(self, deadline, page, left, top, right, bottom):
+        clip = self.run_on_ui_thread(self.page_region_rect, int(page) - 1, (left, top, right, bottom), timeout=time_left(deadline))
+        img = self.render_region_for_ocr(int(page) - 1, clip, timeout=time_left(deadline))
+        if img is None:
+            return "The region is blank."
+        return self.ocr_engine.image_to_string(img).strip() or "No text was found in the region."
+
+    def tool_latex_region(self, deadline, page, left, top, right, bottom):
+        clip = self.run_on_ui_thread(self.page_region_rect, int(page) - 1, (left, top, right, bottom), timeout=time_left(deadline))
+        img = self.render_region_for_ocr(int(page) - 1, clip, dpi=72 * EQUATION_RENDER_SCALE, binarize=False,
+                                         timeout=time_left(deadline))
+        if img is None:
+            return "The region is blank."
+        latex = self.latex_worker.recognize(img, timeout=time_left(deadline))
+        return f"$${latex}$$" if latex else "No equation could be recognised in the region."
+
+    def check_page_number(self, page_num):
+        # Raises a ValueError the AI can act on if there is no such page in the open PDF
+        if not self.current_pdf:
+            raise ValueError("no PDF is open")
+        if not 0 <= page_num < len(self.current_pdf):
+            raise ValueError(f"the PDF has pages 1 to {len(self.current_pdf)}")
+
+    def read_page_text(self, page_num):
+        """
+        Returns the text of a page of the open PDF for the read_pdf_page tool (runs on
+        the Tk thread).
+
+        Returns:
+        - str or None: The text, or None for a scanned page that has not been OCRed
+          yet (it is then OCRed on the tool's thread)
+        """
+        self.check_page_number(page_num)
+        text = self.page_content.get_text(page_num)
+        if not text.strip():
+            cached = self.get_cached_ocr(page_num)
+            if cached:
+                text = cached[0]
+        return text if text.strip() else None
+
+    def page_region_rect(self, page_num, box):
+        """
+        Converts a region of a page given by the ocr_region and latex_region tools to
+        PDF coordinates (runs on the Tk thread).
+
+        Parameters:
+        - page_num (int): The page (starting at 0)
+        - box (tuple): (left, top, right, bottom) as fractions of the page's width and height
+
+        Returns:
+        - tuple: (x0, y0, x1, y1) in PDF coordinates
+        """
+        self.check_page_number(page_num)
+        left, top, right, bottom = (min(1.0, max(0.0, float(value))) for value in box)
+        page_rect = self.current_pdf[page_num].rect
+        clip = fitz.Rect(page_rect.x0 + left * page_rect.width, page_rect.y0 + top * page_rect.height,
+                         page_rect.x0 + right * page_rect.width, page_rect.y0 + bottom * page_rect.height)
+        if clip.is_empty:
+            raise ValueError("the region is empty (right must be more than left, and bottom more than top)")
+        return tuple(clip)
 
     def convert_image_to_latex(self, image):
         """
@@ -1136,10 +6375,8 @@ class PDFStudyAssistant:
         - str or None: The LaTeX string if conversion was successful, None otherwise
         """
         try:
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
-            return self.latex_ocr(img_byte_arr)
+            # The worker process receives the raw pixels, so no PNG encoding is needed
+            return self.latex_worker.recognize(image)
         except Exception as e:
             print(f"Error converting image to LaTeX: {str(e)}")
             return None
@@ -1147,31 +6384,134 @@ class PDFStudyAssistant:
 
 
 
+class LatexRenderer:
+    """
+    Renders LaTeX math to images for the chat history, with an LRU cache and a
+    background thread.
+
+    Equations are rendered with matplotlib's mathtext parser directly (no figure, no
+    layout pass and no PNG encoding), which is much cheaper than drawing a figure.
+    Rendered images are cached on (latex, fontsize, dpi), so an equation that appears
+    again is shown immediately. Equations that are not cached can be rendered on the
+    background thread with render_async, so long messages don't block the Tk thread.
+
+    Example:
+    renderer = LatexRenderer()
+    img = renderer.render("x^2 + y^2")  # PIL image, rendered on this thread
+    renderer.render_async("e^{i x}", 12, 100, lambda img, error: print(img or error))
+    """
+    def __init__(self, max_entries=LATEX_RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # ((latex, fontsize, dpi) -> PIL image, oldest first)
+        self.lock = threading.Lock()  # (protects the cache)
+        self.parser_lock = threading.Lock()  # (the mathtext parser is not thread-safe)
+        self.parser = None
+        self.requests = queue.Queue()
+        self.thread = None
+
+    def cached(self, latex, fontsize=12, dpi=100):
+        """
+        Returns the cached image of an equation, or None if it has not been rendered.
+        """
+        key = (latex, fontsize, dpi)
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+            return img
+
+    def render(self, latex, fontsize=12, dpi=100):
+        """
+        Renders an equation (or returns it from the cache).
+
+        Parameters:
+        - latex (str): The LaTeX math, without the surrounding dollar signs
+        - fontsize (int): Font size in points
+        - dpi (int): Resolution of the image
+
+        Returns:
+        - PIL.Image: Black text on a white background
+
+        Raises:
+        - ValueError: If mathtext cannot parse the expression
+        """
+        img = self.cached(latex, fontsize, dpi)
+        if img is not None:
+            return img
+        with self.parser_lock:
+            if self.parser is None:
+                from matplotlib.mathtext import MathTextParser
+                self.parser = MathTextParser("agg")
+            from matplotlib.font_manager import FontProperties
+            # The raster result's sixth field is the glyph coverage (0 = background)
+            coverage = np.asarray(self.parser.parse(f"${latex}$", dpi=dpi, prop=FontProperties(size=fontsize))[5])
+        img = Image.fromarray(255 - coverage.astype(np.uint8), "L")
+        # Pad the equation a little, like the text around it
+        padded = Image.new("L", (img.width + 8, img.height + 8), 255)
+        padded.paste(img, (4, 4))
+        with self.lock:
+            self.entries[(latex, fontsize, dpi)] = padded
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return padded
+
+    def render_async(self, latex, fontsize, dpi, callback):
+        """
+        Renders an equation on the background thread and calls callback(img, error)
+        from that thread when done, so the callback must hand the result over to the
+        Tk thread (for example with root.after).
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.requests.put((latex, fontsize, dpi, callback))
+
+    def run(self):
+        # Runs on the background thread
+        while True:
+            latex, fontsize, dpi, callback = self.requests.get()
+            try:
+                img = self.render(latex, fontsize, dpi)
+            except Exception as e:
+                callback(None, str(e))
+            else:
+                callback(img, None)
+
+
+# Shared renderer for chat equations
+latex_renderer = LatexRenderer()
+
+
 def render_latex(latex_string, fontsize=12, dpi=100):
-        # Create a figure and axis
-        fig, ax = plt.subplots(figsize=(6, 0.5), dpi=dpi)
-        ax.axis('off')
-        
-        # Render the LaTeX string
-        ax.text(0, 0.5, f'${latex_string}$', fontsize=fontsize, va='center')
-        
-        # Save the figure to a buffer
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0.1)
-        plt.close(fig)
-        buf.seek(0)
-        
-        # Create a PhotoImage from the buffer
-        img = Image.open(buf)
-        return ImageTk.PhotoImage(img)
+    """
+    Renders LaTeX math to a PhotoImage on the calling thread (see LatexRenderer).
+
+    Parameters:
+    - latex_string (str): The LaTeX math, without the surrounding dollar signs
+    - fontsize (int): Font size in points
+    - dpi (int): Resolution of the image
+
+    Returns:
+    - ImageTk.PhotoImage: The rendered equation
+    """
+    return ImageTk.PhotoImage(latex_renderer.render(latex_string, fontsize, dpi))
 
 def main():
 
     """ Main function to run the PDFStudyAssistant application.
     This function creates the root window and initializes the PDFStudyAssistant
     application, then starts the main event loop."""
+    parser = argparse.ArgumentParser(description="PDF Study Assistant")
+    parser.add_argument("--benchmark-ocr", metavar="PATH", help="measure OCR latency per call on an image or PDF and exit")
+    args = parser.parse_args()
+    if args.benchmark_ocr:
+        benchmark_ocr(args.benchmark_ocr)
+        return
+
     root = tkdnd.TkinterDnD.Tk()
     app = PDFStudyAssistant(root)
+    # after_idle runs once the event loop is idle, i.e. after the window has been drawn
+    root.after_idle(app.on_first_window)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+# Tests for fetching and extracting web pages (fetch_pages, build_excerpt_bundle),
+# run against a local stand-in HTTP server on 127.0.0.1.
+#
+# The tests import main.py, so they need the application's dependencies from
+# requirements.txt (PyMuPDF, openai, httpx, tkinterdnd2, pytesseract, ...) and
+# Tkinter; without them the whole file is skipped. They don't use the network.
+#
+# Run with: python -m unittest discover tests
+import os
+import sys
+import threading
+import time
+import unittest
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import main
+except ImportError as e:
+    raise unittest.SkipTest(f"the application's dependencies are not installed: {str(e)}")
+
+
+SHARED = "Entropy measures the number of microscopic configurations that are consistent with a macrostate."
+
+PAGES = {
+    "/a": ("text/html; charset=utf-8",
+           "<html><head><title>Page A</title><script>var hidden = 'script text must not be extracted at all';</script></head>"
+           "<body><nav>Home About Contact Blog Archive Search Login</nav>"
+           f"<p>{SHARED}</p><p>The second law says the entropy of an isolated system never decreases.</p>"
+           "<footer>Copyright notice that is long enough to count as a paragraph</footer></body></html>"),
+    "/b": ("text/html", f"<html><title>Page B</title><body><div>{SHARED}</div>"
+                        "<p>Only page B explains how heat engines reach the Carnot efficiency.</p></body></html>"),
+    "/big": ("text/html", "<p>" + "word " * 20000 + "</p>"),
+    "/pdf": ("application/pdf", "%PDF-1.4 not a web page"),
+    "/delayed": ("text/html", "<p>This page is served after a short delay to test concurrent fetching.</p>"),
+    "/delayed2": ("text/html", "<p>This page is served after a short delay to test concurrent fetching.</p>"),
+    "/delayed3": ("text/html", "<p>This page is served after a short delay to test concurrent fetching.</p>"),
+    "/slow": ("text/html", "<p>This page is served too late and must be cut off by the time cap.</p>"),
+    "/flaky": ("text/html", "<p>This page is served on the second attempt, after a temporary error.</p>"),
+}
+DELAYS = {"/delayed": 0.6, "/delayed2": 0.6, "/delayed3": 0.6, "/slow": 3.0}
+# Pages that answer every other request with "503 Service Unavailable", so each fetch
+# fails once and is served when it is retried
+FLAKY = {"/flaky"}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    requests = Counter()  # (number of requests per path)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path not in PAGES:
+            self.send_response(404)
+            self.end_headers()
+            return
+        time.sleep(DELAYS.get(self.path.split("?")[0], 0))
+        self.requests[self.path] += 1
+        if self.path in FLAKY and self.requests[self.path] % 2 == 1:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        content_type, text = PAGES[self.path]
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+class WebFetchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def url(self, path):
+        return self.base + path
+
+    def test_pages_are_fetched_concurrently(self):
+        # Three pages that each take 0.6 s arrive together, not one after another
+        urls = [self.url("/delayed"), self.url("/delayed2"), self.url("/delayed3")]
+        started = time.perf_counter()
+        pages = main.fetch_pages(urls, timeout=5)
+        elapsed = time.perf_counter() - started
+        self.assertEqual(set(pages), set(urls))
+        self.assertLess(elapsed, 1.5)
+
+    def test_slow_page_is_cut_off_by_the_time_cap(self):
+        started = time.perf_counter()
+        pages = main.fetch_pages([self.url("/slow"), self.url("/a")], timeout=0.5)
+        self.assertLess(time.perf_counter() - started, 2.0)
+        self.assertNotIn(self.url("/slow"), pages)
+        self.assertIn(self.url("/a"), pages)
+
+    def test_size_cap(self):
+        pages = main.fetch_pages([self.url("/big")], max_bytes=2000, timeout=5)
+        _, paragraphs = pages[self.url("/big")]
+        self.assertLessEqual(sum(len(paragraph) for paragraph in paragraphs), 2000)
+
+    def test_temporary_error_is_retried(self):
+        pages = main.fetch_pages([self.url("/flaky")], timeout=5)
+        self.assertIn(self.url("/flaky"), pages)
+
+    def test_non_html_content_is_skipped(self):
+        pages = main.fetch_pages([self.url("/pdf"), self.url("/missing")], timeout=5)
+        self.assertEqual(pages, {})
+
+    def test_readable_text_is_extracted(self):
+        pages = main.fetch_pages([self.url("/a")], timeout=5)
+        title, paragraphs = pages[self.url("/a")]
+        self.assertEqual(title, "Page A")
+        self.assertEqual(paragraphs[0], SHARED)
+        text = " ".join(paragraphs)
+        self.assertNotIn("script text", text)
+        self.assertNotIn("Copyright", text)
+        self.assertNotIn("Login", text)
+
+    def test_excerpts_are_deduplicated(self):
+        results = [{"title": "A", "href": self.url("/a")}, {"title": "B", "href": self.url("/b")},
+                   {"title": "PDF", "href": self.url("/pdf")}]
+        pages = main.fetch_pages([result["href"] for result in results], timeout=5)
+        bundle = main.build_excerpt_bundle(results, pages)
+        self.assertEqual(bundle.count(SHARED), 1)
+        self.assertIn("[1] Page A", bundle)
+        self.assertIn("[2] Page B", bundle)
+        self.assertIn("Carnot efficiency", bundle)
+        self.assertNotIn("[3]", bundle)
+
+
+if __name__ == "__main__":
+    unittest.main()